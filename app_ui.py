@@ -1,18 +1,61 @@
 # app_ui.py
+import hashlib
+import logging
 import os
 import pandas as pd
 import streamlit as st
 
 from contabilizar_factura import (
-    extraer_campos_azure,
-    construir_asiento,
-    clasificar_con_gpt,
     validar_balance,
+    validar_asientos_lote,
+    aprender_de_asiento,
+    obtener_catalogo_puc,
+    obtener_reglas,
+    obtener_registro_ica,
+    pool_clientes,
 )
+from cola_facturas import ColaFacturas, EN_COLA, ERROR, LISTO
+from diario import DIARIO_DIR, DiarioContable, cargar_diario, periodo_actual
+from metricas import configurar_logging, servir_metricas
+
+configurar_logging()
+servir_metricas()  # solo si METRICAS_PUERTO está definido; idempotente entre reruns
 
 st.set_page_config(page_title="App Contable - Facturas", layout="wide")
 st.title("📄 Procesamiento Contable de Facturas - Synergy Pack")
 
+# --- Recursos compartidos por todas las sesiones y reruns ---
+@st.cache_resource
+def obtener_cola() -> ColaFacturas:
+    """Cola de procesamiento en segundo plano: una por servidor, sobrevive a los reruns."""
+    return ColaFacturas()
+
+@st.cache_resource
+def _precargar() -> bool:
+    """Catálogo PUC, reglas, tarifas ICA y clientes HTTP listos antes de la primera factura."""
+    for carga in (obtener_catalogo_puc, obtener_reglas, obtener_registro_ica,
+                  pool_clientes.azure, pool_clientes.openai):
+        try:
+            carga()
+        except Exception as e:  # credenciales/archivos ausentes: el error real saldrá al procesar
+            logging.getLogger("contabilizar").warning("precarga %s: %s", getattr(carga, "__name__", carga), e)
+    return True
+
+@st.cache_data(max_entries=4)
+def _diario_mes(periodo: str, firma: tuple) -> pd.DataFrame:
+    # `firma` (mtime/tamaño del diario) invalida la caché cuando se anexa un asiento
+    return cargar_diario(periodos=[periodo])
+
+def _firma_diario() -> tuple:
+    try:
+        st_ = os.stat(os.path.join(DIARIO_DIR, "diario.jsonl"))
+        return (st_.st_mtime_ns, st_.st_size)
+    except OSError:
+        return ()
+
+cola = obtener_cola()
+_precargar()
+
 # --- Helpers ---
 def _empty_row_like(df: pd.DataFrame) -> dict:
     row = {}
@@ -35,109 +78,90 @@ def _insert_before_last(df: pd.DataFrame) -> pd.DataFrame:
         ignore_index=True,
     )
 
-# --- Upload & auto-process once per file ---
-uploaded_file = st.file_uploader("Sube una factura PDF", type=["pdf"])
+_SESION_FACTURA = ("df_edit", "df_base", "campos", "processed_file_sig", "clasificacion", "fuente_clasificacion")
 
-# If user clears the file (clicks ✖), wipe session so the UI goes blank
-if uploaded_file is None and any(
-    k in st.session_state for k in ("df_edit", "df_base", "campos", "processed_file_sig")
-):
-    for k in ("df_edit", "df_base", "campos", "processed_file_sig"):
-        st.session_state.pop(k, None)
+# --- Upload: cada PDF nuevo entra a la cola; la sesión nunca se bloquea ---
+uploaded_files = st.file_uploader("Sube una o varias facturas PDF", type=["pdf"], accept_multiple_files=True)
 
-if uploaded_file is not None:
-    # Build a simple signature so we only process once per uploaded file
-    try:
-        file_sig = f"{uploaded_file.name}:{len(uploaded_file.getbuffer())}"
-    except Exception:
-        file_bytes = uploaded_file.read()
-        file_sig = f"{uploaded_file.name}:{len(file_bytes)}"
-        uploaded_file.seek(0)
-
-    if st.session_state.get("processed_file_sig") != file_sig:
-        # Save temp PDF and process
-        tmp_pdf = "temp_factura.pdf"
-        with open(tmp_pdf, "wb") as f:
-            f.write(uploaded_file.read())
-        try:
-            uploaded_file.seek(0)
-        except Exception:
-            pass
+# If user clears the files (clicks ✖), wipe session so the UI goes blank
+if not uploaded_files and any(k in st.session_state for k in _SESION_FACTURA):
+    for k in _SESION_FACTURA + ("ediciones",):
+        st.session_state.pop(k, None)
 
-        try:
-            # 👇 Animated brain next to “IA” while processing (pulse: contraction/expansion)
-            brain_ui = st.empty()
-            brain_ui.markdown(
-                """
-                <style>
-                  .ia-line{display:flex;align-items:center;gap:.4rem;font-weight:600}
-                  .ia-brain{
-                    display:inline-block;
-                    transform-origin:50% 50%;
-                    will-change: transform;
-                    animation:pulse 1.2s ease-in-out infinite;
-                  }
-                  @keyframes pulse{
-                    0%,100%{ transform: scale(1) }
-                    50%    { transform: scale(0.88) }
-                  }
-                  /* Respect users who prefer reduced motion */
-                  @media (prefers-reduced-motion: reduce){
-                    .ia-brain{ animation: pulse 2.4s ease-in-out infinite; }
-                  }
-                </style>
-                <div class="ia-line">Procesando factura con ayuda de IA <span class="ia-brain">🧠</span></div>
-                """,
-                unsafe_allow_html=True,
-            )
+def _firma_contenido(uploaded_file) -> str:
+    """SHA-256 del PDF (sobre getbuffer(), sin copiar); se calcula una vez por archivo subido."""
+    hashes = st.session_state.setdefault("_hashes", {})
+    clave = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+    if clave not in hashes:
+        hashes[clave] = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    return hashes[clave]
+
+sigs = []
+for uploaded_file in uploaded_files or []:
+    # Firma por contenido: dos facturas distintas del mismo tamaño no se confunden
+    file_sig = _firma_contenido(uploaded_file)
+    trabajo = cola.trabajo(file_sig)
+    if trabajo is None or (trabajo.estado == ERROR and file_sig not in st.session_state.get("cola_sigs", [])):
+        # El PDF pasa en memoria (memoryview del upload) a Azure: sin archivo temporal compartido
+        cola.encolar(file_sig, uploaded_file.name, uploaded_file.getbuffer())
+    if file_sig not in sigs:
+        sigs.append(file_sig)
+st.session_state["cola_sigs"] = sigs
+
+_ETIQUETAS = {EN_COLA: "⏳ en cola", "extrayendo": "🧠 leyendo (Azure)", "esperando azure": "⏳ Azure sigue analizando",
+              "clasificando": "🧠 clasificando", LISTO: "✅ listo", ERROR: "❌ error"}
+
+def _panel_estado():
+    trabajos = [t for t in map(cola.trabajo, st.session_state.get("cola_sigs", [])) if t is not None]
+    if not trabajos:
+        return
+    listos = sum(t.terminado for t in trabajos)
+    st.caption(f"{listos}/{len(trabajos)} archivo(s) procesados")
+    for t in trabajos:
+        n = f" · {len(t.facturas)} factura(s)" if len(t.facturas) > 1 else ""
+        st.progress(t.progreso, text=f"{t.nombre} — {_ETIQUETAS.get(t.estado, t.estado)}{n}")
+        if t.error:
+            st.error(f"{t.nombre}: {t.error}")
+    # Facturas nuevas para revisar: rerun completo para refrescar el selector
+    disponibles = sum(len(t.facturas) for t in trabajos)
+    if disponibles != st.session_state.get("_facturas_vistas"):
+        st.session_state["_facturas_vistas"] = disponibles
+        st.rerun()
+
+_fragmento = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+_pendientes = any(not t.terminado for t in map(cola.trabajo, sigs) if t is not None)
+if _pendientes and _fragmento is not None:
+    _fragmento(run_every=2)(_panel_estado)()  # se refresca solo mientras haya archivos en curso
+else:
+    _panel_estado()
+    if _pendientes and st.button("🔄 Actualizar estado"):
+        st.rerun()
+
+# --- Selección de la factura a revisar (las listas se revisan mientras el resto avanza) ---
+facturas = {}
+for t in filter(None, map(cola.trabajo, sigs)):
+    for i, f in enumerate(list(t.facturas)):
+        etiqueta = t.nombre + (f" · págs {f.paginas}" if len(t.facturas) > 1 or t.estado != LISTO else "")
+        facturas[etiqueta] = (f"{t.sig}#{i}", f)
+
+if facturas:
+    etiqueta = st.selectbox("Factura a revisar", list(facturas))
+    clave, factura = facturas[etiqueta]
+    ediciones = st.session_state.setdefault("ediciones", {})
+    if st.session_state.get("processed_file_sig") != clave:
+        # Build base df and add "Centro de costos" column (empty)
+        df_base = pd.DataFrame(factura.asiento)
+        if "Centro de costos" not in df_base.columns:
+            df_base["Centro de costos"] = ""
+
+        # Persist editing session (las ediciones de cada factura se conservan al cambiar)
+        st.session_state["campos"] = factura.campos
+        st.session_state["clasificacion"] = factura.clasificacion
+        st.session_state["fuente_clasificacion"] = factura.fuente
+        st.session_state["df_base"] = df_base
+        st.session_state["df_edit"] = ediciones.get(clave, df_base.copy())
+        st.session_state["processed_file_sig"] = clave
 
-            with st.spinner("Procesando factura con ayuda de IA..."):
-                campos = extraer_campos_azure(tmp_pdf)
-
-                descripcion = campos.get("Descripcion", "")
-                proveedor = campos.get("Proveedor", "")
-                origen_destino = campos.get("Origen-Destino", "")
-
-                # Compatibilidad: 4 valores (nuevo) o 3 valores (anterior)
-                try:
-                    cuenta, nombre, retention_category, tipo_transaccion = clasificar_con_gpt(
-                        descripcion, proveedor, origen_destino
-                    )
-                except Exception:
-                    cuenta, nombre, retention_category = clasificar_con_gpt(
-                        descripcion, proveedor, origen_destino
-                    )
-                    tipo_transaccion = None
-
-                try:
-                    asiento = construir_asiento(
-                        campos, cuenta, nombre, retention_category, tipo_transaccion
-                    )
-                except TypeError:
-                    asiento = construir_asiento(campos, cuenta, nombre, retention_category)
-
-                # Build base df and add "Centro de costos" column (empty)
-                df_base = pd.DataFrame(asiento)
-                if "Centro de costos" not in df_base.columns:
-                    df_base["Centro de costos"] = ""
-
-                # Persist editing session & mark processed file
-                st.session_state["campos"] = campos
-                st.session_state["df_base"] = df_base
-                st.session_state["df_edit"] = df_base.copy()
-                st.session_state["processed_file_sig"] = file_sig
-
-            st.success("✅ Procesado. Revisa y ajusta el asiento si lo necesitas.")
-        finally:
-            # remove animated brain and temp file
-            try:
-                brain_ui.empty()
-            except Exception:
-                pass
-            try:
-                os.remove(tmp_pdf)
-            except Exception:
-                pass
 # --- Show results if available ---
 if "df_edit" in st.session_state and st.session_state["df_edit"] is not None:
     # Ensure the new column exists even if the file was processed earlier in the session
@@ -154,6 +178,15 @@ if "df_edit" in st.session_state and st.session_state["df_edit"] is not None:
     st.json(campos, expanded=False)
 
     st.subheader("🧾 Asiento sugerido (base)")
+    _fuentes = {
+        "memoria_nit": "memoria por NIT (correcciones confirmadas)",
+        "cache_memoria": "caché de clasificación",
+        "cache_disco": "caché de clasificación",
+        "gpt": "GPT",
+    }
+    fuente = st.session_state.get("fuente_clasificacion")
+    if fuente:
+        st.caption(f"Clasificación decidida por: {_fuentes.get(fuente, fuente)}")
     st.dataframe(df_base, use_container_width=True)
 
     st.markdown("---")
@@ -169,9 +202,10 @@ if "df_edit" in st.session_state and st.session_state["df_edit"] is not None:
         df_edit,
         num_rows="dynamic",
         use_container_width=True,
-        key="editable_editor",
+        key=f"editable_editor_{st.session_state['processed_file_sig']}",
     )
     st.session_state["df_edit"] = df_edit
+    st.session_state.setdefault("ediciones", {})[st.session_state["processed_file_sig"]] = df_edit
 
     # Validación
     if st.button("✅ Validar asiento editado"):
@@ -181,11 +215,40 @@ if "df_edit" in st.session_state and st.session_state["df_edit"] is not None:
         else:
             st.error(f"❌ Asiento desbalanceado. Débitos: {d} | Créditos: {c} | Diferencia: {diff}")
 
-    # Descarga
+    # Descarga: si el asiento cuadra, la clasificación confirmada se recuerda por NIT
+    # (una vez por factura) y el asiento se anexa al diario del periodo (re-descargar lo reemplaza)
+    def _recordar_confirmacion(df: pd.DataFrame = df_edit):
+        lineas = df.to_dict(orient="records")
+        if validar_balance(lineas)[0]:
+            aprender_de_asiento(
+                st.session_state.get("campos", {}),
+                lineas,
+                st.session_state.get("clasificacion"),
+                factura=st.session_state.get("processed_file_sig"),
+            )
+            with DiarioContable() as diario:
+                diario.agregar(lineas, factura=st.session_state.get("processed_file_sig", ""),
+                               campos=st.session_state.get("campos", {}))
+
     st.download_button(
         "📥 Descargar CSV editado",
         df_edit.to_csv(index=False),
         file_name="asiento_editado.csv",
+        on_click=_recordar_confirmacion,
     )
-else:
-    st.info("Sube una factura para procesarla automáticamente.")
+elif not sigs:
+    st.info("Sube una o varias facturas para procesarlas automáticamente.")
+
+# --- Diario del periodo: un solo archivo para el ERP ---
+with st.sidebar:
+    st.subheader("📒 Diario del mes")
+    df_diario = _diario_mes(periodo_actual(), _firma_diario())
+    st.caption(f"{df_diario['factura'].nunique()} factura(s), {len(df_diario)} línea(s) en {periodo_actual()}")
+    if not df_diario.empty:
+        reporte = validar_asientos_lote(df_diario)
+        (st.caption if reporte.ok else st.warning)(reporte.resumen())
+        st.download_button(
+            "📦 Descargar diario consolidado (CSV)",
+            df_diario.to_csv(index=False),
+            file_name=f"diario_{periodo_actual()}.csv",
+        )
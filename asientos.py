@@ -0,0 +1,277 @@
+# asientos.py
+"""
+Representación compacta de las líneas de asiento para lotes grandes.
+
+    from asientos import DiarioColumnar, LineaAsiento
+
+    d = DiarioColumnar()
+    d.agregar(cf.construir_asiento(...), clave="factura-1")   # lista de dicts de siempre
+    d = DiarioColumnar.desde_dataframe(cf.construir_asientos_lote(df))
+    df = d.a_dataframe()                                     # columnas de _COLUMNAS_ASIENTO
+    d.a_dicts("factura-1")                                   # el formato dict de siempre
+    cf.validar_asientos_lote(d)                              # totales exactos, sin parsear
+
+Los importes se guardan en centavos enteros: se convierten una sola vez al
+entrar y no se vuelven a parsear (to_float) en cada validación o exportación.
+LineaAsiento usa __slots__ y se comporta como el dict de siempre para leer
+(l["cuenta"], l.get("debito"), dict(l)). DiarioColumnar guarda cada columna
+por separado (array 'q'/'d' para números, listas de cadenas internadas para
+textos: la misma cuenta o el mismo nombre en miles de líneas es un solo objeto)
+y cada asiento ocupa un rango contiguo de líneas.
+"""
+from array import array
+
+# Claves del formato dict de una línea (construir_asiento, diario, UI)
+CUENTA, NOMBRE, DEBITO, CREDITO, CANTIDAD, TERCERO, DETALLE = (
+    "cuenta", "nombre", "debito", "credito", "Cantidad (Kg)", "Tercero", "Detalle")
+
+
+def _numero(valor) -> float:
+    """Como to_float: número o texto '1,234.50'; lo no numérico (y NaN) es 0."""
+    if isinstance(valor, (int, float)):
+        return float(valor) if valor == valor else 0.0
+    try:
+        return float(str(valor).replace(",", "").strip())
+    except ValueError:
+        return 0.0
+
+
+def centavos(valor) -> int:
+    """Importe a centavos enteros."""
+    return round(_numero(valor) * 100)
+
+
+def centavos_serie(serie):
+    """centavos() vectorizado sobre una Serie: int64; solo el texto que no es número directo se limpia."""
+    import pandas as pd
+    valores = pd.to_numeric(serie, errors="coerce")
+    if serie.dtype == object:
+        texto = valores.isna() & serie.notna()
+        if texto.any():
+            valores[texto] = pd.to_numeric(
+                serie[texto].astype(str).str.replace(",", "", regex=False).str.strip(), errors="coerce")
+    return (valores.fillna(0.0) * 100).round().astype("int64")
+
+
+def _texto(valor, defecto=None):
+    return defecto if valor is None or valor != valor else valor  # None/NaN -> defecto
+
+
+class LineaAsiento:
+    """Una línea de asiento con importes en centavos; se lee como el dict de siempre."""
+
+    __slots__ = ("cuenta", "nombre", "debito_c", "credito_c", "cantidad", "tercero", "detalle")
+
+    def __init__(self, cuenta: str, nombre: str = "", debito_c: int = 0, credito_c: int = 0,
+                 cantidad: float = 0.0, tercero: str = None, detalle: str = None):
+        self.cuenta = cuenta
+        self.nombre = nombre
+        self.debito_c = debito_c
+        self.credito_c = credito_c
+        self.cantidad = cantidad
+        self.tercero = tercero
+        self.detalle = detalle
+
+    @classmethod
+    def desde_dict(cls, d: dict) -> "LineaAsiento":
+        return cls(str(d.get(CUENTA) or "").strip(), _texto(d.get(NOMBRE), ""), centavos(d.get(DEBITO, 0)),
+                   centavos(d.get(CREDITO, 0)), _numero(d.get(CANTIDAD, 0)),
+                   _texto(d.get(TERCERO)), _texto(d.get(DETALLE)))
+
+    @property
+    def debito(self) -> float:
+        return self.debito_c / 100
+
+    @property
+    def credito(self) -> float:
+        return self.credito_c / 100
+
+    # --- lectura como dict: l["cuenta"], l.get("debito"), dict(l) ---
+    def keys(self):
+        claves = [CUENTA, NOMBRE, DEBITO, CREDITO, CANTIDAD]
+        if self.tercero is not None:
+            claves.append(TERCERO)
+        if self.detalle is not None:
+            claves.append(DETALLE)
+        return claves
+
+    def __getitem__(self, clave: str):
+        if clave == CUENTA:
+            return self.cuenta
+        if clave == NOMBRE:
+            return self.nombre
+        if clave == DEBITO:
+            return self.debito
+        if clave == CREDITO:
+            return self.credito
+        if clave == CANTIDAD:
+            return self.cantidad
+        if clave == TERCERO and self.tercero is not None:
+            return self.tercero
+        if clave == DETALLE and self.detalle is not None:
+            return self.detalle
+        raise KeyError(clave)
+
+    def get(self, clave: str, default=None):
+        try:
+            return self[clave]
+        except KeyError:
+            return default
+
+    def a_dict(self) -> dict:
+        return {k: self[k] for k in self.keys()}
+
+    def __repr__(self):
+        return f"LineaAsiento({self.a_dict()!r})"
+
+
+class DiarioColumnar:
+    """Líneas de muchos asientos en columnas; cada asiento es un rango contiguo de líneas."""
+
+    def __init__(self):
+        self.claves = []             # clave de cada asiento (p.ej. la factura)
+        self._indice = {}            # clave -> posición en self.claves
+        self.inicios = array("q")    # primera línea de cada asiento
+        self.asiento = array("q")    # posición del asiento de cada línea
+        self.cuenta = []
+        self.nombre = []
+        self.debito_c = array("q")
+        self.credito_c = array("q")
+        self.cantidad = array("d")
+        self.tercero = []
+        self.detalle = []
+        self._textos = {}
+
+    def _interna(self, s):
+        return s if s is None else self._textos.setdefault(s, s)
+
+    def __len__(self) -> int:
+        return len(self.debito_c)
+
+    def __contains__(self, clave) -> bool:
+        return clave in self._indice
+
+    def agregar(self, asiento, clave) -> int:
+        """Anexa un asiento (dicts o LineaAsiento) bajo `clave`; devuelve su número de líneas."""
+        if clave in self._indice:
+            raise ValueError(f"El asiento {clave!r} ya está en el diario")
+        pos = self._indice[clave] = len(self.claves)
+        self.claves.append(clave)
+        self.inicios.append(len(self))
+        n = 0
+        for l in asiento:
+            if not isinstance(l, LineaAsiento):
+                l = LineaAsiento.desde_dict(l)
+            self.asiento.append(pos)
+            self.cuenta.append(self._interna(l.cuenta))
+            self.nombre.append(self._interna(l.nombre))
+            self.debito_c.append(l.debito_c)
+            self.credito_c.append(l.credito_c)
+            self.cantidad.append(l.cantidad)
+            self.tercero.append(self._interna(l.tercero))
+            self.detalle.append(self._interna(l.detalle))
+            n += 1
+        return n
+
+    @classmethod
+    def desde_dicts(cls, asientos) -> "DiarioColumnar":
+        """Desde {clave: [dict, ...]} o un iterable de (clave, asiento)."""
+        diario = cls()
+        for clave, asiento in (asientos.items() if hasattr(asientos, "items") else asientos):
+            diario.agregar(asiento, clave)
+        return diario
+
+    def linea(self, i: int) -> LineaAsiento:
+        return LineaAsiento(self.cuenta[i], self.nombre[i], self.debito_c[i], self.credito_c[i],
+                            self.cantidad[i], self.tercero[i], self.detalle[i])
+
+    def __iter__(self):
+        return (self.linea(i) for i in range(len(self)))
+
+    def _rango(self, pos: int) -> range:
+        fin = self.inicios[pos + 1] if pos + 1 < len(self.inicios) else len(self)
+        return range(self.inicios[pos], fin)
+
+    def lineas_de(self, clave) -> list:
+        return [self.linea(i) for i in self._rango(self._indice[clave])]
+
+    def a_dicts(self, clave=None):
+        """Lista de dicts del asiento `clave` o, sin clave, {clave: [dicts]} de todos."""
+        if clave is not None:
+            return [l.a_dict() for l in self.lineas_de(clave)]
+        return {c: [self.linea(i).a_dict() for i in self._rango(p)] for c, p in self._indice.items()}
+
+    def totales(self):
+        """(claves, débitos, créditos) por asiento, en centavos int64 exactos; un asiento sin líneas suma 0."""
+        import numpy as np
+        claves = np.asarray(self.claves, dtype=object)
+        debitos = np.zeros(len(claves), dtype=np.int64)
+        creditos = np.zeros(len(claves), dtype=np.int64)
+        if not len(self):
+            return claves, debitos, creditos
+        # reduceat solo sobre los asientos con líneas: con un inicio repetido (asiento
+        # vacío) devolvería la línea siguiente, y con uno igual a len(self), IndexError
+        inicios = np.frombuffer(self.inicios, dtype=np.int64)
+        con_lineas = inicios < np.append(inicios[1:], len(self))
+        debitos[con_lineas] = np.add.reduceat(np.frombuffer(self.debito_c, dtype=np.int64), inicios[con_lineas])
+        creditos[con_lineas] = np.add.reduceat(np.frombuffer(self.credito_c, dtype=np.int64), inicios[con_lineas])
+        return claves, debitos, creditos
+
+    def a_dataframe(self, clave: str = "asiento"):
+        """DataFrame con las columnas de construir_asientos_lote (importes en pesos)."""
+        import numpy as np
+        import pandas as pd
+        claves = np.asarray(self.claves, dtype=object)
+        return pd.DataFrame({
+            clave: claves[np.frombuffer(self.asiento, dtype=np.int64)] if len(self) else claves[:0],
+            CUENTA: self.cuenta,
+            NOMBRE: self.nombre,
+            DEBITO: np.frombuffer(self.debito_c, dtype=np.int64) / 100,
+            CREDITO: np.frombuffer(self.credito_c, dtype=np.int64) / 100,
+            CANTIDAD: np.frombuffer(self.cantidad, dtype=np.float64).copy(),
+            TERCERO: self.tercero,
+            DETALLE: self.detalle,
+        })
+
+    @classmethod
+    def desde_dataframe(cls, df, clave: str = "asiento") -> "DiarioColumnar":
+        """
+        Desde un DataFrame de líneas (construir_asientos_lote, diario.cargar_diario
+        con clave='factura'). Las líneas de un mismo asiento se agrupan en orden
+        estable. ValueError si alguna línea no trae su clave de asiento.
+        """
+        import numpy as np
+        import pandas as pd
+        codigos, claves = pd.factorize(df[clave], sort=False)
+        if len(codigos) and codigos.min() < 0:
+            # factorize marca la clave vacía con -1: se colaría en el último asiento
+            filas = np.flatnonzero(codigos < 0)
+            raise ValueError(f"{len(filas)} línea(s) sin '{clave}' (filas {filas[:5].tolist()})")
+        orden = np.argsort(codigos, kind="stable")
+        codigos = codigos[orden]
+
+        def _col(nombre, defecto=None):
+            if nombre not in df.columns:
+                return [defecto] * len(df)
+            return df[nombre].to_numpy(dtype=object)[orden]
+
+        def _centavos_col(nombre):
+            if nombre not in df.columns:
+                return np.zeros(len(df), dtype=np.int64)
+            return centavos_serie(df[nombre]).to_numpy()[orden]
+
+        diario = cls()
+        diario.claves = list(claves)
+        diario._indice = {c: i for i, c in enumerate(diario.claves)}
+        diario.inicios = array("q", np.searchsorted(codigos, np.arange(len(claves))).astype(np.int64).tobytes())
+        diario.asiento = array("q", codigos.astype(np.int64).tobytes())
+        diario.debito_c = array("q", _centavos_col(DEBITO).tobytes())
+        diario.credito_c = array("q", _centavos_col(CREDITO).tobytes())
+        cantidad = (pd.to_numeric(df[CANTIDAD], errors="coerce").fillna(0.0).to_numpy(dtype=np.float64)[orden]
+                    if CANTIDAD in df.columns else np.zeros(len(df)))
+        diario.cantidad = array("d", np.ascontiguousarray(cantidad).tobytes())
+        diario.cuenta = [diario._interna(str(_texto(v, "")).strip()) for v in _col(CUENTA, "")]
+        diario.nombre = [diario._interna(_texto(v, "")) for v in _col(NOMBRE, "")]
+        diario.tercero = [diario._interna(_texto(v)) for v in _col(TERCERO)]
+        diario.detalle = [diario._interna(_texto(v)) for v in _col(DETALLE)]
+        return diario
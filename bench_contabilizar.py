@@ -0,0 +1,327 @@
+# bench_contabilizar.py
+"""
+Mediciones de rendimiento de contabilizar_factura.
+
+Uso:
+    python bench_contabilizar.py importacion     # tiempo de `import contabilizar_factura`
+    python bench_contabilizar.py lote -n 10000   # construir_asientos_lote vs construir_asiento
+    python bench_contabilizar.py micro           # funciones puras vs línea base
+    python bench_contabilizar.py micro --guardar-linea-base
+
+El objetivo de importación (IMPORT_OBJETIVO_MS, default 100 ms) se mide en un
+intérprete limpio y SIN credenciales en el entorno: importar el módulo no debe
+leer variables de entorno ni cargar pandas / Azure / OpenAI.
+
+La medición de lote verifica primero la paridad línea a línea entre
+construir_asientos_lote y construir_asiento sobre facturas sintéticas, y luego
+exige un speedup >= LOTE_OBJETIVO_X (default 10x) con 10 000 facturas. La
+paridad también se verifica en tests/test_asientos_lote.py.
+
+La medición micro reporta, por función pura del camino contable, la latencia
+(ns por llamada, mediana de las rondas) y el pico de memoria asignada por
+llamada (tracemalloc). Con --guardar-linea-base escribe BENCH_LINEA_BASE
+(default bench_linea_base.json); sin él compara contra ese archivo y falla si
+alguna función empeora más de BENCH_TOLERANCIA (default 25 %).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_OBJETIVO_MS = float(os.getenv("IMPORT_OBJETIVO_MS", "100"))
+MODULOS_PESADOS = ("pandas", "openai", "httpx", "azure.ai.formrecognizer")
+LOTE_OBJETIVO_X = float(os.getenv("LOTE_OBJETIVO_X", "10"))
+LOTE_CORRIDAS_POR_ESCALAR = 5  # el lote es ~10x más barato: más corridas estabilizan su mínimo
+BENCH_LINEA_BASE = os.getenv("BENCH_LINEA_BASE", os.path.join(AQUI, "bench_linea_base.json"))
+BENCH_TOLERANCIA = float(os.getenv("BENCH_TOLERANCIA", "0.25"))
+
+
+# =====================  Tiempo de importación  =====================
+
+_SONDA = (
+    "import sys, json, contabilizar_factura\n"
+    "print(json.dumps([m for m in %r if m in sys.modules]))\n"
+) % (MODULOS_PESADOS,)
+
+def medir_importacion(repeticiones: int = 7) -> dict:
+    """
+    Importa contabilizar_factura en `repeticiones` intérpretes nuevos con
+    -X importtime y devuelve la mediana (ms) del tiempo acumulado del módulo,
+    más los módulos pesados que se hayan cargado (debería ser ninguno).
+    """
+    env = {k: v for k, v in os.environ.items() if k not in
+           ("OPENAI_API_KEY", "AZURE_KEY", "AZURE_ENDPOINT", "AZURE_MODEL_ID")}
+    # Precompila para no medir la compilación a bytecode
+    subprocess.run([sys.executable, "-m", "compileall", "-q", os.path.join(AQUI, "contabilizar_factura.py")],
+                   check=True, env=env)
+    tiempos, cargados = [], []
+    for _ in range(repeticiones):
+        p = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", _SONDA],
+            cwd=AQUI, env=env, capture_output=True, text=True, check=True,
+        )
+        m = re.search(r"\|\s*(\d+)\s*\|\s*contabilizar_factura\s*$", p.stderr, flags=re.M)
+        tiempos.append(int(m.group(1)) / 1000.0)
+        cargados = p.stdout.strip()
+    return {
+        "mediana_ms": round(statistics.median(tiempos), 2),
+        "min_ms": round(min(tiempos), 2),
+        "objetivo_ms": IMPORT_OBJETIVO_MS,
+        "modulos_pesados_cargados": cargados,
+    }
+
+
+# =====================  Facturas sintéticas  =====================
+
+_PERFILES = [
+    # (cuenta, nombre, categoría GPT, tipo, descripción, proveedor, ciudad, régimen, CIIU)
+    ("14051001", "Arroz paddy", "COMPRAS 1.5%", "bienes", "Compra arroz paddy verde",
+     "Agropecuaria El Llano SAS", "Villavicencio", "Responsable de IVA", "0112"),
+    ("14051001", "Arroz paddy", "Compras 1.5 %", "bienes", "ARROZ PADDY SECO",
+     "Molinos del Tolima", "Ibagué, Tolima", "No responsable de IVA", "0112"),
+    ("5235500000", "Fletes", "SERVICIOS FLETES 1%", "servicios", "Flete Ibagué - Bogotá",
+     "Transportes Rápido SAS", "Bogotá", "Responsable de IVA", "4923"),
+    ("5235500000", "Fletes", "", "servicios", "Servicio de transporte de carga",
+     "Transcarga Ltda", "Ibague", "Autorretenedor de renta", "4923"),
+    ("513550", "Servicios de aseo", "SERVICIOS 4%", "servicios", "Aseo y cafetería",
+     "Limpieza Total SAS", "Ibagué", "Responsable de IVA", "8121"),
+    ("513550", "Honorarios", "SERVICIOS 2%", "servicios", "Asesoría contable mensual",
+     "Contadores Asociados", "Ibagué", "Régimen Simple de Tributación", "6920"),
+    ("733550", "Mantenimiento", "COMPRAS 2.5%", "bienes", "Repuestos molino",
+     "Ferretería Central", "Ibagué", "iva\nNo somos autorretenedores", "4752"),
+    ("51201001", "Arrendamiento", "ARRENDAMIENTO BIENES INMUEBLES 3.5%", "servicios", "Canon bodega",
+     "Inmobiliaria Andina", "Ibagué", "Responsable de IVA", "6810"),
+]
+
+def facturas_sinteticas(n: int = 1000, semilla: int = 7) -> list:
+    """
+    `n` pares (campos, clasificación) realistas y reproducibles: arroz paddy con
+    Cantidad multilínea, fletes con Origen-Destino, proveedores de Ibagué,
+    autorretenedores / RST, IVA 19 % / 5 % / sin IVA y retenciones ya liquidadas.
+    """
+    rnd = random.Random(semilla)
+    out = []
+    for i in range(n):
+        cuenta, nombre, cat, tipo, desc, prov, ciudad, regimen, ciiu = _PERFILES[i % len(_PERFILES)]
+        subtotal = round(rnd.uniform(200_000, 60_000_000), rnd.choice((0, 2)))
+        fletes = rnd.choice((0, 0, 0, round(subtotal * 0.03)))
+        iva = round(subtotal * rnd.choice((0.19, 0.05, 0.0, 0.19)), 2)
+        total = subtotal + fletes + iva if rnd.random() < 0.8 else subtotal + iva
+        campos = {
+            "Proveedor": prov,
+            "NIT Proveedor": f"{900000000 + i % 997}-{i % 10}",
+            "Ciudad": ciudad,
+            "Regimen Tributario": regimen,
+            "Actividad Economica": rnd.choice((f"Actividad Económica {ciiu} Tarifa {rnd.choice((4, 7, 10))}",
+                                               f"CIIU: {ciiu}", f"{ciiu} - Actividad")),
+            "Descripcion": desc,
+            "Subtotal": f"{subtotal:,.2f}" if rnd.random() < 0.5 else str(subtotal),
+            "IVA Valor": str(iva),
+            "Total Factura": str(total),
+            "Fletes": str(fletes),
+            "Retefuente Valor": str(round(subtotal * 0.025, 2)) if rnd.random() < 0.15 else "0",
+        }
+        if cuenta == "14051001":
+            campos["Cantidad"] = "\n".join(f"{rnd.randint(1, 40) * 500:,}" for _ in range(rnd.randint(1, 4)))
+            if rnd.random() < 0.3:
+                campos["Impuesto Fomento"] = str(round(subtotal * 0.005, 2))
+        if cuenta == "5235500000":
+            campos["Origen-Destino"] = rnd.choice(("Ibagué - Bogotá", "IBAGUE -> CALI", "Espinal / Ibagué", ""))
+        if rnd.random() < 0.1:
+            campos["ReteICA Valor"] = "1500"
+        out.append((campos, (cuenta, nombre, cat, tipo)))
+    return out
+
+
+# =====================  Asientos en lote  =====================
+
+def _normalizar_linea(l: dict) -> tuple:
+    def texto(v):
+        return v if isinstance(v, str) and v else None  # NaN / None / "" = sin dato
+    return (str(l["cuenta"]), l["nombre"], round(float(l["debito"]), 2), round(float(l["credito"]), 2),
+            round(float(l.get("Cantidad (Kg)") or 0), 2), texto(l.get("Tercero")), texto(l.get("Detalle")))
+
+def medir_lote(n: int = 10000, semilla: int = 7, repeticiones: int = 3) -> dict:
+    """
+    Paridad y speedup de construir_asientos_lote frente a construir_asiento.
+    Tiempos = mejor de `repeticiones` corridas del escalar y de
+    repeticiones * LOTE_CORRIDAS_POR_ESCALAR del lote; la salida de depuración
+    del escalar se descarta para no medir la consola.
+    """
+    import pandas as pd
+    import contabilizar_factura as cf
+
+    facturas = facturas_sinteticas(n, semilla)
+    filas = [dict(c, cuenta=k[0], nombre=k[1], retention_category=k[2], tipo_transaccion=k[3])
+             for c, k in facturas]
+    df = pd.DataFrame(filas)
+    cf.seleccionar_cuentas_cxp_lote(["14051001"])  # carga índice CxP / tarifas fuera del cronómetro
+    cf.obtener_registro_ica()
+
+    t_escalar = t_lote = float("inf")
+    for _ in range(max(1, repeticiones)):
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            escalar = [cf.construir_asiento(dict(c), *k) for c, k in facturas]
+        t_escalar = min(t_escalar, time.perf_counter() - t0)
+
+        for _ in range(LOTE_CORRIDAS_POR_ESCALAR):
+            t0 = time.perf_counter()
+            lote = cf.construir_asientos_lote(df)
+            t_lote = min(t_lote, time.perf_counter() - t0)
+
+    por_factura = {i: [] for i in range(n)}
+    for l in lote.to_dict("records"):
+        por_factura[l["asiento"]].append(_normalizar_linea(l))
+    difieren = [i for i in range(n) if por_factura[i] != [_normalizar_linea(l) for l in escalar[i]]]
+    return {
+        "facturas": n,
+        "lineas": len(lote),
+        "escalar_s": round(t_escalar, 3),
+        "lote_s": round(t_lote, 3),
+        "speedup": round(t_escalar / t_lote, 1),
+        "objetivo_x": LOTE_OBJETIVO_X,
+        "difieren": difieren[:10],
+        "n_difieren": len(difieren),
+    }
+
+
+# =====================  Microbenchmarks (funciones puras)  =====================
+
+def _casos_micro(facturas) -> dict:
+    """nombre -> (función, [args, ...]) sobre las facturas sintéticas."""
+    import contabilizar_factura as cf
+
+    campos = [c for c, _ in facturas]
+    clasif = [k for _, k in facturas]
+    return {
+        "normalize_retention_category": (cf.normalize_retention_category,
+                                         [(k[2], c["Descripcion"], k[0]) for c, k in facturas]),
+        "es_autorretenedor_renta": (cf.es_autorretenedor_renta, [(c["Regimen Tributario"],) for c in campos]),
+        "es_autorretenedor_ica": (cf.es_autorretenedor_ica, [(c["Regimen Tributario"],) for c in campos]),
+        "parse_ciiu": (cf.parse_ciiu, [(c["Actividad Economica"],) for c in campos]),
+        "extraer_origen": (cf.extraer_origen, [(c["Origen-Destino"],) for c in campos if "Origen-Destino" in c]),
+        "seleccionar_cuenta_cxp_por_pares": (cf.seleccionar_cuenta_cxp_por_pares, [(k[0],) for k in clasif]),
+        "calcular_ica_bomberil_consolidado": (cf.calcular_ica_bomberil_consolidado,
+                                              [(c, cf.to_float(c["Subtotal"])) for c in campos]),
+        "construir_asiento": (lambda c, *k: cf.construir_asiento(dict(c), *k),
+                              [(c, *k) for c, k in facturas]),
+    }
+
+def medir_micro(n: int = 200, rondas: int = 5, semilla: int = 7) -> dict:
+    """
+    Por función: ns por llamada (mediana de `rondas` pasadas sobre `n` fixtures)
+    y KB de pico asignado por llamada (promedio, tracemalloc). La salida de
+    depuración de construir_asiento se descarta.
+    """
+    import contabilizar_factura as cf
+
+    casos = _casos_micro(facturas_sinteticas(n, semilla))
+    cf.obtener_registro_ica()  # cargas únicas (tarifas, índice CxP) fuera de la medición
+    cf.seleccionar_cuentas_cxp_lote(["14051001"])
+    resultados = {}
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        for nombre, (fn, args) in casos.items():
+            for a in args:  # calentamiento
+                fn(*a)
+            tiempos = []
+            for _ in range(max(1, rondas)):
+                t0 = time.perf_counter_ns()
+                for a in args:
+                    fn(*a)
+                tiempos.append((time.perf_counter_ns() - t0) / len(args))
+
+            tracemalloc.start()
+            picos = 0
+            for a in args:
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                fn(*a)
+                picos += tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+
+            resultados[nombre] = {
+                "ns_llamada": round(statistics.median(tiempos)),
+                "kb_pico_llamada": round(picos / len(args) / 1024, 2),
+                "llamadas": len(args),
+            }
+    return resultados
+
+def comparar_linea_base(actual: dict, base: dict, tolerancia: float = BENCH_TOLERANCIA) -> list:
+    """Lista de (función, métrica, base, actual) que empeoraron más de `tolerancia`."""
+    regresiones = []
+    for nombre, r in actual.items():
+        b = base.get(nombre)
+        if not b:
+            continue
+        for metrica, holgura in (("ns_llamada", 0), ("kb_pico_llamada", 0.1)):
+            if r[metrica] > b[metrica] * (1 + tolerancia) + holgura:
+                regresiones.append((nombre, metrica, b[metrica], r[metrica]))
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de contabilizar_factura")
+    parser.add_argument("medicion", nargs="?", default="importacion", choices=["importacion", "lote", "micro"])
+    parser.add_argument("--repeticiones", type=int, default=None,
+                        help="Corridas por medición (default 7 importacion, 3 lote, 5 micro)")
+    parser.add_argument("-n", type=int, default=None, help="Facturas sintéticas (default 10000 lote, 200 micro)")
+    parser.add_argument("--guardar-linea-base", action="store_true",
+                        help="micro: guarda los resultados como nueva línea base")
+    args = parser.parse_args(argv)
+
+    if args.medicion == "micro":
+        r = medir_micro(args.n or 200, rondas=args.repeticiones or 5)
+        base = {}
+        if os.path.exists(BENCH_LINEA_BASE):
+            with open(BENCH_LINEA_BASE, "r", encoding="utf-8") as f:
+                base = json.load(f).get("funciones", {})
+        print(f"{'función':<36}{'ns/llamada':>12}{'base':>12}{'KB pico':>10}{'base':>10}")
+        for nombre, m in r.items():
+            b = base.get(nombre, {})
+            print(f"{nombre:<36}{m['ns_llamada']:>12}{b.get('ns_llamada', '-'):>12}"
+                  f"{m['kb_pico_llamada']:>10}{b.get('kb_pico_llamada', '-'):>10}")
+        if args.guardar_linea_base:
+            with open(BENCH_LINEA_BASE, "w", encoding="utf-8") as f:
+                json.dump({"python": sys.version.split()[0], "fecha": time.strftime("%Y-%m-%d"),
+                           "funciones": r}, f, indent=2, ensure_ascii=False)
+            print(f"Línea base guardada en {BENCH_LINEA_BASE}")
+            return 0
+        if not base:
+            print("Sin línea base: ejecute con --guardar-linea-base para crearla.")
+            return 0
+        regresiones = comparar_linea_base(r, base)
+        for nombre, metrica, antes, ahora in regresiones:
+            print(f"❌ Regresión {nombre}.{metrica}: {antes} -> {ahora} (tolerancia {BENCH_TOLERANCIA:.0%})")
+        print("✅ OK" if not regresiones else "❌ Fuera de objetivo")
+        return 0 if not regresiones else 1
+
+    if args.medicion == "lote":
+        r = medir_lote(args.n or 10000, repeticiones=args.repeticiones or 3)
+        print(f"{r['facturas']} facturas / {r['lineas']} líneas: escalar {r['escalar_s']} s, "
+              f"lote {r['lote_s']} s -> {r['speedup']}x (objetivo >= {r['objetivo_x']}x); "
+              f"asientos distintos: {r['n_difieren']} {r['difieren']}")
+        ok = r["n_difieren"] == 0 and r["speedup"] >= r["objetivo_x"]
+        print("✅ OK" if ok else "❌ Fuera de objetivo")
+        return 0 if ok else 1
+
+    r = medir_importacion(args.repeticiones or 7)
+    print(f"import contabilizar_factura: mediana {r['mediana_ms']} ms (min {r['min_ms']} ms), "
+          f"objetivo <= {r['objetivo_ms']} ms; módulos pesados cargados: {r['modulos_pesados_cargados']}")
+    ok = r["mediana_ms"] <= r["objetivo_ms"] and r["modulos_pesados_cargados"] == "[]"
+    print("✅ OK" if ok else "❌ Fuera de objetivo")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+# cola_facturas.py
+"""
+Cola de facturas en segundo plano para la UI.
+
+    cola = ColaFacturas(workers=4)
+    t = cola.encolar(sha256_del_pdf, "factura.pdf", pdf_bytes)        # no bloquea
+    t.estado, t.progreso, t.facturas                                   # se consultan en cada rerun
+
+Cada PDF recorre extraer_facturas_azure -> clasificar_factura -> construir_asiento
+en un hilo del pool; un PDF con varias facturas produce varias FacturaLista.
+La cola es segura entre hilos y pensada para vivir una vez por proceso
+(st.cache_resource en app_ui.py): sobrevive a los reruns de Streamlit y un
+mismo archivo subido dos veces se procesa una sola vez.
+
+Los hilos del pool nunca esperan a Azure: inician el análisis sin esperarlo
+(plazo_s=0) y, si no está listo, el trabajo pasa a ESPERANDO_AZURE. Un único
+hilo de sondeo consulta cada COLA_SONDEO_AZURE_S segundos, también sin
+esperar, la operación de cada trabajo en espera (cf.analisis_terminado); la
+que terminó se recoge y avanza a la siguiente pasada del PDF si la hay.
+Cuando las facturas están listas, la clasificación vuelve al pool.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import contabilizar_factura as cf
+
+log = logging.getLogger("contabilizar")
+
+COLA_WORKERS = int(os.getenv("COLA_WORKERS", "4"))
+COLA_MAX_TRABAJOS = int(os.getenv("COLA_MAX_TRABAJOS", "500"))  # terminados que se recuerdan
+COLA_SONDEO_AZURE_S = float(os.getenv("COLA_SONDEO_AZURE_S", "1"))
+
+# Estados de un trabajo, en orden de avance
+EN_COLA = "en cola"
+EXTRAYENDO = "extrayendo"
+ESPERANDO_AZURE = "esperando azure"
+CLASIFICANDO = "clasificando"
+LISTO = "listo"
+ERROR = "error"
+
+
+@dataclass
+class FacturaLista:
+    paginas: str
+    campos: dict
+    clasificacion: tuple  # (cuenta, nombre, retention_category, tipo_transaccion)
+    fuente: str
+    asiento: list
+
+
+class Trabajo:
+    """Estado de un PDF en la cola (lo escribe el hilo del pool, lo lee la UI)."""
+
+    def __init__(self, sig: str, nombre: str):
+        self.sig = sig
+        self.nombre = nombre
+        self.estado = EN_COLA
+        self.progreso = 0.0
+        self.facturas = []
+        self.error = None
+        self.creado = time.time()
+        self.terminado_en = None
+
+    @property
+    def terminado(self) -> bool:
+        return self.estado in (LISTO, ERROR)
+
+
+class ColaFacturas:
+    def __init__(self, workers: int = COLA_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="cola-facturas")
+        self._lock = threading.Lock()
+        self._trabajos = OrderedDict()
+        self._esperando = {}  # sig -> (trabajo, pdf_bytes, clave de la operación de Azure en curso)
+        self._hay_esperando = threading.Event()
+        threading.Thread(target=self._sondear, name="cola-facturas-azure", daemon=True).start()
+
+    def trabajo(self, sig: str):
+        with self._lock:
+            return self._trabajos.get(sig)
+
+    def encolar(self, sig: str, nombre: str, pdf_bytes) -> Trabajo:
+        """
+        Encola el PDF si `sig` no está ya en la cola; devuelve su trabajo (nuevo o
+        existente). `pdf_bytes` puede ser bytes o un memoryview (se usa sin copiar).
+        """
+        with self._lock:
+            t = self._trabajos.get(sig)
+            if t is not None and t.estado != ERROR:
+                return t
+            t = self._trabajos[sig] = Trabajo(sig, nombre)  # nuevo, o reintento de uno fallido
+            self._podar()
+        self._pool.submit(self._ejecutar, t, pdf_bytes)
+        return t
+
+    def _podar(self):
+        terminados = [s for s, t in self._trabajos.items() if t.terminado]
+        for s in terminados[:max(0, len(terminados) - COLA_MAX_TRABAJOS)]:
+            del self._trabajos[s]
+
+    def _ejecutar(self, t: Trabajo, pdf_bytes):
+        t.estado, t.progreso = EXTRAYENDO, 0.1
+        try:
+            # en memoria, sin archivo temporal; inicia (o encuentra en caché) sin esperar a Azure
+            facturas = cf.extraer_facturas_azure(pdf_bytes, plazo_s=0)
+        except cf.AnalisisPendiente as e:
+            t.estado, t.progreso = ESPERANDO_AZURE, 0.2
+            with self._lock:
+                self._esperando[t.sig] = (t, pdf_bytes, e.clave)
+                self._hay_esperando.set()
+            return
+        except Exception as e:
+            self._fallar(t, e)
+            return
+        self._clasificar(t, facturas)
+
+    def _sondear(self):
+        """Único hilo que consulta los análisis en curso; ninguna consulta espera a Azure."""
+        while True:
+            self._hay_esperando.wait()
+            time.sleep(COLA_SONDEO_AZURE_S)
+            with self._lock:
+                esperando = list(self._esperando.values())
+                if not esperando:
+                    self._hay_esperando.clear()
+            for t, pdf_bytes, clave in esperando:
+                try:
+                    if not cf.analisis_terminado(clave):
+                        continue
+                    facturas = cf.extraer_facturas_azure(pdf_bytes, plazo_s=0)
+                except cf.AnalisisPendiente as e:  # siguiente pasada (OCR o rangos) ya iniciada
+                    with self._lock:
+                        self._esperando[t.sig] = (t, pdf_bytes, e.clave)
+                    continue
+                except Exception as e:
+                    facturas = None
+                    self._fallar(t, e)
+                with self._lock:
+                    self._esperando.pop(t.sig, None)
+                if facturas is not None:
+                    self._pool.submit(self._clasificar, t, facturas)
+
+    def _clasificar(self, t: Trabajo, facturas):
+        try:
+            t.estado, t.progreso = CLASIFICANDO, 0.4
+            for i, (paginas, campos) in enumerate(facturas, 1):
+                cuenta, nombre, retention_category, tipo_transaccion, fuente = cf.clasificar_factura(campos)
+                asiento = cf.construir_asiento(dict(campos), cuenta, nombre, retention_category, tipo_transaccion)
+                t.facturas.append(FacturaLista(paginas, campos,
+                                               (cuenta, nombre, retention_category, tipo_transaccion),
+                                               fuente, asiento))
+                t.progreso = 0.4 + 0.6 * i / len(facturas)
+            t.estado = LISTO
+        except Exception as e:
+            self._fallar(t, e)
+            return
+        t.progreso = 1.0
+        t.terminado_en = time.time()
+
+    def _fallar(self, t: Trabajo, e: Exception):
+        log.warning("cola: %s falló: %s: %s", t.nombre, type(e).__name__, e)
+        t.error = f"{type(e).__name__}: {e}"
+        t.estado = ERROR
+        t.progreso = 1.0
+        t.terminado_en = time.time()
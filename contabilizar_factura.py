@@ -1,164 +1,347 @@
 # contabilizar_factura.py
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from openai import OpenAI
-import os
+from __future__ import annotations
+
+import atexit
+import hashlib
+import io
 import json
-import pandas as pd
-import httpx  # Import httpx to create a custom client
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+
+from asientos import DiarioColumnar, centavos_serie
+from gobernador import gobernador
+from metricas import cronometrado, incrementar, span
+
+if TYPE_CHECKING:  # solo para las anotaciones: en ejecución se importan en el primer uso
+    import pandas as pd
+    from azure.ai.formrecognizer import DocumentAnalysisClient
+    from openai import OpenAI
+
+# Depuración por niveles (LOG_LEVEL en los scripts); métricas por etapa en metricas.py
+log = logging.getLogger("contabilizar")
 
 # ------------------ CONFIGURACIÓN ------------------
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-AZURE_KEY = os.environ["AZURE_KEY"]
-AZURE_ENDPOINT = os.environ["AZURE_ENDPOINT"]
-AZURE_MODEL_ID = os.environ["AZURE_MODEL_ID"]
+# Importar este módulo no lee credenciales ni importa los SDK de Azure/OpenAI
+# ni pandas: todo se resuelve en el primer uso. Así las reglas puras
+# (construir_asiento, calcular_ica_bomberil, CxP...) se pueden importar sin
+# credenciales y en pocos milisegundos (ver bench_contabilizar.py).
+_CREDENCIALES = ("OPENAI_API_KEY", "AZURE_KEY", "AZURE_ENDPOINT", "AZURE_MODEL_ID")
+
+def _config(nombre: str) -> str:
+    """Credencial obligatoria, leída del entorno en el momento de usarla."""
+    return os.environ[nombre]
+
+def __getattr__(nombre):
+    # Compatibilidad: cf.OPENAI_API_KEY, cf.client_openai, ... siguen funcionando
+    if nombre in _CREDENCIALES:
+        return _config(nombre)
+    if nombre == "client_openai":
+        return pool_clientes.openai()
+    if nombre == "http_client":
+        pool_clientes.openai()
+        return pool_clientes._http
+    if nombre == "ACCOUNTS_IVA":
+        return dict(obtener_reglas().iva)
+    if nombre == "RETENTION_MAPPING":
+        return {k: {"account": r.cuenta, "rate": r.tarifa} for k, r in obtener_reglas().retencion.items()}
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
 
 # =====================  IVA DESCONTABLE: helpers (minimal)  =====================
-from dataclasses import dataclass
-from typing import Optional
 
 @dataclass(frozen=True)
 class IVAAccount:
     numero: str
     nombre: str
 
-ACCOUNTS_IVA = {
-    ("compras",   0.19): IVAAccount("24080501", "IVA DESCONTABLE POR COMPRAS 19%"),
-    ("gastos",    0.19): IVAAccount("24080502", "IVA DESCONTABLE POR GASTOS 19%"),
-    ("servicios", 0.19): IVAAccount("24080503", "IVA DESCONTABLE POR SERVICIOS 19%"),
-    ("compras",   0.05): IVAAccount("24080505", "IVA DESCONTABLE POR COMPRAS 5%"),
-    ("gastos",    0.05): IVAAccount("24080506", "IVA DESCONTABLE POR GASTOS 5%"),
-    ("servicios", 0.05): IVAAccount("24080507", "IVA DESCONTABLE POR SERVICIOS 5%"),
-}
+# Las cuentas de IVA descontable por (tipo, tarifa) viven en reglas_tributarias.json
 
-import unicodedata, re
 
-def _norm_simple(s: str) -> str:
+# ======================  Vista de texto normalizado  ======================
+# Todos los detectores (flete, autorretenedor, RST, Ibagué...) trabajan sobre la
+# forma canónica del texto: sin tildes, espacios colapsados, minúsculas. Se
+# calcula una vez por texto distinto (lru_cache) y los patrones se compilan al
+# cargar el módulo.
+
+_RE_ESPACIOS = re.compile(r"\s+")
+
+@lru_cache(maxsize=8192)
+def _canon(s: str) -> str:
     s = (s or "")
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"\s+", " ", s).strip().upper()
-    return s
+    if not s.isascii():
+        s = unicodedata.normalize("NFKD", s)
+        s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return _RE_ESPACIOS.sub(" ", s).strip().lower()
+
+_CAMPO_DESCRIPCION = ("Descripcion", "Descripción")
+_CAMPO_REGIMEN = ("Regimen Tributario", "Régimen Tributario")
+
+class TextoFactura:
+    """
+    Textos de una factura normalizados una sola vez (por campo) y compartidos
+    por los detectores:
+
+        texto = TextoFactura(campos)
+        texto.es_flete(), texto.es_autorretenedor_renta(), texto.es_regimen_simple()
+    """
+    __slots__ = ("campos", "reglas", "_norm")
+
+    def __init__(self, campos: dict, reglas: "ReglasTributarias" = None):
+        self.campos = campos or {}
+        self.reglas = reglas or obtener_reglas()
+        self._norm = {}
+
+    def norm(self, *nombres) -> str:
+        """Forma canónica del primer campo no vacío entre `nombres`."""
+        t = self._norm.get(nombres)
+        if t is None:
+            crudo = next((v for v in map(self.campos.get, nombres) if v), "")
+            t = self._norm[nombres] = _canon(str(crudo))
+        return t
+
+    def es_flete(self) -> bool:
+        return _es_flete_c(self.norm(*_CAMPO_DESCRIPCION), self.norm("Proveedor"), self.reglas)
+
+    def es_autorretenedor_renta(self) -> bool:
+        return _es_autorretenedor_renta_c(self.norm(*_CAMPO_REGIMEN), self.reglas)
+
+    def es_autorretenedor_ica(self) -> bool:
+        return _es_autorretenedor_ica_c(self.norm(*_CAMPO_REGIMEN), self.reglas)
+
+    def es_regimen_simple(self) -> bool:
+        return _es_regimen_simple_c(self.norm(*_CAMPO_REGIMEN), self.reglas)
+
+    def proveedor_en_ibague(self, ciudad: str = None) -> bool:
+        c = self.norm("Ciudad") if ciudad is None else _canon(ciudad)
+        return _proveedor_en_ibague_c(c, self.reglas)
+
+# ==================  Reglas tributarias (tabla versionada)  ==================
+# Categorías de retención (cuenta, tarifa), cuentas de IVA descontable por
+# (tipo, tarifa) y familias de palabras clave de los detectores, cargadas una vez
+# desde reglas_tributarias.json (REGLAS_TRIBUTARIAS_PATH). Agregar una regla es
+# editar la tabla: las palabras de todas las familias se buscan en una sola
+# pasada (Aho-Corasick) sobre el texto canónico.
+
+@dataclass(frozen=True)
+class ReglaRetencion:
+    categoria: str
+    cuenta: str
+    tarifa: float
+
+class AutomataPalabras:
+    """
+    Aho-Corasick sobre texto canónico: buscar(texto) devuelve el conjunto de
+    familias con al menos una palabra contenida en el texto (subcadena, como `in`).
+    """
+    __slots__ = ("_goto", "_fallo", "_salida", "buscar")
+
+    def __init__(self, familias: dict):
+        goto, salida = [{}], [set()]
+        for familia, palabras in familias.items():
+            for palabra in palabras:
+                e = 0
+                for ch in palabra:
+                    sig = goto[e].get(ch)
+                    if sig is None:
+                        sig = goto[e][ch] = len(goto)
+                        goto.append({})
+                        salida.append(set())
+                    e = sig
+                salida[e].add(familia)
+        fallo = [0] * len(goto)
+        cola = deque(goto[0].values())
+        while cola:
+            e = cola.popleft()
+            for ch, sig in goto[e].items():
+                cola.append(sig)
+                f = fallo[e]
+                while f and ch not in goto[f]:
+                    f = fallo[f]
+                fallo[sig] = goto[f].get(ch, 0)
+                salida[sig] |= salida[fallo[sig]]
+        self._goto, self._fallo = goto, fallo
+        self._salida = [frozenset(x) for x in salida]
+        self.buscar = lru_cache(maxsize=8192)(self._buscar)
+
+    def _buscar(self, texto: str) -> frozenset:
+        goto, fallo, salida = self._goto, self._fallo, self._salida
+        e, hallado = 0, frozenset()
+        for ch in texto:
+            while e and ch not in goto[e]:
+                e = fallo[e]
+            e = goto[e].get(ch, 0)
+            if salida[e]:
+                hallado |= salida[e]
+        return hallado
+
+class ReglasTributarias:
+    """
+    Tabla de reglas compilada. `version` identifica la tabla (se registra en el
+    log al cargar); `familias(texto)` recibe texto canónico (_canon).
+    """
+
+    def __init__(self, path: str, firma: tuple, version: str, retencion: dict, iva: dict,
+                 palabras: dict, flete_categoria: str, flete_prefijos: tuple):
+        self.path = path
+        self.firma = firma
+        self.verificado = 0.0                 # time.monotonic() de la última revisión del archivo
+        self.version = version
+        self.retencion = retencion            # categoría -> ReglaRetencion
+        self.iva = iva                        # (tipo, tarifa) -> IVAAccount
+        self.tarifas_iva = tuple(sorted({r for _, r in iva}, reverse=True))
+        self.cuentas_iva_servicios = frozenset(a.numero for (t, _), a in iva.items() if t == "servicios")
+        self.flete_categoria = flete_categoria
+        self.flete_prefijos = flete_prefijos
+        self._categorias = {_norm_simple(k): k for k in retencion}
+        self._automata = AutomataPalabras(palabras)
+        self.familias = self._automata.buscar
+
+    def categoria(self, texto: str) -> str:
+        """Categoría oficial para 'Servicios 1 %', 'SERVICIOS 1%'...; '' si no existe."""
+        t = _norm_simple(texto)
+        return self._categorias.get(t) or self._categorias.get(t.replace(" %", "%"), "")
+
+    @classmethod
+    def cargar(cls, path: str) -> "ReglasTributarias":
+        firma = _firma_archivo(path)
+        with open(path, "r", encoding="utf-8") as f:
+            datos = json.load(f)
+        try:
+            retencion = {k: ReglaRetencion(k, str(v["cuenta"]), float(v["tarifa"]))
+                         for k, v in datos["retencion"].items()}
+            iva = {(str(r["tipo"]).lower(), float(r["tarifa"])): IVAAccount(str(r["cuenta"]), r["nombre"])
+                   for r in datos["iva"]}
+            palabras = {fam: [_canon(p) for p in lista if _canon(p)]
+                        for fam, lista in datos["palabras"].items()}
+            flete = datos.get("retencion_flete") or {}
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Reglas tributarias ({path}): tabla inválida: {e!r}") from e
+        categoria_flete = flete.get("categoria", "")
+        if categoria_flete and categoria_flete not in retencion:
+            raise ValueError(f"Reglas tributarias ({path}): retencion_flete.categoria "
+                             f"{categoria_flete!r} no está en 'retencion'")
+        reglas = cls(path, firma, str(datos.get("version", "")), retencion, iva, palabras,
+                     categoria_flete, tuple(flete.get("prefijos_cuenta", ())))
+        log.info("Reglas tributarias %s cargadas de %s", reglas.version, os.path.basename(path))
+        return reglas
+
+_reglas = {}
+_reglas_lock = threading.Lock()
+# El archivo se revisa (stat) como mucho cada REGLAS_RECARGA_S segundos: el
+# camino caliente no paga una llamada al sistema por cada detector.
+REGLAS_RECARGA_S = float(os.getenv("REGLAS_RECARGA_S", "2"))
+REGLAS_TRIBUTARIAS_PATH = os.getenv("REGLAS_TRIBUTARIAS_PATH", "reglas_tributarias.json")
+
+@lru_cache(maxsize=32)
+def _resolver_reglas(path: str) -> str:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return path if os.path.isabs(path) or os.path.exists(path) else os.path.join(base_dir, path)
+
+def obtener_reglas(path: Optional[str] = None) -> ReglasTributarias:
+    """Reglas compartidas; se recompilan solo si cambia el archivo (mtime/tamaño)."""
+    real = _resolver_reglas(path or REGLAS_TRIBUTARIAS_PATH)
+    reglas = _reglas.get(real)
+    ahora = time.monotonic()
+    if reglas is not None and ahora - reglas.verificado < REGLAS_RECARGA_S:
+        return reglas
+    firma = _firma_archivo(real)
+    if reglas is not None and reglas.firma == firma:
+        reglas.verificado = ahora
+        return reglas
+    with _reglas_lock:
+        reglas = _reglas.get(real)
+        if reglas is None or reglas.firma != firma:
+            reglas = ReglasTributarias.cargar(real)
+            _reglas[real] = reglas
+        reglas.verificado = ahora
+    return reglas
+
+def _norm_simple(s: str) -> str:
+    return _canon(s).upper()
 
 def normalize_retention_category(cat: str, descripcion: str = "", cuenta: str = "") -> str:
     """
     Coerce GPT outputs (e.g., 'Servicios 1 %', 'SERVICIOS FLETES 1%') to your exact keys.
     Falls back to 'SERVICIOS 1%' when the description looks like fletes/transporte.
     """
-    KEYS = {
-        "PERSONAS JURIDICAS 11%": "PERSONAS JURIDICAS 11%",
-        "PERSONAS NO DECLARANTES PN 10%": "PERSONAS NO DECLARANTES PN 10%",
-        "SERVICIOS 1%": "SERVICIOS 1%",
-        "SERVICIOS 4%": "SERVICIOS 4%",
-        "SERVICIOS 2%": "SERVICIOS 2%",
-        "SERVICIOS 3.5%": "SERVICIOS 3.5%",
-        "ARRENDAMIENTO BIENES INMUEBLES 3.5%": "ARRENDAMIENTO BIENES INMUEBLES 3.5%",
-        "ARRENDAMIENTO BIENES MUEBLES 4%": "ARRENDAMIENTO BIENES MUEBLES 4%",
-        "COMBUSTIBLE 0.1%": "COMBUSTIBLE 0.1%",
-        "COMPRAS 2.5%": "COMPRAS 2.5%",
-        "COMPRAS 1.5%": "COMPRAS 1.5%",
-    }
-
-    t = _norm_simple(cat)
-    if t in KEYS:
-        return KEYS[t]
-
-    # Fix spacing like 'SERVICIOS 1 %'
-    t2 = t.replace(" %", "%")
-    if t2 in KEYS:
-        return KEYS[t2]
+    reglas = obtener_reglas()
+    # Exact key, also fixing spacing like 'SERVICIOS 1 %'
+    categoria = reglas.categoria(cat)
+    if categoria:
+        return categoria
 
     # Heuristics for fletes/transporte
-    d = _norm_simple(descripcion)
-    if any(k in d for k in ("FLETE", "FLETES", "TRANSPORTE", "ACARREO")):
-        return "SERVICIOS 1%"
+    if "flete" in reglas.familias(_canon(descripcion)):
+        return reglas.flete_categoria
 
     # Heuristic on debit account family (e.g., 5235… -> transporte/fletes)
     c = str(cuenta or "")
-    if c.startswith(("5235", "5105")):
-        return "SERVICIOS 1%"
+    if reglas.flete_prefijos and c.startswith(reglas.flete_prefijos):
+        return reglas.flete_categoria
 
     return ""  # unknown
 
 
-import re
-import unicodedata
-
-def _norm_txt(s: str) -> str:
-    s = (s or "").lower()
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"\s+", " ", s)
-    return s
+_norm_txt = _canon
 
 
-import re
-import unicodedata
+_RE_RENTA_NO_ANTES = re.compile(r"\bno\b\s*(somos|soy|es)?\s*autor?retened(?:or|ores)\b")
+_RE_RENTA_NO_DESPUES = re.compile(r"\bautor?retened(?:or|ores)\b.{0,12}\bno\b")
 
 def es_autorretenedor_renta(texto: str) -> bool:
     """
     TRUE only if the supplier explicitly says AUTORRETENEDOR DE RENTA.
     Handles 'iva\\nNo', glued NO, accents, and avoids confusing ICA with renta.
     """
-    s = (texto or "")
-    # Normalize newlines/tabs first so 'iva\\nNo' -> 'iva No'
-    s = s.replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    # Remove accents, lowercase, collapse whitespace
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
-    s = re.sub(r"\s+", " ", s).strip()
+    return _es_autorretenedor_renta_c(_canon(texto))
 
+def _es_autorretenedor_renta_c(s: str, reglas: ReglasTributarias = None) -> bool:
+    # s ya canónico: 'iva\\nNo' -> 'iva no', sin tildes, minúsculas
+    familias = (reglas or obtener_reglas()).familias(s)
     # Explicit ICA => NOT renta
-    if "autorretenedor de ica" in s or "autoretenedor de ica" in s:
+    if "renta_ica" in familias:
         return False
 
     # Robust negations: "... no somos autorretenedores", "... autorretenedores ... no"
-    if re.search(r"\bno\b\s*(somos|soy|es)?\s*autor?retened(?:or|ores)\b", s):
+    if _RE_RENTA_NO_ANTES.search(s):
         return False
-    if re.search(r"\bautor?retened(?:or|ores)\b.{0,12}\bno\b", s):
+    if _RE_RENTA_NO_DESPUES.search(s):
         return False
 
     # Positive renta statements
-    if "autorretenedor de renta" in s or "autoretenedor de renta" in s:
-        return True
-    if "autorretencion a titulo de renta" in s or "autorretencion renta" in s:
-        return True
-
-    return False
-import os
-import re
-import unicodedata
-import pandas as pd
-from functools import lru_cache
+    return "renta" in familias
 
 # ======================  Helpers de normalización  ======================
 
-def _strip_accents_lower(s: str) -> str:
-    s = (s or "")
-    s = s.replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"\s+", " ", s).strip().lower()
-    return s
+_strip_accents_lower = _canon
 
 def _only_digits(s: str) -> str:
     return "".join(ch for ch in (s or "") if ch.isdigit())
 
-import re
-import unicodedata
-
 def _norm_basic(s: str) -> str:
-    s = (s or "")
-    s = s.replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    return re.sub(r"\s+", " ", s).strip().upper()
+    return _canon(s).upper()
 
 def es_flete(descripcion: str, proveedor: str = "") -> bool:
     """Detecta si la factura es de fletes/transporte por keywords conservadoras."""
-    t = _norm_basic(descripcion + " " + (proveedor or ""))
-    KW = ("FLETE", "FLETES", "TRANSPORTE", "ACARREO")
-    return any(k in t for k in KW)
+    return _es_flete_c(_canon(descripcion), _canon(proveedor))
+
+def _es_flete_c(descripcion: str, proveedor: str, reglas: ReglasTributarias = None) -> bool:
+    familias = (reglas or obtener_reglas()).familias
+    return "flete" in familias(descripcion) or "flete" in familias(proveedor)
+
+# Separadores de 'Origen-Destino', en el orden en que se sustituyen por ' → '
+_RE_SEPARADORES_OD = tuple(re.compile(p) for p in
+                           (r"\s*->\s*", r"\s*→\s*", r"\s*-\s*", r"\s+A\s+", r"\s*/\s*", r"\s*,\s*"))
 
 def extraer_origen(origen_destino: str) -> str:
     """
@@ -173,9 +356,8 @@ def extraer_origen(origen_destino: str) -> str:
     t_norm = _norm_basic(t)
 
     # Reemplaza separadores a un único símbolo '→'
-    seps = [r"\s*->\s*", r"\s*→\s*", r"\s*-\s*", r"\s+A\s+", r"\s*/\s*", r"\s*,\s*"]
-    for pat in seps:
-        t_norm = re.sub(pat, " → ", t_norm)
+    for pat in _RE_SEPARADORES_OD:
+        t_norm = pat.sub(" → ", t_norm)
 
     parts = [p for p in t_norm.split("→") if p and p.strip()]
     if not parts:
@@ -183,7 +365,7 @@ def extraer_origen(origen_destino: str) -> str:
     # ORIGEN = primer tramo
     return parts[0].strip()
 
-def calcular_ica_bomberil_consolidado(campos: dict, base_subtotal: float):
+def calcular_ica_bomberil_consolidado(campos: dict, base_subtotal: float, texto: TextoFactura = None):
     """
     Territorialidad ICA (criterio operativo):
       • Si ES FLETE/TRANSPORTE: usar SOLO el ORIGEN del campo 'Origen-Destino'.
@@ -191,14 +373,14 @@ def calcular_ica_bomberil_consolidado(campos: dict, base_subtotal: float):
       • Si NO es flete: usar la 'Ciudad' del proveedor como hasta ahora.
 
     Delega el cálculo real en tu función existente `calcular_ica_bomberil(campos_mod, base_subtotal)`.
+    `texto` reutiliza la vista normalizada de la factura si el llamador ya la tiene.
     """
     # Entradas base
-    descripcion = (campos.get("Descripcion") or campos.get("Descripción") or "").strip()
-    proveedor   = (campos.get("Proveedor") or "").strip()
+    texto = texto or TextoFactura(campos)
     od          = (campos.get("Origen-Destino") or campos.get("Origen - Destino") or "").strip()
     ciudad_prov = (campos.get("Ciudad") or "").strip()
 
-    if es_flete(descripcion, proveedor):
+    if texto.es_flete():
         # Transporte: la territorialidad se fija en el ORIGEN del viaje.
         origen = extraer_origen(od)
         if origen:
@@ -207,8 +389,8 @@ def calcular_ica_bomberil_consolidado(campos: dict, base_subtotal: float):
             return calcular_ica_bomberil(tmp, base_subtotal)
         else:
             # Sin ORIGEN, no se puede determinar territorialidad -> no reteICA Ibagué
-            print("Debug - ICA: flete sin ORIGEN; no se practica reteICA/bomberil (pendiente confirmar origen).")
-            return 0.0, 0.0
+            log.debug("ICA: flete sin ORIGEN; no se practica reteICA/bomberil (pendiente confirmar origen).")
+            return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, "Flete sin ORIGEN"
     else:
         # No es flete: mantenemos la ciudad del proveedor
         tmp = dict(campos)
@@ -220,58 +402,16 @@ def calcular_ica_bomberil_consolidado(campos: dict, base_subtotal: float):
 
 def proveedor_en_ibague(ciudad_texto: str) -> bool:
     """Devuelve True si el texto de ciudad contiene 'Ibagué/Ibague'."""
-    t = _strip_accents_lower(ciudad_texto)
-    return "ibague" in t or "ibague," in t or t.endswith(" ibague")
+    return _proveedor_en_ibague_c(_canon(ciudad_texto))
 
-# ===================  Detección autorretenedor de ICA  ===================
-
-import re, unicodedata
-
-def _norm_ica_txt(s: str) -> str:
-    s = (s or "")
-    s = s.replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-def es_autorretenedor_ica(texto: str) -> bool:
-    """
-    True si el proveedor declara ser autorretenedor/retendedor de ICA
-    o incluye una advertencia de 'no practicar reteICA'.
-    """
-    t = _norm_ica_txt(texto)
-
-    # Mensajes de 'no practicar retención' (bloquea reteICA)
-    if ("abstenerse de efectuar retencion de ica" in t or
-        "abstenerse de efectuar retencion ica" in t or
-        "no efectuar retencion de ica" in t or
-        "no practicar reteica" in t):
-        return True  # tratar como autorretenedor a efectos de no retener
-
-    # Declaraciones explícitas de autorretención/retención en ICA
-    keys = [
-        "retendedor de ica",
-        "retenedor de ica",
-        "agente retenedor de ica",
-        "agente de retencion en ica",
-        "agente de retencion de ica",
-        "somos autorretenedores de ica",
-        "autorretenedor de ica",
-        "autoretenedor de ica",
-    ]
-    if any(k in t for k in keys):
-        return True
-
-    # Evita falsos positivos por negaciones directas
-    if re.search(r"\bno\b\s*(somos|soy|es)?\s*(autorretened|retened)", t):
-        return False
-
-    return False
+def _proveedor_en_ibague_c(t: str, reglas: ReglasTributarias = None) -> bool:
+    return "ibague" in (reglas or obtener_reglas()).familias(t)
 
 # =====================  Parseo de CIIU desde actividad  =====================
 
-import re, unicodedata
+_RE_CIIU_ETIQUETA = re.compile(r'(?:\bCIIU\b|\bActividad\s*Econ(?:o?mica)?)\D{0,10}(\d{4})(?!\d)', re.I)
+_RE_CIIU_BLOQUE = re.compile(r'\b(\d{4})(?!\d)\b')
+_RE_NO_DIGITOS = re.compile(r'\D')
 
 def parse_ciiu(actividad_economica: str) -> str:
     """
@@ -285,94 +425,179 @@ def parse_ciiu(actividad_economica: str) -> str:
     s = "".join(ch for ch in s if not unicodedata.combining(ch))
 
     # Prefer a 4-digit right after 'CIIU' or 'Actividad Económica'
-    m = re.search(r'(?:\bCIIU\b|\bActividad\s*Econ(?:o?mica)?)\D{0,10}(\d{4})(?!\d)', s, flags=re.I)
+    m = _RE_CIIU_ETIQUETA.search(s)
     if m:
         return m.group(1)
 
     # Else take the first standalone 4-digit block (not followed by another digit)
-    m = re.search(r'\b(\d{4})(?!\d)\b', s)
+    m = _RE_CIIU_BLOQUE.search(s)
     if m:
         return m.group(1)
 
     # Fallback: first 4 of all digits if nothing else
-    digits = re.sub(r'\D','', s)
+    digits = _RE_NO_DIGITOS.sub('', s)
     return digits[:4] if len(digits) >= 4 else ""
 
-# ====================  Carga tarifas ICA Ibagué (CSV)  ====================
-
-@lru_cache(maxsize=1)
-def _load_tarifas_ica_ibague(csv_path: str = "tarifas_ica_ibague.csv") -> pd.DataFrame:
-    """
-    Carga el CSV y normaliza nombres de columnas.
-    Columnas aceptadas (flexible):
-      - ciiu
-      - reteica_tarifa | tarifa | tarifa_por_mil
-      - base_minima | base
-      - bomberil_tarifa | bomberil | tasa_bomberil
-    Las tarifas pueden venir en %, por mil o decimales.
-    """
-    df = pd.read_csv(csv_path, encoding="utf-8")
-    cols = {c.lower().strip(): c for c in df.columns}
-    def pick(*names):
-        for n in names:
-            if n in cols: 
-                return cols[n]
-        return None
+# ====================  Registro de tarifas ICA Ibagué  ====================
 
-    col_ciiu = pick("ciiu")
-    col_tarifa = pick("reteica_tarifa", "tarifa", "tarifa_por_mil")
-    col_base  = pick("base_minima", "base")
-    col_bomb  = pick("bomberil_tarifa", "bomberil", "tasa_bomberil")
+@dataclass(frozen=True)
+class TarifaICA:
+    ciiu: str
+    tarifa: float       # decimal (8.3 por mil -> 0.0083)
+    base_minima: float  # pesos
+    bomberil: float     # fracción del reteICA (20% -> 0.20)
+
+# Encabezados aceptados (comparados sin mayúsculas, tildes, espacios ni '_')
+_ICA_COLS_CIIU     = ("ciiu", "codigociiu", "codigo", "actividadeconomica", "actividad")
+_ICA_COLS_TARIFA   = ("tarifapormil", "tarifa", "reteicatarifa")
+_ICA_COLS_BASE     = ("baseminima", "base")
+_ICA_COLS_BOMBERIL = ("bomberiltarifa", "bomberil", "tasabomberil")
+_ICA_TARIFA_MAX    = 0.02  # ninguna tarifa ICA supera 20 por mil: por encima hay un error de unidades
+
+_RE_CIIU4 = re.compile(r"\d{4}")
+_RE_NO_NUM = re.compile(r"[^\d,.\-]")
+
+def _col_key(s) -> str:
+    return re.sub(r"[\s_]+", "", _canon(str(s)))
+
+def _a_pesos(x) -> float:
+    """'1.271.000' / '1,271,000' / '1271000.50' -> float (formato colombiano o anglosajón)."""
+    s = _RE_NO_NUM.sub("", str(x or ""))
+    if not s:
+        return 0.0
+    if "," in s and "." in s:
+        dec = "," if s.rfind(",") > s.rfind(".") else "."
+        s = s.replace("." if dec == "," else ",", "").replace(dec, ".")
+    elif s.count(".") > 1 or s.count(",") > 1:
+        s = s.replace(".", "").replace(",", "")
+    elif "," in s or "." in s:
+        sep = "," if "," in s else "."
+        entero, _, frac = s.partition(sep)
+        s = entero + frac if len(frac) == 3 else f"{entero}.{frac}"  # 1.271 = mil doscientos...
+    try:
+        return float(s)
+    except ValueError:
+        return 0.0
 
-    if not col_ciiu or not col_tarifa:
-        raise ValueError("CSV de tarifas ICA: faltan columnas obligatorias (ciiu, tarifa).")
+class RegistroTarifasICA:
+    """
+    Tarifas ICA Ibagué por CIIU (4 dígitos), parseadas una vez desde el CSV o
+    XLSX. Las unidades se normalizan y validan al cargar:
+      - tarifa: '0.0083' decimal, '8.3' por mil, '0.83%' porcentaje (o columna 'por mil')
+      - bomberil: '20' % del ICA o '0.2' fracción
+    Las filas dudosas quedan en `advertencias`.
+    """
 
-    df["_ciiu"] = df[col_ciiu].astype(str).str.strip().str[:6]
-    # Normaliza tarifas a DECIMAL (0.XX)
-    def _to_rate(x):
+    def __init__(self, path: str, firma: tuple, tarifas: dict, advertencias: list):
+        self.path = path
+        self.firma = firma
+        self.tarifas = tarifas
+        self.advertencias = advertencias
+
+    def get(self, ciiu) -> Optional[TarifaICA]:
+        m = _RE_CIIU4.search(str(ciiu or ""))
+        return self.tarifas.get(m.group(0)) if m else None
+
+    @staticmethod
+    def _filas(path: str):
+        if os.path.splitext(path)[1].lower() in (".xlsx", ".xls"):
+            import pandas as pd
+            df = pd.read_excel(path, dtype=str).fillna("")
+            return [str(c) for c in df.columns], df.values.tolist()
+        import csv
+        with open(path, "rb") as f:
+            raw = f.read()
         try:
-            v = float(str(x).replace(",", "."))
-        except:
-            return 0.0
-        # Heurística: si v > 1, puede venir en 'por mil' o en '%'
-        # Intento 1: por mil
-        if v > 1.5:  # ej. 8.3 por mil => 0.0083 ; 11 => 0.011
-            # Si está claramente <= 100 y no es por mil alto, asúmelo %:
-            # - Si 8.3: puede ser por mil (0.0083) o 8.3% (0.083).
-            #   La práctica en ICA suele ser por mil. Priorizamos por mil.
-            return v / 1000.0
-        return v  # ya decimal (ej. 0.0083)
-    df["_tarifa"] = df[col_tarifa].apply(_to_rate)
-
-    df["_base_min"] = 0.0
-    if col_base:
-        def _to_money(x):
-            s = str(x).replace(",", "").replace(".", "")
+            texto = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            texto = raw.decode("latin-1")
+        try:
+            dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=",;\t|")
+        except csv.Error:
+            dialecto = csv.excel
+        filas = list(csv.reader(texto.splitlines(), dialecto))
+        return (filas[0], filas[1:]) if filas else ([], [])
+
+    @classmethod
+    def cargar(cls, path: str) -> "RegistroTarifasICA":
+        firma = _firma_archivo(path)
+        header, filas = cls._filas(path)
+        colmap = {_col_key(c): i for i, c in enumerate(header)}
+        pick = lambda keys: next((colmap[k] for k in keys if k in colmap), None)
+        i_ciiu, i_tar = pick(_ICA_COLS_CIIU), pick(_ICA_COLS_TARIFA)
+        i_base, i_bomb = pick(_ICA_COLS_BASE), pick(_ICA_COLS_BOMBERIL)
+        if i_ciiu is None or i_tar is None:
+            raise ValueError(f"Tarifas ICA: faltan columnas obligatorias (CIIU, tarifa). Columnas: {header}")
+        por_mil = "pormil" in _col_key(header[i_tar])
+
+        tarifas, advertencias = {}, []
+        celda = lambda fila, i: str(fila[i]).strip() if i is not None and i < len(fila) else ""
+        for n, fila in enumerate(filas, 2):
+            cod = celda(fila, i_ciiu)
+            if cod.isdigit() and len(cod) < 4:
+                cod = cod.zfill(4)  # Excel/CSV pierde el cero inicial: 161 -> 0161
+            m = _RE_CIIU4.search(cod)
+            if not m or m.group(0) in tarifas:
+                continue  # sin CIIU o repetido: gana la primera fila
+            raw = celda(fila, i_tar).replace(" ", "").replace(",", ".")
             try:
-                return float(re.sub(r"[^0-9.]", "", str(x)).replace(",", ""))  # flexible
-            except:
-                return 0.0
-        df["_base_min"] = df[col_base].apply(_to_money)
-
-    df["_bomberil"] = 0.0
-    if col_bomb:
-        def _to_bomb(x):
+                if raw.endswith("%"):
+                    tarifa = float(raw[:-1]) / 100.0
+                else:
+                    v = float(raw)
+                    tarifa = v / 1000.0 if (por_mil or v > 1.0) else v
+            except ValueError:
+                advertencias.append(f"fila {n}: tarifa ilegible {raw!r}")
+                continue
+            if not 0.0 <= tarifa <= _ICA_TARIFA_MAX:
+                advertencias.append(f"fila {n}: tarifa {tarifa} fuera de rango para CIIU {m.group(0)}")
+                continue
+            bomb_raw = celda(fila, i_bomb).replace(",", ".")
             try:
-                v = float(str(x).replace(",", "."))
-            except:
-                return 0.0
-            # bomberil casi siempre es % del ICA; si >1, interpretamos % (20 -> 0.20)
-            return v / 100.0 if v > 1 else v
-        df["_bomberil"] = df[col_bomb].apply(_to_bomb)
-
-    return df[["_ciiu", "_tarifa", "_base_min", "_bomberil"]]
+                bomberil = float(bomb_raw) if bomb_raw else 0.0
+            except ValueError:
+                advertencias.append(f"fila {n}: bomberil ilegible {bomb_raw!r}")
+                bomberil = 0.0
+            if bomberil > 1:
+                bomberil /= 100.0
+            tarifas[m.group(0)] = TarifaICA(m.group(0), round(tarifa, 10), _a_pesos(celda(fila, i_base)), bomberil)
+
+        for a in advertencias:
+            log.warning("tarifas ICA (%s): %s", os.path.basename(path), a)
+        return cls(path, firma, tarifas, advertencias)
+
+_registros_ica = {}
+_registros_ica_lock = threading.Lock()
+
+def _resolver_tarifas_ica(path: Optional[str] = None) -> str:
+    """Ruta dada (o relativa a este archivo); por defecto el CSV junto al .py y si no, el XLSX."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if path:
+        for p in (path, os.path.join(base_dir, path)):
+            if os.path.exists(p):
+                return p
+    default_csv = os.path.join(base_dir, "tarifas_ica_ibague.csv")
+    return default_csv if os.path.exists(default_csv) else os.path.join(base_dir, "tarifas_ica_ibague.xlsx")
+
+def obtener_registro_ica(path: Optional[str] = None) -> RegistroTarifasICA:
+    """Registro compartido; se recarga solo si cambia el archivo (mtime/tamaño)."""
+    real = _resolver_tarifas_ica(path)
+    firma = _firma_archivo(real)
+    reg = _registros_ica.get(real)
+    if reg is not None and reg.firma == firma:
+        return reg
+    with _registros_ica_lock:
+        reg = _registros_ica.get(real)
+        if reg is None or reg.firma != firma:
+            reg = RegistroTarifasICA.cargar(real)
+            _registros_ica[real] = reg
+    return reg
 
 def _lookup_tarifas_ibague(ciiu: str):
-    df = _load_tarifas_ica_ibague()
-    row = df[df["_ciiu"] == (ciiu or "")].head(1)
-    if row.empty:
+    t = obtener_registro_ica().get(ciiu)
+    if t is None:
         return 0.0, 0.0, 0.0
-    return float(row["_tarifa"].iloc[0]), float(row["_base_min"].iloc[0]), float(row["_bomberil"].iloc[0])
+    return t.tarifa, t.base_minima, t.bomberil
 
 # ===================  Cálculo ICA + Tasa Bomberil  ===================
 
@@ -380,36 +605,42 @@ def _lookup_tarifas_ibague(ciiu: str):
 ICA_ACCOUNT_DEFAULT       = os.getenv("PUC_RETEICA_IBAGUE", "2368050000")   # Pasivo: ReteICA Ibagué
 BOMBERIL_ACCOUNT_DEFAULT  = os.getenv("PUC_BOMBERIL_IBAGUE", "2368400000")  # Pasivo: Sobretasa bomberil Ibagué
 
-def calcular_ica_bomberil(campos: dict, base_subtotal: float):
+def _parametros_ica(ciudad: str, regimen: str, actividad: str):
     """
-    Retorna (reteICA_val, bomberil_val, cuenta_ica, cuenta_bomberil, motes) para logging.
-    Requiere: Ciudad, Actividad Económica (CIIU), Régimen Tributario.
+    Reglas de ICA Ibagué que no dependen de la base: (tarifa, base_min, tarifa_bomberil, nota).
+    tarifa = 0.0 cuando no se practica reteICA (la nota explica por qué).
     """
-    ciudad = campos.get("Ciudad", "")
-    actividad = campos.get("Actividad Economica", "") or campos.get("Actividad Económica", "")
-    regimen = campos.get("Regimen Tributario", "") or campos.get("Régimen Tributario", "")
-
+    reglas = obtener_reglas()
     # 1) Territorialidad práctica de tu cliente: retener ICA Ibagué solo si proveedor está en Ibagué
-    if not proveedor_en_ibague(ciudad):
-        return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, "Proveedor NO domiciliado en Ibagué"
+    if not _proveedor_en_ibague_c(_canon(ciudad), reglas):
+        return 0.0, 0.0, 0.0, "Proveedor NO domiciliado en Ibagué"
 
     # 2) Exclusiones: autorretenedor ICA o RST
-    if es_autorretenedor_ica(regimen):
-        return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, "Autorretenedor ICA"
-    try:
-        is_simple = es_regimen_simple(regimen)  # usa tu función existente
-    except NameError:
-        # Fallback simple si no existiera
-        t = _strip_accents_lower(regimen)
-        is_simple = ("regimen simple" in t) or ("régimen simple" in t) or ("simple" in t)
-    if is_simple:
-        return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, "Régimen Simple"
+    regimen = _canon(regimen)
+    if _es_autorretenedor_ica_c(regimen, reglas):
+        return 0.0, 0.0, 0.0, "Autorretenedor ICA"
+    if _es_regimen_simple_c(regimen, reglas):
+        return 0.0, 0.0, 0.0, "Régimen Simple"
 
     # 3) Tarifa por CIIU
     ciiu = parse_ciiu(actividad)
     tarifa_ica, base_min, tarifa_bomb = _lookup_tarifas_ibague(ciiu)
     if tarifa_ica <= 0.0:
-        return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, f"Tarifa ICA=0 para CIIU {ciiu or 'N/A'}"
+        return 0.0, 0.0, 0.0, f"Tarifa ICA=0 para CIIU {ciiu or 'N/A'}"
+    return tarifa_ica, base_min, tarifa_bomb, f"OK CIIU {ciiu}, tarifa {tarifa_ica}, bomberil {tarifa_bomb}"
+
+def calcular_ica_bomberil(campos: dict, base_subtotal: float):
+    """
+    Retorna (reteICA_val, bomberil_val, cuenta_ica, cuenta_bomberil, motes) para logging.
+    Requiere: Ciudad, Actividad Económica (CIIU), Régimen Tributario.
+    """
+    ciudad = campos.get("Ciudad", "")
+    actividad = campos.get("Actividad Economica", "") or campos.get("Actividad Económica", "")
+    regimen = campos.get("Regimen Tributario", "") or campos.get("Régimen Tributario", "")
+
+    tarifa_ica, base_min, tarifa_bomb, nota = _parametros_ica(ciudad, regimen, actividad)
+    if tarifa_ica <= 0.0:
+        return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, nota
     if base_subtotal <= (base_min or 0.0):
         return 0.0, 0.0, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, f"Base menor a base_mínima ({base_min})"
 
@@ -417,7 +648,7 @@ def calcular_ica_bomberil(campos: dict, base_subtotal: float):
     reteica_val = round(base_subtotal * tarifa_ica, 2)
     bomberil_val = round(reteica_val * (tarifa_bomb or 0.0), 2)
 
-    return reteica_val, bomberil_val, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, f"OK CIIU {ciiu}, tarifa {tarifa_ica}, bomberil {tarifa_bomb}"
+    return reteica_val, bomberil_val, ICA_ACCOUNT_DEFAULT, BOMBERIL_ACCOUNT_DEFAULT, nota
 
 
 
@@ -446,8 +677,8 @@ def detect_iva_rate(iva_valor: float, subtotal: float, tolerance: float = 0.01)
     if iva_val <= 0 or sub <= 0:
         return None
     def close(a, b): return abs(a - b) <= tolerance * max(b, 1e-9)
-    if close(iva_val, sub * 0.19): return 0.19
-    if close(iva_val, sub * 0.05): return 0.05
+    for rate in obtener_reglas().tarifas_iva:  # de mayor a menor
+        if close(iva_val, sub * rate): return rate
     return None
 
 def get_iva_account(transaction_type_from_gpt: str, cuenta_debito: str, iva_valor: float, subtotal: float) -> Optional[IVAAccount]:
@@ -461,7 +692,7 @@ def get_iva_account(transaction_type_from_gpt: str, cuenta_debito: str, iva_valo
         if _is_inventory_account(cuenta_debito): key = ("compras", rate)
         elif _is_pnl_account(cuenta_debito):     key = ("gastos", rate)
         else:                                    key = ("gastos", rate)
-    return ACCOUNTS_IVA.get(key)
+    return obtener_reglas().iva.get(key)
 
 def build_iva_asiento_line(
     transaction_type_from_gpt: str,
@@ -487,97 +718,198 @@ def build_iva_asiento_line(
 # ===================  /IVA DESCONTABLE: helpers  =====================
 
 # =====================  CxP selection from pairs (data-driven)  =====================
-import os
-import pandas as pd
-from functools import lru_cache
+
+CXP_NOMBRE_DEFAULT = "Cuentas por pagar - Proveedores"
+_CXP_LARGOS_PREFIJO = range(4, 11)  # fallbacks por prefijo 10→…→4
+_CXP_IDX_VERSION = 2  # 2: JSON (antes pickle)
 
 def _normalize_code(x) -> str:
     s = str(x).strip()
     return "".join(ch for ch in s if ch.isdigit())
 
-@lru_cache(maxsize=1)
-def _load_ap_pairs(csv_path: str):
-    # Robust load (encoding + flexible columns)
-    last_err = None
-    for enc in ("latin-1", "cp1252", "utf-8-sig", "utf-8"):
-        try:
-            df = pd.read_csv(csv_path, encoding=enc)
-            break
-        except Exception as e:
-            last_err = e
-            df = None
-    if df is None:
-        raise last_err
-
-    def _find(cols, *needles):
-        lc = {c.lower(): c for c in cols}
-        for k, v in lc.items():
-            if all(n in k for n in needles):
-                return v
-        return None
-
-    deb_col = _find(df.columns, "debito", "cuenta")
-    ap_col  = _find(df.columns, "ap", "cuenta")
-    ap_desc_col = _find(df.columns, "ap", "descr")
-
-    if not deb_col or not ap_col:
-        raise ValueError("CSV must include columns for 'Débito - Cuenta' and 'AP - Cuenta'.")
-
-    work = df[[deb_col, ap_col] + ([ap_desc_col] if ap_desc_col else [])].dropna(how="all").copy()
-    work["deb_code"] = work[deb_col].apply(_normalize_code)
-    work["ap_code"]  = work[ap_col].apply(_normalize_code)
-    work["ap_desc"]  = (work[ap_desc_col] if ap_desc_col else "").astype(str).str.strip()
-    work = work[(work["deb_code"] != "") & (work["ap_code"] != "")]
-    work["ap_desc_len"] = work["ap_desc"].str.len()
+class IndiceCxP:
+    """
+    Trie de dígitos de las cuentas débito del archivo de pares, compilado en una
+    pasada. Cada nodo es [hijos, ap_por_prefijo, ap_exacto]:
+      - ap_exacto: AP más frecuente para esa cuenta débito completa
+      - ap_por_prefijo (profundidad 4..10): AP más frecuente entre todas las
+        cuentas débito que comparten ese prefijo
+    Desempates como antes: más frecuente, luego descripción AP más larga,
+    luego menor (código, descripción). Búsqueda O(largo de la cuenta).
+    """
 
-    # Exact mapping: choose most frequent; tiebreak by longer description
-    freq = (
-        work.groupby(["deb_code", "ap_code", "ap_desc"])
-            .size().reset_index(name="n")
-    )
-    freq = freq.merge(
-        work[["ap_code", "ap_desc", "ap_desc_len"]].drop_duplicates(),
-        on=["ap_code", "ap_desc"], how="left"
-    )
+    def __init__(self, raiz: list, ap_nombres: dict):
+        self.raiz = raiz
+        self.ap_nombres = ap_nombres
 
-    exact_map = {}
-    for deb, grp in freq.groupby("deb_code"):
-        grp = grp.sort_values(["n", "ap_desc_len"], ascending=[False, False])
-        exact_map[deb] = grp.iloc[0]["ap_code"]
-
-    # Canonical AP name (by frequency then length)
-    ap_name_rank = (
-        work.groupby(["ap_code", "ap_desc"])
-            .size().reset_index(name="n")
-            .merge(work[["ap_code","ap_desc","ap_desc_len"]].drop_duplicates(),
-                   on=["ap_code","ap_desc"], how="left")
-            .sort_values(["ap_code","n","ap_desc_len"], ascending=[True, False, False])
-            .drop_duplicates(subset=["ap_code"], keep="first")
-    )
-    ap_name_map = dict(zip(ap_name_rank["ap_code"], ap_name_rank["ap_desc"]))
-
-    # Prefix maps for fallbacks 10→…→4
-    prefix_maps = {}
-    for plen in (10, 9, 8, 7, 6, 5, 4):
-        tmp = work.copy()
-        tmp["deb_prefix"] = tmp["deb_code"].str[:plen]
-        pfreq = (
-            tmp.groupby(["deb_prefix", "ap_code", "ap_desc"])
-               .size().reset_index(name="n")
-        )
-        pfreq = pfreq.merge(
-            tmp[["ap_code","ap_desc","ap_desc_len"]].drop_duplicates(),
-            on=["ap_code","ap_desc"], how="left"
-        ).sort_values(["deb_prefix","n","ap_desc_len"], ascending=[True, False, False])
-
-        best_pref = {}
-        for pref, g in pfreq.groupby("deb_prefix"):
-            if not isinstance(pref, str) or pref == "":
+    @classmethod
+    def desde_csv(cls, csv_path: str) -> "IndiceCxP":
+        import csv
+        with open(csv_path, "rb") as f:
+            raw = f.read()
+        try:
+            texto = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            texto = raw.decode("latin-1")
+        filas = csv.reader(io.StringIO(texto, newline=""))  # respeta saltos de línea dentro de comillas
+        header = next(filas, [])
+
+        def _find(cols, *needles):
+            for i, c in enumerate(cols):
+                if all(n in c.lower() for n in needles):
+                    return i
+            return None
+
+        deb_col = _find(header, "debito", "cuenta")
+        ap_col = _find(header, "ap", "cuenta")
+        ap_desc_col = _find(header, "ap", "descr")
+        if deb_col is None or ap_col is None:
+            raise ValueError("CSV must include columns for 'Débito - Cuenta' and 'AP - Cuenta'.")
+
+        # Única pasada: conteos (clave, ap, desc) para cuenta exacta, prefijos y nombres AP
+        exactos, prefijos, nombres = {}, {}, {}
+        for fila in filas:
+            if len(fila) <= max(deb_col, ap_col):
+                continue
+            deb = _normalize_code(fila[deb_col])
+            ap = _normalize_code(fila[ap_col])
+            if not deb or not ap:
                 continue
-            best_pref[pref] = g.iloc[0]["ap_code"]
-        prefix_maps[plen] = best_pref
+            desc = fila[ap_desc_col].strip() if ap_desc_col is not None and ap_desc_col < len(fila) else ""
+            k = (deb, ap, desc)
+            exactos[k] = exactos.get(k, 0) + 1
+            for plen in _CXP_LARGOS_PREFIJO:
+                if plen > len(deb):
+                    break
+                k = (deb[:plen], ap, desc)
+                prefijos[k] = prefijos.get(k, 0) + 1
+            k = (ap, desc)
+            nombres[k] = nombres.get(k, 0) + 1
+
+        def _mejor(conteos: dict) -> dict:
+            mejor = {}
+            for (clave, ap, desc), n in conteos.items():
+                rango = (-n, -len(desc), ap, desc)
+                if clave not in mejor or rango < mejor[clave][0]:
+                    mejor[clave] = (rango, ap)
+            return {k: v[1] for k, v in mejor.items()}
+
+        raiz = [{}, None, None]
+
+        def _nodo(codigo: str) -> list:
+            n = raiz
+            for ch in codigo:
+                n = n[0].setdefault(ch, [{}, None, None])
+            return n
+
+        for deb, ap in _mejor(exactos).items():
+            _nodo(deb)[2] = ap
+        for pref, ap in _mejor(prefijos).items():
+            _nodo(pref)[1] = ap
+        # Nombre canónico del AP: descripción más frecuente, luego más larga
+        mejor_desc = {}
+        for (ap, desc), n in nombres.items():
+            rango = (-n, -len(desc), desc)
+            if ap not in mejor_desc or rango < mejor_desc[ap][0]:
+                mejor_desc[ap] = (rango, desc)
+        ap_nombres = {ap: v[1] for ap, v in mejor_desc.items()}
+        return cls(raiz, ap_nombres)
+
+    def buscar(self, cuenta_debito: str):
+        """(ap, modo) con modo 'exact', 'prefix-N' o None si no hay coincidencia."""
+        deb = _normalize_code(cuenta_debito)
+        nodo, ap, modo = self.raiz, None, None
+        for i, ch in enumerate(deb, 1):
+            nodo = nodo[0].get(ch)
+            if nodo is None:
+                return ap, modo
+            if nodo[1] is not None:
+                ap, modo = nodo[1], f"prefix-{i}"
+        if nodo[2] is not None:
+            return nodo[2], "exact"
+        return ap, modo
+
+# ---- Sidecar JSON: el índice compilado se reutiliza hasta que cambia el CSV ----
+# Solo datos (listas, dicts, cadenas): el archivo vive junto al CSV y leerlo
+# nunca ejecuta código, a diferencia de pickle.
+_indices_cxp = {}
+_indices_cxp_lock = threading.Lock()
+
+def _firma_archivo(path: str) -> tuple:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _cargar_indice_cxp(csv_path: str) -> IndiceCxP:
+    firma = _firma_archivo(csv_path)
+    memo = _indices_cxp.get(csv_path)
+    if memo is not None and memo[0] == firma:
+        return memo[1]
+    with _indices_cxp_lock:
+        memo = _indices_cxp.get(csv_path)
+        if memo is not None and memo[0] == firma:
+            return memo[1]
+        sidecar = csv_path + ".cxpidx"
+        indice = None
+        try:
+            with open(sidecar, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == _CXP_IDX_VERSION and data.get("firma") == list(firma):
+                indice = IndiceCxP(data["raiz"], data["ap_nombres"])
+        except Exception:
+            indice = None
+        if indice is None:
+            indice = IndiceCxP.desde_csv(csv_path)
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(sidecar) or ".", suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"version": _CXP_IDX_VERSION, "firma": list(firma),
+                               "raiz": indice.raiz, "ap_nombres": indice.ap_nombres},
+                              f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp, sidecar)
+            except OSError:
+                pass  # carpeta de solo lectura: se usa el índice en memoria
+        _indices_cxp[csv_path] = (firma, indice)
+        return indice
+
+def _resolver_csv_pares(csv_path: str) -> Optional[str]:
+    # Resolve CSV path relative to this file to avoid working-dir issues
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidate_paths = [
+        csv_path,
+        os.path.join(here, csv_path),
+        os.path.join(here, os.path.basename(csv_path)),
+    ]
+    return next((p for p in candidate_paths if os.path.exists(p)), None)
 
-    return exact_map, prefix_maps, ap_name_map
+@cronometrado("cxp")
+def seleccionar_cuentas_cxp_lote(cuentas_debito,
+                                 csv_path: str = "Pares_Debito-AP_extra_dos.csv",
+                                 fallback: str = "220505") -> list:
+    """
+    Versión masiva de seleccionar_cuenta_cxp_por_pares: resuelve muchas cuentas
+    débito contra un único índice (cada cuenta distinta se busca una sola vez).
+    Devuelve [(ap_code, ap_name), ...] en el mismo orden.
+    """
+    cuentas_debito = list(cuentas_debito)
+    real_csv = _resolver_csv_pares(csv_path)
+    if real_csv is None:
+        log.warning("[CxP map] CSV not found: %s. Using fallback %s.", csv_path, fallback)
+        return [(fallback, CXP_NOMBRE_DEFAULT)] * len(cuentas_debito)
+    try:
+        indice = _cargar_indice_cxp(real_csv)
+    except Exception as e:
+        log.warning("[CxP map] Failed to load '%s': %s. Using fallback %s.", real_csv, e, fallback)
+        return [(fallback, CXP_NOMBRE_DEFAULT)] * len(cuentas_debito)
+
+    resueltas = {}
+    out = []
+    for c in cuentas_debito:
+        r = resueltas.get(c)
+        if r is None:
+            ap = indice.buscar(c)[0] or fallback
+            r = resueltas[c] = (ap, indice.ap_nombres.get(ap, CXP_NOMBRE_DEFAULT))
+        out.append(r)
+    return out
 
 def seleccionar_cuenta_cxp_por_pares(cuenta_debito: str,
                                      csv_path: str = "Pares_Debito-AP_extra_dos.csv",
@@ -587,64 +919,230 @@ def seleccionar_cuenta_cxp_por_pares(cuenta_debito: str,
       1) exact debit match,
       2) prefix fallback (10→9→…→4),
       3) fallback account.
-    Prints a small diagnostic about how it matched.
     """
-    # Resolve CSV path relative to this file to avoid working-dir issues
-    here = os.path.dirname(os.path.abspath(__file__))
-    candidate_paths = [
-        csv_path,
-        os.path.join(here, csv_path),
-        os.path.join(here, os.path.basename(csv_path)),
-    ]
-    real_csv = next((p for p in candidate_paths if os.path.exists(p)), None)
-    if real_csv is None:
-        print(f"[CxP map] CSV not found. Tried: {candidate_paths}. Using fallback {fallback}.")
-        return fallback, "Cuentas por pagar - Proveedores"
+    return seleccionar_cuentas_cxp_lote([cuenta_debito], csv_path, fallback)[0]
+# =================== /CxP selection from pairs  =====================
 
-    try:
-        exact_map, prefix_maps, ap_name_map = _load_ap_pairs(real_csv)
-    except Exception as e:
-        print(f"[CxP map] Failed to load '{real_csv}': {e}. Using fallback {fallback}.")
-        return fallback, "Cuentas por pagar - Proveedores"
-
-    deb = _normalize_code(cuenta_debito)
-    mode = "fallback"
-    ap = exact_map.get(deb)
-    if ap:
-        mode = "exact"
-    else:
-        for plen in (10, 9, 8, 7, 6, 5, 4):
-            if len(deb) < plen:
-                continue  # skip impossible prefix length
-            pref = deb[:plen]
-            ap = prefix_maps.get(plen, {}).get(pref)
-            if ap:
-                mode = f"prefix-{plen}"
-                break
 
-    if not ap:
-        ap = fallback
+# =====================  Pool de clientes HTTP (Azure / OpenAI)  =====================
+
+# Límites de conexión compartidos por todas las sesiones/hilos del proceso.
+# HTTP_MAX_KEEPALIVE y HTTP_KEEPALIVE_S solo aplican a OpenAI (httpx): el
+# transporte requests/urllib3 de Azure no tiene expiración por inactividad y
+# conserva hasta HTTP_MAX_CONEXIONES conexiones por host hasta que el servidor las cierra.
+HTTP_MAX_CONEXIONES    = int(os.getenv("HTTP_MAX_CONEXIONES", "20"))
+HTTP_MAX_KEEPALIVE     = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_S       = float(os.getenv("HTTP_KEEPALIVE_S", "60"))
+HTTP_CONNECT_TIMEOUT_S = float(os.getenv("HTTP_CONNECT_TIMEOUT_S", "10"))
+HTTP_READ_TIMEOUT_S    = float(os.getenv("HTTP_READ_TIMEOUT_S", "120"))
+# Hosts distintos a los que habla el cliente de Azure (el endpoint del recurso):
+# pool_connections de requests es el número de pools por host, no un límite de keep-alive
+_AZURE_HOSTS = 2
+# Reintentos del SDK de Azure para las consultas de estado de un análisis (GET del poller)
+AZURE_REINTENTOS_SONDEO = int(os.getenv("AZURE_REINTENTOS_SONDEO", "10"))
+
+def _politica_reintentos_azure():
+    """
+    RetryPolicy del cliente de Azure: el envío del análisis (POST) no se
+    reintenta en el SDK porque ya lo reintenta el gobernador; las consultas de
+    estado del poller sí, hasta AZURE_REINTENTOS_SONDEO veces.
+    """
+    from azure.core.pipeline.policies import RetryPolicy
 
-    name = ap_name_map.get(ap, "Cuentas por pagar - Proveedores")
-    print(f"[CxP map] debit {deb} -> AP {ap} ({mode}) from {os.path.basename(real_csv)}")
-    return ap, name
-# =================== /CxP selection from pairs  =====================
+    class _RetrySoloSondeo(RetryPolicy):
+        def increment(self, settings, response=None, error=None):
+            if response is not None and response.http_request.method.upper() == "POST":
+                return False
+            return super().increment(settings, response=response, error=error)
 
+    return _RetrySoloSondeo(retry_total=AZURE_REINTENTOS_SONDEO)
 
-# Debug prints to verify values and environment
-print("OPENAI_API_KEY:", OPENAI_API_KEY)
-print("AZURE_KEY:", AZURE_KEY)
-print("AZURE_ENDPOINT:", AZURE_ENDPOINT)
-print("AZURE_MODEL_ID:", AZURE_MODEL_ID)
-print("Environment vars related to proxies:", {k: v for k, v in os.environ.items() if 'PROXY' in k.upper()})
+class PoolClientes:
+    """
+    Un DocumentAnalysisClient y un cliente OpenAI por proceso, creados bajo
+    demanda y reutilizados por todos los hilos (ambos SDK son thread-safe), con
+    conexiones keep-alive y límites/timeouts configurables. cerrar() libera los
+    sockets; una llamada posterior vuelve a crear los clientes.
+    """
 
-# Initialize OpenAI client with a custom httpx client (no proxies by default)
-http_client = httpx.Client()  # Default client without proxies unless env vars are set
-client_openai = OpenAI(
-    api_key=OPENAI_API_KEY,
-    http_client=http_client
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._azure = None
+        self._azure_session = None
+        self._openai = None
+        self._http = None
+
+    def azure(self) -> DocumentAnalysisClient:
+        if self._azure is None:
+            with self._lock:
+                if self._azure is None:
+                    import requests
+                    from azure.ai.formrecognizer import DocumentAnalysisClient
+                    from azure.core.credentials import AzureKeyCredential
+                    from azure.core.pipeline.transport import RequestsTransport
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=_AZURE_HOSTS, pool_maxsize=HTTP_MAX_CONEXIONES
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    transport = RequestsTransport(
+                        session=session,
+                        session_owner=False,
+                        connection_timeout=HTTP_CONNECT_TIMEOUT_S,
+                        read_timeout=HTTP_READ_TIMEOUT_S,
+                    )
+                    self._azure_session = session
+                    self._azure = DocumentAnalysisClient(
+                        endpoint=_config("AZURE_ENDPOINT"),
+                        credential=AzureKeyCredential(_config("AZURE_KEY")),
+                        transport=transport,
+                        retry_policy=_politica_reintentos_azure(),
+                    )
+        return self._azure
+
+    def openai(self) -> OpenAI:
+        if self._openai is None:
+            with self._lock:
+                if self._openai is None:
+                    import httpx
+                    from openai import OpenAI
+                    # Proxies solo si vienen en variables de entorno (trust_env por defecto)
+                    self._http = httpx.Client(
+                        limits=httpx.Limits(
+                            max_connections=HTTP_MAX_CONEXIONES,
+                            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                            keepalive_expiry=HTTP_KEEPALIVE_S,
+                        ),
+                        timeout=httpx.Timeout(HTTP_READ_TIMEOUT_S, connect=HTTP_CONNECT_TIMEOUT_S),
+                    )
+                    # Sin reintentos del SDK: los hace el gobernador (ver _chat_gpt)
+                    self._openai = OpenAI(api_key=_config("OPENAI_API_KEY"), http_client=self._http,
+                                          max_retries=0)
+        return self._openai
+
+    def cerrar(self):
+        with self._lock:
+            for recurso in (self._azure, self._azure_session, self._http):
+                if recurso is not None:
+                    try:
+                        recurso.close()
+                    except Exception:
+                        pass
+            self._azure = self._azure_session = self._openai = self._http = None
+
+pool_clientes = PoolClientes()
+atexit.register(pool_clientes.cerrar)
+
+# Toda llamada saliente pasa por el gobernador de su servicio (gobernador.py):
+# límite de tasa, concurrencia adaptativa y reintentos con backoff. Para Azure
+# ver _poller_azure.
+def _chat_gpt(**kwargs):
+    return gobernador("openai").ejecutar(pool_clientes.openai().chat.completions.create, **kwargs)
+
+# =====================  Caché persistente (SQLite)  =====================
+
+CACHE_DB_PATH = os.getenv(
+    "CACHE_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache_contable.sqlite3"),
 )
 
+class _CacheSQLite:
+    """
+    Tabla clave -> valor (pickle) en SQLite, compartida entre procesos (WAL).
+    Expulsa por edad (max_age_s, según fecha de escritura) y por tamaño
+    (max_bytes, primero lo menos usado recientemente).
+    """
+
+    def __init__(self, tabla: str, path: str = CACHE_DB_PATH,
+                 max_bytes: int = 0, max_age_s: float = 0):
+        self.tabla = tabla
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {tabla} ("
+                " clave TEXT PRIMARY KEY, valor BLOB NOT NULL,"
+                " creado REAL NOT NULL, accedido REAL NOT NULL)"
+            )
+
+    def get(self, clave: str):
+        hit = self.get_con_fecha(clave)
+        return hit[0] if hit is not None else None
+
+    def get_con_fecha(self, clave: str):
+        """(valor, creado) o None: `creado` es la fecha de escritura, para que quien copie el valor conserve su edad."""
+        ahora = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                f"SELECT valor, creado FROM {self.tabla} WHERE clave = ?", (clave,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.max_age_s and ahora - row[1] > self.max_age_s:
+                self._db.execute(f"DELETE FROM {self.tabla} WHERE clave = ?", (clave,))
+                return None
+            self._db.execute(f"UPDATE {self.tabla} SET accedido = ? WHERE clave = ?", (ahora, clave))
+        return pickle.loads(row[0]), row[1]
+
+    def put(self, clave: str, valor):
+        blob = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        ahora = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.tabla} (clave, valor, creado, accedido) VALUES (?, ?, ?, ?)",
+                (clave, blob, ahora, ahora),
+            )
+            self._expulsar(ahora)
+
+    def actualizar(self, clave: str, fn):
+        """
+        Lee, transforma y escribe la entrada en una sola transacción (BEGIN IMMEDIATE):
+        ni otros hilos ni otros procesos pierden la actualización. fn(valor o None) -> nuevo valor.
+        """
+        ahora = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute(
+                f"SELECT valor, creado FROM {self.tabla} WHERE clave = ?", (clave,)
+            ).fetchone()
+            vigente = row is not None and not (self.max_age_s and ahora - row[1] > self.max_age_s)
+            nuevo = fn(pickle.loads(row[0]) if vigente else None)
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.tabla} (clave, valor, creado, accedido) VALUES (?, ?, ?, ?)",
+                (clave, pickle.dumps(nuevo, protocol=pickle.HIGHEST_PROTOCOL), ahora, ahora),
+            )
+            self._expulsar(ahora)
+        return nuevo
+
+    def invalidar(self, clave: Optional[str] = None) -> int:
+        """Borra una entrada (o todas si clave es None). Devuelve cuántas se borraron."""
+        with self._lock, self._db:
+            if clave is None:
+                return self._db.execute(f"DELETE FROM {self.tabla}").rowcount
+            return self._db.execute(f"DELETE FROM {self.tabla} WHERE clave = ?", (clave,)).rowcount
+
+    def _expulsar(self, ahora: float):
+        if self.max_age_s:
+            self._db.execute(f"DELETE FROM {self.tabla} WHERE creado < ?", (ahora - self.max_age_s,))
+        if self.max_bytes:
+            total = self._db.execute(f"SELECT COALESCE(SUM(LENGTH(valor)), 0) FROM {self.tabla}").fetchone()[0]
+            if total > self.max_bytes:
+                filas = self._db.execute(
+                    f"SELECT clave, LENGTH(valor) FROM {self.tabla} ORDER BY accedido ASC"
+                ).fetchall()
+                borrar = []
+                for clave, n in filas:
+                    if total <= self.max_bytes:
+                        break
+                    borrar.append((clave,))
+                    total -= n
+                self._db.executemany(f"DELETE FROM {self.tabla} WHERE clave = ?", borrar)
+
 # FUNCIONES AUXILIARES
 def to_float(valor):
     try:
@@ -653,140 +1151,244 @@ def to_float(valor):
         return 0.0
 
 def es_regimen_simple(texto):
-    texto = texto.lower()
-    return "régimen simple" in texto or "regimen simple" in texto or "simple" in texto
-
-def es_autorretenedor_ica(texto):
-    texto = texto.lower()
-    return any(p in texto for p in ["autorretenedor", "tarifa 0", "no aplicar", "regimen simple", "régimen simple"])
-
-import os, re
-import pandas as pd
+    return _es_regimen_simple_c(_canon(texto))
 
-import os, re
-import pandas as pd
+def _es_regimen_simple_c(texto, reglas=None):
+    return "regimen_simple" in (reglas or obtener_reglas()).familias(texto)
 
-import os, re
-import pandas as pd
+def es_autorretenedor_ica(texto):
+    return _es_autorretenedor_ica_c(_canon(texto))
 
-import os, re, pandas as pd
+def _es_autorretenedor_ica_c(texto, reglas=None):
+    return "exclusion_ica" in (reglas or obtener_reglas()).familias(texto)
 
 def obtener_tarifa_ica(codigo_ciiu, path="tarifas_ica_ibague.csv"):
     """
-    Devuelve la tarifa ICA en DECIMAL (p.ej., 8.3‰ -> 0.0083) para el CIIU dado.
-    Lee CSV o XLSX. Tolera encabezados: CIIU / codigo / actividad, y tarifa / tarifa_por_mil.
-    Incluye prints de diagnóstico para ver ruta, columnas y valor crudo leído.
+    Devuelve la tarifa ICA en DECIMAL (p.ej., 8.3‰ -> 0.0083) para el CIIU dado,
+    desde el registro de tarifas (CSV o XLSX, cargado una vez). 0.0 si no existe.
     """
-    import os, re
-    import pandas as pd
-
-    # --- Resolver archivo (CSV junto al .py; si no, XLSX; o 'path' si viene) ---
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    default_csv  = os.path.join(base_dir, "tarifas_ica_ibague.csv")
-    default_xlsx = os.path.join(base_dir, "tarifas_ica_ibague.xlsx")
-    chosen = path or (default_csv if os.path.exists(default_csv) else default_xlsx)
-    ext = os.path.splitext(chosen)[1].lower()
-
-    # --- Abrir robusto (CSV/XLSX + encoding fallback) ---
     try:
-        if ext in (".xlsx", ".xls"):
-            df = pd.read_excel(chosen, dtype=str)
-        else:
-            try:
-                df = pd.read_csv(chosen, dtype=str, sep=None, engine="python",
-                                 encoding="utf-8", keep_default_na=False)
-            except Exception:
-                df = pd.read_csv(chosen, dtype=str, sep=None, engine="python",
-                                 encoding="latin-1", keep_default_na=False)
+        t = obtener_registro_ica(path).get(codigo_ciiu)
     except Exception as e:
-        # Intento alterno: si era CSV y existe XLSX al lado, probar XLSX
-        if ext not in (".xlsx", ".xls") and os.path.exists(default_xlsx):
-            try:
-                df = pd.read_excel(default_xlsx, dtype=str)
-                chosen = default_xlsx
-                ext = ".xlsx"
-            except Exception as e2:
-                print("DEBUG TARIFAS: cannot open:", os.path.abspath(chosen), "error:", e2)
-                return 0.0
-        else:
-            print("DEBUG TARIFAS: cannot open:", os.path.abspath(chosen), "error:", e)
-            return 0.0
-
-    print("DEBUG TARIFAS: reading", os.path.abspath(chosen), "columns:", list(df.columns))
-
-    # --- Selección de columnas tolerante a nombres ---
-    def k(s): return re.sub(r'[\s_]+', '', str(s).lower().strip())
-    colmap = {k(c): c for c in df.columns}
-
-    col_ciiu = None
-    for key in ("ciiu", "codigociiu", "codigo", "actividadeconomica", "actividad"):
-        if key in colmap:
-            col_ciiu = colmap[key]; break
-
-    col_tar = None
-    for key in ("tarifa_por_mil", "tarifa", "reteica_tarifa"):
-        if key in colmap:
-            col_tar = colmap[key]; break
-
-    if not col_ciiu or not col_tar:
-        print("DEBUG TARIFAS: missing columns. Have:", list(df.columns), "| need CIIU + tarifa/tarifa_por_mil")
+        log.warning("tarifas ICA: cannot open %s: %s", path, e)
         return 0.0
+    return t.tarifa if t is not None else 0.0
+
+# =====================  Catálogo PUC (carga única por proceso)  =====================
+PUC_PATH = "PUC-CENTRO COSTOS SYNERGY.xlsx"
+
+# Familias de cuentas que se ofrecen a GPT para el débito principal
+# (inventarios, gastos, costos de venta y de producción)
+PUC_PREFIJOS_RELEVANTES = ("14", "51", "61", "71", "72", "73")
+
+# Preselección local de candidatas (TF-IDF de n-gramas de caracteres sobre DESCRIPCION).
+# PUC_SHORTLIST=0 vuelve a enviar el listado completo.
+PUC_SHORTLIST_ENABLED = os.getenv("PUC_SHORTLIST", "1") not in ("0", "false", "False", "no")
+PUC_SHORTLIST_K = int(os.getenv("PUC_SHORTLIST_K", "40"))
+# Cuentas que siempre se ofrecen (las que citan las reglas del prompt)
+PUC_CUENTAS_OBLIGATORIAS = tuple(
+    c.strip() for c in os.getenv("PUC_CUENTAS_OBLIGATORIAS", "14051001,5235500000,513550,733550").split(",") if c.strip()
+)
 
-    # --- CIIU a 4 dígitos (evita '25115' por dígito pegado) ---
-    m = re.search(r'\d{4}', str(codigo_ciiu) or "")
-    code = m.group(0) if m else ""
-    print("DEBUG TARIFAS: CIIU searched:", code)
-    if not code:
-        return 0.0
+def _ngramas(texto: str, n: int = 3) -> dict:
+    """Frecuencia de n-gramas de caracteres por palabra (con bordes), sobre texto normalizado."""
+    out = {}
+    for palabra in _norm_simple(texto).split():
+        w = f" {palabra} "
+        for i in range(max(len(w) - n + 1, 1)):
+            g = w[i:i + n]
+            out[g] = out.get(g, 0) + 1
+    return out
+
+class _IndiceNgramas:
+    """Índice invertido TF-IDF (coseno) sobre una lista de textos; se construye una vez."""
+
+    def __init__(self, textos):
+        import math
+        docs = [_ngramas(t) for t in textos]
+        df_count = {}
+        for d in docs:
+            for g in d:
+                df_count[g] = df_count.get(g, 0) + 1
+        n_docs = len(docs)
+        self.idf = {g: math.log((1 + n_docs) / (1 + c)) + 1.0 for g, c in df_count.items()}
+        self.postings = {}
+        for i, d in enumerate(docs):
+            pesos = {g: tf * self.idf[g] for g, tf in d.items()}
+            norma = math.sqrt(sum(w * w for w in pesos.values())) or 1.0
+            for g, w in pesos.items():
+                self.postings.setdefault(g, []).append((i, w / norma))
+
+    def buscar(self, consulta: str, k: int) -> list:
+        """Índices de los k textos más parecidos a la consulta (mayor puntaje primero)."""
+        import heapq
+        scores = {}
+        for g, tf in _ngramas(consulta).items():
+            idf = self.idf.get(g)
+            if idf is None:
+                continue
+            q = tf * idf
+            for i, w in self.postings[g]:
+                scores[i] = scores.get(i, 0.0) + q * w
+        return [i for i, _ in heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])]
 
-    df["_ciiu_4"] = df[col_ciiu].astype(str).str.extract(r'(\d{4})', expand=True)[0]
-    row = df[df["_ciiu_4"] == code].head(1)
-    print("DEBUG TARIFAS: matches:", len(row))
-    if row.empty:
-        return 0.0
+class CatalogoPUC:
+    """
+    Hoja 'PUC' del Excel de la empresa, parseada una sola vez.
+      - cuentas_validas: frozenset de códigos (solo dígitos)
+      - relevantes: DataFrame CUENTA/DESCRIPCION filtrado a PUC_PREFIJOS_RELEVANTES
+      - bloque_prompt: listado 'CUENTA - DESCRIPCION' listo para el prompt
+      - huella: SHA-256 abreviado del archivo (versión del catálogo)
+    """
 
-    # --- Leer la celda de tarifa y normalizar ---
-    raw_tar = str(row.iloc[0][col_tar]).strip()
-    raw_std = raw_tar.replace(" ", "").replace(",", ".")
-    print(f"DEBUG TARIFAS: col_tar='{col_tar}' raw='{raw_tar}' std='{raw_std}'")
+    def __init__(self, path: str, df: pd.DataFrame, firma: tuple, huella: str):
+        self.path = path
+        self.firma = firma
+        self.huella = huella
+        self.df = df
+        self.cuentas_validas = frozenset(df["CUENTA"])
+        self.relevantes = df[df["CUENTA"].str.startswith(PUC_PREFIJOS_RELEVANTES)].reset_index(drop=True)
+        self.bloque_prompt = "\n".join(
+            f"{c} - {d}" for c, d in zip(self.relevantes["CUENTA"], self.relevantes["DESCRIPCION"]) if d
+        )
+        self._descripciones = dict(zip(df["CUENTA"], df["DESCRIPCION"]))
+        self._indice = None
+        self._indice_lock = threading.Lock()
+
+    def descripcion(self, cuenta: str) -> str:
+        """Descripción de la cuenta o, si no existe, la de su ancestro más largo en el catálogo."""
+        for n in range(len(cuenta), 1, -1):
+            d = self._descripciones.get(cuenta[:n])
+            if d:
+                return d
+        return ""
 
-    try:
-        if raw_std.endswith("%"):
-            v = float(raw_std[:-1])
-            tarifa = v / 100.0
-        else:
-            v = float(raw_std)
-            # Si el encabezado dice 'por mil' -> dividir entre 1000. Si no, heurística:
-            if k(col_tar) == "tarifapormil" or "por_mil" in col_tar.lower() or "pormil" in col_tar.lower():
-                tarifa = v / 1000.0            # 1 -> 0.001 ; 8.3 -> 0.0083
-            else:
-                tarifa = v if v <= 1.0 else v / 1000.0  # 0.0083 -> 0.0083 ; 8.3 -> 0.0083
-    except Exception as e:
-        print("DEBUG TARIFAS: cannot parse tariff value:", raw_tar, "error:", e)
-        return 0.0
+    def candidatos(self, descripcion: str, proveedor: str = "", k: int = PUC_SHORTLIST_K) -> list:
+        """Top-k cuentas relevantes para la factura + PUC_CUENTAS_OBLIGATORIAS (sin duplicados)."""
+        if self._indice is None:
+            with self._indice_lock:
+                if self._indice is None:
+                    self._indice = _IndiceNgramas(self.relevantes["DESCRIPCION"].tolist())
+        cuentas = self.relevantes["CUENTA"]
+        elegidas = list(PUC_CUENTAS_OBLIGATORIAS)
+        for i in self._indice.buscar(f"{descripcion or ''} {proveedor or ''}", k):
+            c = cuentas.iat[i]
+            if c not in elegidas:
+                elegidas.append(c)
+        return elegidas
+
+    def bloque_candidatos(self, cuentas) -> str:
+        return "\n".join(f"{c} - {self.descripcion(c)}" for c in cuentas)
+
+    @classmethod
+    def cargar(cls, path: str = PUC_PATH) -> "CatalogoPUC":
+        import pandas as pd
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            raw = f.read()
+        df = pd.read_excel(io.BytesIO(raw), sheet_name="PUC", dtype=str)
+        df.columns = [str(c).strip() for c in df.columns]
+        if "CUENTA" not in df.columns:
+            raise KeyError(f"Column 'CUENTA' not found in {path}. Available columns: {df.columns.tolist()}")
+        df = pd.DataFrame({
+            "CUENTA": df["CUENTA"].fillna("").map(_normalize_code),
+            "DESCRIPCION": df["DESCRIPCION"].fillna("").str.strip() if "DESCRIPCION" in df.columns else "",
+        })
+        df = df[df["CUENTA"] != ""].reset_index(drop=True)
+        return cls(path, df, (st.st_mtime_ns, st.st_size), hashlib.sha256(raw).hexdigest()[:16])
+
+_catalogos_puc = {}
+_catalogos_puc_lock = threading.Lock()
+
+def obtener_catalogo_puc(path: str = PUC_PATH) -> CatalogoPUC:
+    """Catálogo compartido; solo se vuelve a leer el Excel si cambia su mtime/tamaño."""
+    st = os.stat(path)
+    firma = (st.st_mtime_ns, st.st_size)
+    cat = _catalogos_puc.get(path)
+    if cat is not None and cat.firma == firma:
+        return cat
+    with _catalogos_puc_lock:
+        cat = _catalogos_puc.get(path)
+        if cat is None or cat.firma != firma:
+            cat = CatalogoPUC.cargar(path)
+            _catalogos_puc[path] = cat
+    return cat
+
+# Cuentas que el propio sistema contabiliza desde sus tablas: CxP del archivo de
+# pares, retención e IVA de las reglas tributarias, ReteICA/bomberil de Ibagué,
+# fomento arrocero y las cuentas obligatorias del prompt. Todas deben existir en
+# la hoja PUC: la validación no las acepta por venir del sistema, así un error
+# de digitación en una tabla se ve como cuenta inválida.
+CUENTA_FOMENTO = "246005"
+CXP_PARES_CSV = "Pares_Debito-AP_extra_dos.csv"
+
+def cuentas_sistema_fuera_del_puc(path_catalogo: str = PUC_PATH) -> dict:
+    """{cuenta: origen} de las cuentas de las tablas del sistema que no están en el catálogo PUC."""
+    validas = obtener_catalogo_puc(path_catalogo).cuentas_validas
+    reglas = obtener_reglas()
+    origen = {ICA_ACCOUNT_DEFAULT: "PUC_RETEICA_IBAGUE", BOMBERIL_ACCOUNT_DEFAULT: "PUC_BOMBERIL_IBAGUE",
+              CUENTA_FOMENTO: "fomento arrocero"}
+    origen.update((c, "PUC_CUENTAS_OBLIGATORIAS") for c in PUC_CUENTAS_OBLIGATORIAS)
+    origen.update((r.cuenta, f"retención {nombre}") for nombre, r in reglas.retencion.items())
+    origen.update((a.numero, f"IVA {nombre}") for nombre, a in reglas.iva.items())
+    csv_pares = _resolver_csv_pares(CXP_PARES_CSV)
+    if csv_pares is not None:
+        # AP del archivo de pares (los códigos de menos de 4 dígitos son basura del CSV)
+        origen.update((ap, os.path.basename(csv_pares))
+                      for ap in _cargar_indice_cxp(csv_pares).ap_nombres if len(ap) >= 4)
+    fuera = {c: o for c, o in origen.items() if c not in validas}
+    if fuera:
+        log.warning("PUC: %d cuenta(s) de las tablas del sistema no existen en %s: %s",
+                    len(fuera), path_catalogo, ", ".join(f"{c} ({o})" for c, o in sorted(fuera.items())))
+    return fuera
+
+# Seguimiento en línea de la preselección: ¿la cuenta que eligió GPT estaba entre
+# las candidatas? Lo actualizan los hilos de la cola y de los micro-lotes.
+_stats_shortlist = {"consultas": 0, "elegida_en_candidatos": 0, "elegida_fuera": 0}
+_stats_shortlist_lock = threading.Lock()
+
+def estadisticas_shortlist() -> dict:
+    """
+    Conteos en línea y `tasa_en_candidatos`. Es solo un indicador del recall:
+    mide si GPT eligió entre las candidatas, no si la cuenta era la correcta
+    (para eso, evaluar_recall_shortlist con cuentas etiquetadas).
+    """
+    with _stats_shortlist_lock:
+        st = dict(_stats_shortlist)
+    st["tasa_en_candidatos"] = round(st["elegida_en_candidatos"] / st["consultas"], 4) if st["consultas"] else None
+    return st
 
-    print("DEBUG TARIFAS: resolved tarifa_ica_decimal =", tarifa)
-    return round(tarifa, 10)
-
-def clasificar_con_gpt(descripcion, proveedor, origen_destino):
-    # Load PUC to include in prompt
-    df_puc = pd.read_excel("PUC-CENTRO COSTOS SYNERGY.xlsx", sheet_name="PUC")
-    df_puc.columns = df_puc.columns.str.strip()  # Strip column names
-    # Strip values and normalize CUENTA by removing hyphens and spaces
-    df_puc['CUENTA'] = df_puc['CUENTA'].astype(str).str.replace('-', '').str.strip()
-    df_puc['DESCRIPCION'] = df_puc['DESCRIPCION'].astype(str).str.strip()
-    # Filter to relevant accounts for efficiency (inventarios, gastos, costos)
-    relevant_df = df_puc[df_puc["CUENTA"].str.startswith(('14', '51', '61', '71', '72', '73'), na=False)]
-    puc_list = '\n'.join([f"{row['CUENTA']} - {row['DESCRIPCION']}" for _, row in relevant_df.iterrows() if pd.notna(row['DESCRIPCION'])])
-
-    prompt = f"""
-Eres un contador profesional en Colombia que trabajas en un molino de arroz que también fabrica maquinas empaquetadoras de granos. Basado únicamente en esta descripción de factura:
-\"{descripcion}\"
-y el proveedor:
-\"{proveedor}\"
-y el origen-destino:
-\"{origen_destino}\"
-Clasifícala y selecciona la cuenta PUC apropiada para el débito principal (el subtotal de la compra) del siguiente listado de cuentas de la empresa, y determina la categoría de retención en la fuente sobre renta según las reglas DIAN.
+def evaluar_recall_shortlist(ejemplos, ks=(10, 20, 40, 80)) -> dict:
+    """
+    Recall offline de la preselección contra cuentas etiquetadas. `ejemplos`:
+    iterable de (descripcion, proveedor, cuenta_correcta), p.ej. asientos ya
+    contabilizados y revisados por contabilidad.
+    Devuelve {k: fracción de ejemplos cuya cuenta correcta quedó entre las candidatas}.
+    """
+    cat = obtener_catalogo_puc()
+    ejemplos = list(ejemplos)
+    out = {}
+    for k in ks:
+        aciertos = sum(1 for d, p, c in ejemplos if _normalize_code(c) in cat.candidatos(d, p, k))
+        out[k] = round(aciertos / len(ejemplos), 4) if ejemplos else None
+    return out
+
+def _huella_clasificador() -> str:
+    """Versión del catálogo + modo de listado: cambiar K o el modo invalida la caché."""
+    modo = f"k{PUC_SHORTLIST_K}" if PUC_SHORTLIST_ENABLED else "full"
+    return f"{obtener_catalogo_puc().huella}-{modo}"
+
+# Prompt en dos partes. El prefijo (rol, reglas y, sin preselección, el listado
+# PUC completo) es igual para todas las facturas: se renderiza una vez por versión
+# del catálogo y va primero, como mensaje de sistema, para que la API reutilice
+# su caché de prefijo. Lo propio de cada factura (y las cuentas candidatas de la
+# preselección) va después, en el mensaje del usuario.
+_PROMPT_ROL = ("Eres un contador profesional en Colombia que trabajas en un molino de arroz "
+               "que también fabrica maquinas empaquetadoras de granos. Clasificas facturas "
+               "basándote únicamente en su descripción, su proveedor y su origen-destino.")
+
+_PROMPT_REGLAS = """
+Para cada factura, clasifícala y selecciona la cuenta PUC apropiada para el débito principal (el subtotal de la compra) del listado de cuentas de la empresa, y determina la categoría de retención en la fuente sobre renta según las reglas DIAN.
 La descripción es lo más importante porque indica la naturaleza del producto o servicio.
 Usa el nombre del proveedor para refinar, por ejemplo, si el proveedor incluye "Transportadora" or "Transportes", es probable un servicio de fletes, usa una cuenta como 513550 or 613535 or 733550 for transporte, fletes y acarreos, dependiendo si es gasto admin, costo venta or producción.
 Reglas:
@@ -806,85 +1408,936 @@ Reglas:
   - 'COMPRAS 2.5%': Compras de todo tipo de productos que no pertenecen a las demas categorias.
   - 'COMPRAS 1.5%': Arroz Paddy.
 - If no match, use 'COMPRAS 2.5%' as default.
-Lista de cuentas PUC disponibles de la empresa:
-{puc_list}
+""".strip()
+
+@lru_cache(maxsize=4)
+def _prefijo_prompt(catalogo: CatalogoPUC, listado_completo: bool) -> str:
+    """Parte fija del prompt (mensaje de sistema) para una versión del catálogo."""
+    partes = [_PROMPT_ROL, _PROMPT_REGLAS]
+    if listado_completo:
+        partes.append("Lista de cuentas PUC disponibles de la empresa:\n" + catalogo.bloque_prompt)
+    return "\n".join(partes)
+
+def _mensajes_gpt(catalogo: CatalogoPUC, sufijo: str) -> list:
+    return [{"role": "system", "content": _prefijo_prompt(catalogo, not PUC_SHORTLIST_ENABLED)},
+            {"role": "user", "content": sufijo}]
+
+# Tokens por consulta: prompt, cuánto de él vino de la caché de prefijo de la API y respuesta
+_stats_tokens = {"consultas": 0, "prompt": 0, "prompt_cacheado": 0, "respuesta": 0}
+_stats_tokens_lock = threading.Lock()
+
+def _registrar_tokens(response, modo: str):
+    uso = getattr(response, "usage", None)
+    if uso is None:
+        return
+    prompt = getattr(uso, "prompt_tokens", 0) or 0
+    cacheado = getattr(getattr(uso, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    respuesta = getattr(uso, "completion_tokens", 0) or 0
+    with _stats_tokens_lock:
+        _stats_tokens["consultas"] += 1
+        _stats_tokens["prompt"] += prompt
+        _stats_tokens["prompt_cacheado"] += cacheado
+        _stats_tokens["respuesta"] += respuesta
+    ayuda = "Tokens de las consultas a GPT (prompt sin caché, prompt cacheado, respuesta)"
+    incrementar("contabilizar_gpt_tokens_total", prompt - cacheado, ayuda=ayuda, modo=modo, tipo="prompt")
+    incrementar("contabilizar_gpt_tokens_total", cacheado, ayuda=ayuda, modo=modo, tipo="prompt_cacheado")
+    incrementar("contabilizar_gpt_tokens_total", respuesta, ayuda=ayuda, modo=modo, tipo="respuesta")
+    log.debug("gpt %s: %d tokens de prompt (%d cacheados), %d de respuesta", modo, prompt, cacheado, respuesta)
+
+def estadisticas_tokens_gpt() -> dict:
+    """Totales de tokens y fracción del prompt servida desde la caché de prefijo."""
+    with _stats_tokens_lock:
+        st = dict(_stats_tokens)
+    st["fraccion_cacheada"] = round(st["prompt_cacheado"] / st["prompt"], 4) if st["prompt"] else None
+    return st
+
+def _interpretar_clasificacion(data: dict) -> tuple:
+    """(cuenta, nombre, retention_category, tipo_transaccion) de un objeto JSON de GPT; KeyError si falta algo."""
+    # Normalize returned cuenta by removing hyphens (if any)
+    cuenta = str(data["cuenta"]).replace('-', '').strip()
+    nombre = str(data["nombre"]).strip()
+    retention_category = str(data["retention_category"]).strip()
+    if not cuenta or not retention_category:
+        raise KeyError("cuenta/retention_category vacíos")
+    tipo_transaccion = (data.get("tipo_transaccion") or "").strip()
+    return cuenta, nombre, retention_category, tipo_transaccion
+
+def _registrar_shortlist(cuenta: str, candidatas):
+    if candidatas is None:
+        return
+    clave = "elegida_en_candidatos" if cuenta in candidatas else "elegida_fuera"
+    with _stats_shortlist_lock:
+        _stats_shortlist["consultas"] += 1
+        _stats_shortlist[clave] += 1
+    incrementar("contabilizar_shortlist_total", ayuda="Cuentas elegidas por GPT dentro/fuera de la preselección",
+                resultado=clave)
+
+@cronometrado("gpt")
+def _clasificar_con_gpt_api(descripcion, proveedor, origen_destino):
+    catalogo = obtener_catalogo_puc()
+    candidatas = None
+    listado = ""
+    if PUC_SHORTLIST_ENABLED:
+        candidatas = catalogo.candidatos(descripcion, proveedor)
+        listado = f"Cuentas PUC candidatas para esta factura:\n{catalogo.bloque_candidatos(candidatas)}\n\n"
+
+    sufijo = f"""{listado}Factura:
+descripción: "{descripcion}"
+proveedor: "{proveedor}"
+origen-destino: "{origen_destino}"
 
 Devuelve **solo JSON**: {{"cuenta": "codigo_cuenta", "nombre": "nombre_cuenta", "retention_category": "categoria_retencion"}}
 Por ejemplo: {{"cuenta": "14051001", "nombre": "MATERIA PRIMA MOLINO", "retention_category": "COMPRAS 1.5%"}}
-Your response must be a valid JSON object.
-""".strip()
+Your response must be a valid JSON object."""
 
-    response = client_openai.chat.completions.create(
+    response = _chat_gpt(
         model="gpt-4o",
-        messages=[{"role": "user", "content": prompt}],
+        messages=_mensajes_gpt(catalogo, sufijo),
         temperature=0,
         response_format={"type": "json_object"}
     )
+    _registrar_tokens(response, "individual")
     resp = response.choices[0].message.content.strip()
-    data = json.loads(resp)
-    # Normalize returned cuenta by removing hyphens (if any)
-    cuenta = data["cuenta"].replace('-', '').strip()
-    nombre = data["nombre"].strip()
-    retention_category = data["retention_category"]
-    tipo_transaccion = (data.get("tipo_transaccion") or "").strip()
-    return cuenta, nombre, retention_category, tipo_transaccion
+    resultado = _interpretar_clasificacion(json.loads(resp))
+    _registrar_shortlist(resultado[0], candidatas)
+    return resultado
+
+# =====================  Caché de clasificación (LRU + SQLite)  =====================
+
+# CLASIF_CACHE=0 desactiva la caché; TTL en días; tamaño del LRU en memoria
+CLASIF_CACHE_ENABLED  = os.getenv("CLASIF_CACHE", "1") not in ("0", "false", "False", "no")
+CLASIF_CACHE_TTL_DIAS = float(os.getenv("CLASIF_CACHE_TTL_DIAS", "30"))
+CLASIF_CACHE_LRU_MAX  = int(os.getenv("CLASIF_CACHE_LRU_MAX", "1024"))
+
+class _MemoClasificacion:
+    """
+    Dos niveles: LRU en proceso (OrderedDict) delante de la tabla SQLite
+    'clasificacion'. La clave incluye la huella del clasificador (versión del
+    PUC + modo de listado): otra configuración simplemente no encuentra las
+    entradas de la anterior, que salen por LRU y por edad, sin borrar las que
+    otro proceso con otra configuración sigue usando. El TTL cuenta desde que
+    GPT respondió: subir una entrada del disco al LRU conserva esa fecha.
+    """
+
+    def __init__(self, maxsize: int, ttl_s: float):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._disco = None
+        self.stats = {"hits_memoria": 0, "hits_disco": 0, "misses": 0}
+
+    def _persistente(self) -> _CacheSQLite:
+        if self._disco is None:
+            self._disco = _CacheSQLite("clasificacion", max_age_s=self.ttl_s)
+        return self._disco
+
+    @staticmethod
+    def clave(descripcion, proveedor, origen_destino, huella: str) -> str:
+        triple = "\x1f".join(_norm_simple(str(x or "")) for x in (descripcion, proveedor, origen_destino))
+        return f"{huella}|{hashlib.sha256(triple.encode('utf-8')).hexdigest()}"
+
+    def get(self, clave: str):
+        """Devuelve (resultado, fuente) con fuente 'cache_memoria'/'cache_disco', o (None, None)."""
+        ahora = time.time()
+        with self._lock:
+            hit = self._lru.get(clave)
+            if hit is not None and ahora - hit[0] <= self.ttl_s:
+                self._lru.move_to_end(clave)
+                self.stats["hits_memoria"] += 1
+                return hit[1], "cache_memoria"
+            if hit is not None:
+                del self._lru[clave]
+        hit = self._persistente().get_con_fecha(clave)
+        if hit is not None:
+            valor, creado = hit
+            self._guardar_lru(clave, valor, creado)
+            with self._lock:
+                self.stats["hits_disco"] += 1
+            return valor, "cache_disco"
+        with self._lock:
+            self.stats["misses"] += 1
+        return None, None
+
+    def put(self, clave: str, valor):
+        self._guardar_lru(clave, valor, time.time())
+        self._persistente().put(clave, valor)
+
+    def _guardar_lru(self, clave, valor, ts):
+        with self._lock:
+            self._lru[clave] = (ts, valor)
+            self._lru.move_to_end(clave)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def invalidar(self):
+        with self._lock:
+            self._lru.clear()
+        self._persistente().invalidar()
+
+_memo_clasificacion = _MemoClasificacion(CLASIF_CACHE_LRU_MAX, CLASIF_CACHE_TTL_DIAS * 86400)
+
+def estadisticas_cache_clasificacion() -> dict:
+    """Contadores de aciertos/fallos de la caché de clasificación."""
+    return dict(_memo_clasificacion.stats)
+
+def invalidar_cache_clasificacion():
+    _memo_clasificacion.invalidar()
+
+def _clasificar_memoizado(descripcion, proveedor, origen_destino, usar_cache: bool = True):
+    """Devuelve ((cuenta, nombre, retention_category, tipo_transaccion), fuente)."""
+    if not (usar_cache and CLASIF_CACHE_ENABLED):
+        return _clasificar_con_gpt_api(descripcion, proveedor, origen_destino), "gpt"
+    huella = _huella_clasificador()
+    clave = _MemoClasificacion.clave(descripcion, proveedor, origen_destino, huella)
+    hit, fuente = _memo_clasificacion.get(clave)
+    if hit is not None:
+        return tuple(hit), fuente
+    resultado = _clasificar_con_gpt_api(descripcion, proveedor, origen_destino)
+    _memo_clasificacion.put(clave, tuple(resultado))
+    return resultado, "gpt"
+
+def clasificar_con_gpt(descripcion, proveedor, origen_destino, usar_cache: bool = True):
+    """
+    Clasifica la factura (cuenta débito, nombre, categoría de retención, tipo).
+    Las tripletas descripción/proveedor/origen-destino ya vistas con la misma
+    versión del PUC se responden desde caché sin llamar a la API.
+    """
+    resultado, _fuente = _clasificar_memoizado(descripcion, proveedor, origen_destino, usar_cache)
+    return resultado
+
+# =====================  Memoria de clasificación por NIT  =====================
+# Lo que el usuario confirma en la UI (asiento validado y descargado) se recuerda
+# por NIT del proveedor. Con NIT_MEMORIA_MIN_CONFIRMACIONES confirmaciones
+# consecutivas iguales, de facturas distintas, la clasificación se toma de la
+# memoria sin llamar a GPT: descargar dos veces la misma factura cuenta una vez.
+NIT_MEMORIA_ENABLED = os.getenv("NIT_MEMORIA", "1") not in ("0", "false", "False", "no")
+NIT_MEMORIA_MIN_CONFIRMACIONES = int(os.getenv("NIT_MEMORIA_MIN_CONFIRMACIONES", "2"))
+_NIT_MEMORIA_FACTURAS = 50  # firmas de facturas confirmantes que se recuerdan por NIT
+
+@lru_cache(maxsize=1)
+def _memoria_nit() -> _CacheSQLite:
+    return _CacheSQLite("memoria_nit")
+
+def consultar_memoria_nit(nit: str, min_confirmaciones: int = None) -> Optional[dict]:
+    """Clasificación recordada para el NIT si tiene suficientes confirmaciones; si no, None."""
+    nit = _normalize_code(nit or "")
+    if not nit or not NIT_MEMORIA_ENABLED:
+        return None
+    reg = _memoria_nit().get(nit)
+    minimo = NIT_MEMORIA_MIN_CONFIRMACIONES if min_confirmaciones is None else min_confirmaciones
+    if reg is None or reg["confirmaciones"] < minimo:
+        return None
+    return reg
+
+def recordar_clasificacion_nit(nit: str, cuenta: str, nombre: str, retention_category: str,
+                               tipo_transaccion: str, factura: str = None) -> Optional[dict]:
+    """
+    Registra una clasificación confirmada por la factura `factura` (p.ej. su
+    firma SHA-256): repite con otra factura => suma confirmación, misma factura
+    => no cambia nada, clasificación distinta => reinicia. Sin `factura` cada
+    llamada cuenta como una factura nueva.
+    """
+    nit = _normalize_code(nit or "")
+    if not nit or not cuenta:
+        return None
+    nueva = {
+        "cuenta": _clean_cuenta(str(cuenta)),
+        "nombre": str(nombre or ""),
+        "retention_category": str(retention_category or ""),
+        "tipo_transaccion": str(tipo_transaccion or ""),
+    }
+
+    def _confirmar(previa):
+        iguales = previa is not None and all(previa.get(k) == v for k, v in nueva.items())
+        facturas = list(previa.get("facturas", ())) if iguales else []
+        if iguales and factura and factura in facturas:
+            return previa
+        nueva["confirmaciones"] = previa["confirmaciones"] + 1 if iguales else 1
+        nueva["facturas"] = (facturas + [factura])[-_NIT_MEMORIA_FACTURAS:] if factura else facturas
+        return nueva
+
+    return _memoria_nit().actualizar(nit, _confirmar)
+
+def aprender_de_asiento(campos: dict, asiento, clasificacion_sugerida=None, factura: str = None) -> Optional[dict]:
+    """
+    Deduce la clasificación confirmada a partir de un asiento ya validado por el
+    usuario y la guarda para el NIT del proveedor:
+      - cuenta/nombre: primera línea débito que no es IVA descontable
+      - categoría de retención: línea crédito cuya cuenta es de las reglas de retención
+      - tipo: 'servicios' si el IVA va a una cuenta de servicios
+    Lo que no se pueda deducir se toma de la clasificación sugerida. `factura`
+    identifica la factura confirmante (ver recordar_clasificacion_nit).
+    """
+    cuenta_s, nombre_s, categoria_s, tipo_s = (list(clasificacion_sugerida or []) + [""] * 4)[:4]
+    reglas = obtener_reglas()
+    cuentas_ret = {r.cuenta: k for k, r in reglas.retencion.items()}
+    cuentas_iva = {acc.numero for acc in reglas.iva.values()}
+    cuenta = nombre = categoria = tipo = None
+    for l in asiento:
+        c = _clean_cuenta(str(l.get("cuenta") or ""))
+        if not c:
+            continue
+        if c in cuentas_iva:
+            tipo = tipo or ("servicios" if c in reglas.cuentas_iva_servicios else "bienes")
+        elif cuenta is None and to_float(l.get("debito", 0)) > 0:
+            cuenta, nombre = c, l.get("nombre") or ""
+        elif c in cuentas_ret and to_float(l.get("credito", 0)) > 0:
+            categoria = categoria or cuentas_ret[c]
+    if cuenta is None:
+        return None
+    return recordar_clasificacion_nit(
+        campos.get("NIT Proveedor", ""),
+        cuenta,
+        nombre if nombre else nombre_s,
+        categoria or categoria_s,
+        tipo or tipo_s,
+        factura=factura,
+    )
+
+@cronometrado("clasificacion")
+def clasificar_factura(campos: dict, usar_cache: bool = True):
+    """
+    Clasificación completa de una factura con su fuente:
+    (cuenta, nombre, retention_category, tipo_transaccion, fuente), donde fuente es
+    'memoria_nit', 'cache_memoria', 'cache_disco' o 'gpt'.
+    """
+    mem = consultar_memoria_nit(campos.get("NIT Proveedor", "")) if usar_cache else None
+    if mem is not None:
+        incrementar("contabilizar_clasificacion_total", ayuda="Clasificaciones por fuente", fuente="memoria_nit")
+        return mem["cuenta"], mem["nombre"], mem["retention_category"], mem["tipo_transaccion"], "memoria_nit"
+    resultado, fuente = _clasificar_memoizado(
+        campos.get("Descripcion", ""),
+        campos.get("Proveedor", ""),
+        campos.get("Origen-Destino", ""),
+        usar_cache,
+    )
+    incrementar("contabilizar_clasificacion_total", ayuda="Clasificaciones por fuente", fuente=fuente)
+    return (*resultado, fuente)
+
+# =====================  Clasificación GPT en micro-lotes  =====================
+# Para lotes (procesar_lote --gpt-lote): varias facturas pendientes en una sola
+# consulta, con el prefijo del prompt una sola vez. El tamaño N se
+# adapta: +1 tras un lote limpio, a la mitad si la consulta falla o devuelve
+# ítems inválidos (entre 1 y GPT_LOTE_MAX).
+GPT_LOTE_INICIAL = int(os.getenv("GPT_LOTE_INICIAL", "4"))
+GPT_LOTE_MAX     = int(os.getenv("GPT_LOTE_MAX", "16"))
+
+class _TamanoLote:
+    """Tamaño de micro-lote con aumento aditivo y reducción multiplicativa, seguro entre hilos."""
+
+    def __init__(self, inicial: int, maximo: int):
+        self.maximo = max(1, maximo)
+        self.n = min(max(1, inicial), self.maximo)
+        self._lock = threading.Lock()
+
+    def exito(self):
+        with self._lock:
+            self.n = min(self.maximo, self.n + 1)
+
+    def fallo(self):
+        with self._lock:
+            self.n = max(1, self.n // 2)
+
+_tamano_lote_gpt = _TamanoLote(GPT_LOTE_INICIAL, GPT_LOTE_MAX)
+
+@cronometrado("gpt_lote")
+def _clasificar_lote_api(tripletas) -> list:
+    """
+    Una consulta para varias (descripcion, proveedor, origen_destino). Devuelve
+    una clasificación por tripleta, en orden, con None en las que GPT omitió o
+    devolvió incompletas. Una respuesta que no es JSON lanza la excepción.
+    """
+    catalogo = obtener_catalogo_puc()
+    candidatas = None
+    listado = ""
+    if PUC_SHORTLIST_ENABLED:
+        candidatas = [catalogo.candidatos(d, p) for d, p, _ in tripletas]
+        union = dict.fromkeys(c for cs in candidatas for c in cs)
+        listado = f"Cuentas PUC candidatas para estas facturas:\n{catalogo.bloque_candidatos(union)}\n\n"
+    facturas = "\n".join(
+        json.dumps({"id": i, "descripcion": str(d or ""), "proveedor": str(p or ""),
+                    "origen_destino": str(o or "")}, ensure_ascii=False)
+        for i, (d, p, o) in enumerate(tripletas)
+    )
+
+    sufijo = f"""{listado}Facturas (una por línea, JSON con su id), clasifica cada una por separado:
+{facturas}
+
+Devuelve **solo JSON** con un resultado por factura y su mismo id: {{"resultados": [{{"id": 0, "cuenta": "codigo_cuenta", "nombre": "nombre_cuenta", "retention_category": "categoria_retencion"}}]}}
+Your response must be a valid JSON object."""
 
+    response = _chat_gpt(
+        model="gpt-4o",
+        messages=_mensajes_gpt(catalogo, sufijo),
+        temperature=0,
+        response_format={"type": "json_object"}
+    )
+    _registrar_tokens(response, "lote")
+    data = json.loads(response.choices[0].message.content.strip())
+    por_id = {}
+    for item in data.get("resultados") or []:
+        try:
+            por_id[int(item["id"])] = _interpretar_clasificacion(item)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue  # ítem inválido: se reintenta solo
+    salida = [por_id.get(i) for i in range(len(tripletas))]
+    for i, r in enumerate(salida):
+        if r is not None and candidatas is not None:
+            _registrar_shortlist(r[0], candidatas[i])
+    return salida
+
+def clasificar_facturas_lote(lista_campos, usar_cache: bool = True, max_lote: int = None) -> list:
+    """
+    Como clasificar_factura para varias facturas, en el mismo orden. La memoria
+    por NIT y la caché se consultan primero; las tripletas restantes (sin
+    repetir) van a GPT en micro-lotes de tamaño adaptativo (o fijo, max_lote).
+    Una factura que su lote no resuelve se reintenta en una consulta individual;
+    si también falla, su posición trae la excepción en lugar de la tupla.
+    La fuente de lo que clasifica un lote es 'gpt_lote'.
+    """
+    lista_campos = list(lista_campos)
+    resultados = [None] * len(lista_campos)
+    cache = usar_cache and CLASIF_CACHE_ENABLED
+    huella = _huella_clasificador()
+    pendientes = OrderedDict()  # clave -> (tripleta, posiciones con esa tripleta)
+    for pos, campos in enumerate(lista_campos):
+        mem = consultar_memoria_nit(campos.get("NIT Proveedor", "")) if usar_cache else None
+        if mem is not None:
+            resultados[pos] = (mem["cuenta"], mem["nombre"], mem["retention_category"],
+                               mem["tipo_transaccion"], "memoria_nit")
+            continue
+        tripleta = (campos.get("Descripcion", ""), campos.get("Proveedor", ""), campos.get("Origen-Destino", ""))
+        clave = _MemoClasificacion.clave(*tripleta, huella)
+        if cache:
+            hit, fuente = _memo_clasificacion.get(clave)
+            if hit is not None:
+                resultados[pos] = (*hit, fuente)
+                continue
+        pendientes.setdefault(clave, (tripleta, []))[1].append(pos)
+
+    def _resolver(clave, posiciones, resultado, fuente):
+        if cache:
+            _memo_clasificacion.put(clave, tuple(resultado))
+        for pos in posiciones:
+            resultados[pos] = (*resultado, fuente)
+
+    cola = list(pendientes.items())
+    n = max_lote or _tamano_lote_gpt.n
+    while cola:
+        bloque, cola = cola[:max(1, n)], cola[max(1, n):]
+        if len(bloque) > 1:
+            try:
+                salidas = _clasificar_lote_api([t for _, (t, _) in bloque])
+            except Exception as e:
+                log.warning("gpt_lote: falló un lote de %d: %s: %s", len(bloque), type(e).__name__, e)
+                _tamano_lote_gpt.fallo()
+                n = len(bloque) // 2  # el mismo bloque, partido en dos
+                cola = bloque + cola
+                continue
+            (_tamano_lote_gpt.exito if all(salidas) else _tamano_lote_gpt.fallo)()
+            incrementar("contabilizar_gpt_lote_total", ayuda="Consultas GPT en micro-lote por resultado",
+                        resultado="completo" if all(salidas) else "parcial")
+        else:
+            salidas = [None]
+        for (clave, (tripleta, posiciones)), r in zip(bloque, salidas):
+            if r is not None:
+                _resolver(clave, posiciones, r, "gpt_lote")
+                continue
+            try:
+                _resolver(clave, posiciones, _clasificar_con_gpt_api(*tripleta), "gpt")
+            except Exception as e:
+                log.warning("gpt_lote: no se pudo clasificar %r: %s: %s", tripleta[0][:60], type(e).__name__, e)
+                for pos in posiciones:
+                    resultados[pos] = e
+        n = max_lote or _tamano_lote_gpt.n
+
+    for r in resultados:
+        if not isinstance(r, Exception):
+            incrementar("contabilizar_clasificacion_total", ayuda="Clasificaciones por fuente", fuente=r[-1])
+    return resultados
+
+@cronometrado("validacion_balance")
 def validar_balance(asiento):
     total_debitos = sum(to_float(l.get("debito", 0)) for l in asiento)
     total_creditos = sum(to_float(l.get("credito", 0)) for l in asiento)
     diferencia = round(total_debitos - total_creditos, 2)
     return diferencia == 0, total_debitos, total_creditos, diferencia
 
-def validar_cuentas_puc(asiento, path_catalogo="PUC-CENTRO COSTOS SYNERGY.xlsx"):
+@cronometrado("validacion_puc")
+def validar_cuentas_puc(asiento, path_catalogo=PUC_PATH):
     try:
-        df_puc = pd.read_excel(path_catalogo, sheet_name="PUC", dtype={"CUENTA": str})  # Load with explicit dtype
-        df_puc.columns = [col.strip() for col in df_puc.columns]  # Strip whitespace from column names
-        df_puc["CUENTA"] = df_puc["CUENTA"].str.strip()  # Strip whitespace from CUENTA values
-        # Extract only the numeric part of the account code (should already be numeric)
-        df_puc["CUENTA"] = df_puc["CUENTA"].str.extract(r'(\d+)', expand=False).fillna('')  # Ensure numeric only
-        print(f"Debug - PUC columns (after stripping): {df_puc.columns.tolist()}")  # Verify column names
-        print(f"Debug - Unique CUENTA values in PUC: {sorted(df_puc['CUENTA'].unique().tolist())}")  # Log unique accounts
-        if "CUENTA" not in df_puc.columns:
-            raise KeyError(f"Column 'CUENTA' not found in {path_catalogo}. Available columns: {df_puc.columns.tolist()}")
-        cuentas_validas = set(df_puc["CUENTA"])  # Use cleaned numeric codes
+        cuentas_validas = obtener_catalogo_puc(path_catalogo).cuentas_validas
         cuentas_asiento = set(str(l["cuenta"]) for l in asiento)
-        print(f"Debug - Accounts in asiento: {sorted(cuentas_asiento)}")  # Log accounts from asiento
         cuentas_invalidas = cuentas_asiento - cuentas_validas
         if cuentas_invalidas:
-            print(f"Debug - Invalid accounts: {sorted(cuentas_invalidas)}")
+            log.debug("Invalid accounts: %s", sorted(cuentas_invalidas))
         return cuentas_invalidas
     except Exception as e:
-        print(f"Error loading PUC catalog: {str(e)}")
+        log.error("Error loading PUC catalog: %s", e)
         return set()  # Return empty set to avoid crashing if file is invalid
 
-# FUNCION AUXILIAR PARA EXTRAER CAMPOS DE AZURE
-def extraer_campos_azure(ruta_pdf):
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=AZURE_ENDPOINT,
-        credential=AzureKeyCredential(AZURE_KEY)
+# =====================  Validación en lote (diario completo)  =====================
+# Antes de importar al ERP: cuadre de miles de asientos y cuentas contra el PUC
+# en una pasada sobre el DataFrame del diario (una fila por línea, p.ej.
+# diario.cargar_diario). Los importes se llevan a centavos enteros por línea,
+# como los guarda el ERP, y se suman sin error de coma flotante.
+
+@dataclass
+class ReporteValidacion:
+    asientos: int
+    lineas: int
+    descuadrados: pd.DataFrame        # <clave>, debito, credito, diferencia (en pesos)
+    cuentas_invalidas: pd.DataFrame   # cuenta, lineas, asientos, ejemplo (primer asiento con la cuenta)
+    faltantes: tuple = ()  # facturas procesadas (esperadas) sin asiento en el diario
+
+    @property
+    def ok(self) -> bool:
+        return self.descuadrados.empty and self.cuentas_invalidas.empty and not self.faltantes
+
+    def resumen(self) -> str:
+        if self.ok:
+            return f"✅ {self.asientos} asiento(s), {self.lineas} línea(s): todos cuadran y sus cuentas existen en el PUC"
+        partes = [f"{self.asientos} asiento(s), {self.lineas} línea(s)"]
+        if not self.descuadrados.empty:
+            partes.append(f"{len(self.descuadrados)} descuadrado(s) "
+                          f"(diferencia total {self.descuadrados['diferencia'].abs().sum():,.2f})")
+        if not self.cuentas_invalidas.empty:
+            partes.append(f"{len(self.cuentas_invalidas)} cuenta(s) fuera del PUC: "
+                          + ", ".join(self.cuentas_invalidas["cuenta"].head(10)))
+        if self.faltantes:
+            partes.append(f"{len(self.faltantes)} factura(s) procesada(s) sin asiento en el diario")
+        return "❌ " + "; ".join(partes)
+
+@cronometrado("validacion_lote")
+def validar_asientos_lote(df, clave: str = "factura", path_catalogo: str = PUC_PATH,
+                          tolerancia_centavos: int = 0, esperadas=None) -> ReporteValidacion:
+    """
+    Valida todos los asientos de `df` (columnas `clave`, cuenta, debito, credito,
+    o un asientos.DiarioColumnar): totales por asiento con un groupby en centavos
+    y cada cuenta distinta contra el conjunto cacheado del catálogo una sola vez.
+    Un asiento descuadra si |débitos - créditos| > tolerancia_centavos.
+    `esperadas` (p.ej. las facturas procesadas según el manifiesto del lote):
+    las que no tienen asiento en `df` quedan en `faltantes` y el reporte no es ok.
+    """
+    import numpy as np
+    import pandas as pd
+    if isinstance(df, DiarioColumnar):
+        # Ya en centavos y agrupado por asiento: sin parseo ni groupby
+        _, debitos, creditos = df.totales()
+        claves = pd.Index(df.claves, name=clave)
+        totales = pd.DataFrame({"debito": debitos, "credito": creditos}, index=claves)
+        cuentas = pd.Series(df.cuenta, dtype=object)
+        asiento_linea = claves.take(np.frombuffer(df.asiento, dtype=np.int64)).to_numpy()
+    else:
+        cuentas = df["cuenta"].astype(str).str.strip()
+        asiento_linea = df[clave].to_numpy()
+        totales = (pd.DataFrame({clave: asiento_linea, "debito": centavos_serie(df["debito"]).to_numpy(),
+                                 "credito": centavos_serie(df["credito"]).to_numpy()})
+                     .groupby(clave, sort=False).sum())
+    diferencia = totales["debito"] - totales["credito"]
+    mal = diferencia.abs() > tolerancia_centavos
+    descuadrados = (totales[mal].assign(diferencia=diferencia[mal]) / 100).reset_index()
+
+    validas = obtener_catalogo_puc(path_catalogo).cuentas_validas
+    fuera = [c for c in cuentas.unique() if c not in validas]
+    if fuera:
+        lineas = pd.DataFrame({"cuenta": cuentas, "asiento": asiento_linea})
+        lineas = lineas[lineas["cuenta"].isin(fuera)]
+        invalidas = (lineas.groupby("cuenta", sort=True)
+                           .agg(lineas=("asiento", "size"), asientos=("asiento", "nunique"),
+                                ejemplo=("asiento", "first"))
+                           .reset_index())
+    else:
+        invalidas = pd.DataFrame(columns=["cuenta", "lineas", "asientos", "ejemplo"])
+    presentes = set(totales.index)
+    faltantes = tuple(c for c in dict.fromkeys(esperadas or ()) if c not in presentes)
+    return ReporteValidacion(len(totales), len(cuentas), descuadrados, invalidas, faltantes)
+
+# ---- Caché de resultados de Azure Form Recognizer ----
+# AZURE_CACHE=0 desactiva la caché; tamaño en MB y edad en días configurables.
+AZURE_CACHE_ENABLED  = os.getenv("AZURE_CACHE", "1") not in ("0", "false", "False", "no")
+AZURE_CACHE_MAX_MB   = float(os.getenv("AZURE_CACHE_MAX_MB", "200"))
+AZURE_CACHE_MAX_DIAS = float(os.getenv("AZURE_CACHE_MAX_DIAS", "90"))
+
+@lru_cache(maxsize=1)
+def _cache_azure() -> _CacheSQLite:
+    return _CacheSQLite(
+        "azure_campos",
+        max_bytes=int(AZURE_CACHE_MAX_MB * 1024 * 1024),
+        max_age_s=AZURE_CACHE_MAX_DIAS * 86400,
     )
-    with open(ruta_pdf, "rb") as f:
-        poller = document_analysis_client.begin_analyze_document(
-            model_id=AZURE_MODEL_ID,
-            document=f
-        )
-    result = poller.result()
 
+# ---- Análisis en curso: plazo, sondeo y tokens de continuación ----
+# Cada análisis iniciado guarda su token de continuación (tabla azure_pendientes)
+# hasta que su resultado queda en la caché. Si no termina dentro del plazo
+# (AZURE_PLAZO_S) se lanza AnalisisPendiente y el hilo queda libre: la operación sigue en Azure y la próxima llamada con el mismo PDF la
+# retoma (también tras reiniciar el proceso) en vez de reenviarla. Azure conserva
+# los resultados 24 h. El SDK consulta el estado cada AZURE_POLL_S segundos.
+# Todo plazo de espera (plazo_s, esperar_s, AZURE_PLAZO_S) usa la misma
+# convención: 0 = no esperar (solo consultar el estado), inf = sin límite.
+AZURE_POLL_S             = float(os.getenv("AZURE_POLL_S", "1"))
+AZURE_PLAZO_S            = float(os.getenv("AZURE_PLAZO_S", "300"))
+AZURE_PENDIENTES_MAX_H   = float(os.getenv("AZURE_PENDIENTES_MAX_H", "23"))
+AZURE_POLLERS_VIVOS_MAX  = 256
+
+class AnalisisPendiente(Exception):
+    """El análisis de Azure no terminó dentro del plazo; sigue en curso y se puede retomar."""
+
+    def __init__(self, clave: str, plazo_s: float):
+        super().__init__(f"Azure no terminó en {plazo_s:g} s; el análisis sigue en curso ({clave[:12]}…)")
+        self.clave = clave
+        self.plazo_s = plazo_s
+
+@lru_cache(maxsize=1)
+def _pendientes_azure() -> _CacheSQLite:
+    return _CacheSQLite("azure_pendientes", max_age_s=AZURE_PENDIENTES_MAX_H * 3600)
+
+_pollers_vivos = OrderedDict()  # clave de operación -> LROPoller de este proceso
+_pollers_creando = {}           # clave de operación -> Event mientras un hilo lo retoma o lo inicia
+_pollers_lock = threading.Lock()
+
+def _poller_azure(clave_op: str, model_id: str, pdf_bytes=None, paginas: Optional[str] = None):
+    """
+    Poller del análisis `clave_op`: el vivo de este proceso, el retomado desde su
+    token guardado o, si no hay ninguno (y se da pdf_bytes), uno nuevo cuyo token
+    se guarda. La solicitud inicial va por el gobernador, sin reintentos del SDK
+    (ver _politica_reintentos_azure); las consultas de estado sí se reintentan.
+    Un solo hilo por clave retoma o inicia el análisis; los demás esperan su poller.
+    """
+    while True:
+        with _pollers_lock:
+            poller = _pollers_vivos.get(clave_op)
+            if poller is not None:
+                return poller
+            creando = _pollers_creando.get(clave_op)
+            if creando is None:
+                creando = _pollers_creando[clave_op] = threading.Event()
+                break
+        creando.wait()  # si el otro hilo falló, se vuelve a intentar aquí
+    try:
+        poller = _crear_poller_azure(clave_op, model_id, pdf_bytes, paginas)
+        with _pollers_lock:
+            _pollers_vivos[clave_op] = poller
+            while len(_pollers_vivos) > AZURE_POLLERS_VIVOS_MAX:
+                _pollers_vivos.popitem(last=False)  # sigue retomable desde su token
+        return poller
+    finally:
+        with _pollers_lock:
+            _pollers_creando.pop(clave_op, None)
+        creando.set()
+
+def _crear_poller_azure(clave_op: str, model_id: str, pdf_bytes, paginas: Optional[str]):
+    cliente = pool_clientes.azure()
+    pendiente = _pendientes_azure().get(clave_op)
+    if pendiente is not None:
+        try:
+            poller = cliente.begin_analyze_document(
+                model_id, None, continuation_token=pendiente["token"], polling_interval=AZURE_POLL_S)
+            incrementar("contabilizar_azure_retomados_total", ayuda="Análisis de Azure retomados desde su token")
+            return poller
+        except Exception as e:
+            log.info("azure: no se pudo retomar %s (%s: %s); se inicia de nuevo", clave_op[:12], type(e).__name__, e)
+            _pendientes_azure().invalidar(clave_op)
+    if pdf_bytes is None:
+        raise KeyError(f"No hay análisis de Azure iniciado para {clave_op[:12]}…")
+    opciones = {"pages": paginas} if paginas else {}
+    poller = gobernador("azure").ejecutar(
+        cliente.begin_analyze_document, model_id=model_id, document=pdf_bytes,
+        polling_interval=AZURE_POLL_S, **opciones)
+    _pendientes_azure().put(clave_op, {"token": poller.continuation_token(), "modelo": model_id,
+                                       "paginas": paginas, "iniciado": time.time()})
+    return poller
+
+def _esperar_poller(clave_op: str, poller, plazo_s: float):
+    """Resultado del análisis si termina dentro de plazo_s (0 = sin esperar, inf = sin límite); si no, None."""
+    poller.wait(timeout=None if plazo_s == float("inf") else plazo_s)
+    if not poller.done():
+        return None
+    try:
+        return poller.result()
+    except Exception:
+        _olvidar_analisis(clave_op)  # falló en Azure: la próxima llamada lo reenvía
+        raise
+
+def _olvidar_analisis(*claves_op):
+    """Descarta tokens y pollers de análisis cuyo resultado ya se guardó (o falló)."""
+    for clave_op in claves_op:
+        _pendientes_azure().invalidar(clave_op)
+        with _pollers_lock:
+            _pollers_vivos.pop(clave_op, None)
+
+def _clave_azure(pdf_bytes: bytes, model_id: str) -> str:
+    """Clave por contenido: SHA-256 del PDF + modelo (un modelo nuevo no reutiliza resultados viejos)."""
+    return f"{hashlib.sha256(pdf_bytes).hexdigest()}:{model_id}"
+
+def _leer_pdf(origen):
+    """
+    Contenido del PDF sin copias cuando se puede: ruta -> bytes leídos;
+    bytes/bytearray/memoryview -> memoryview; buffer con getbuffer()
+    (io.BytesIO, UploadedFile de Streamlit) -> su memoryview; otro archivo -> read().
+    """
+    if isinstance(origen, (str, os.PathLike)):
+        with open(origen, "rb") as f:
+            return f.read()
+    if isinstance(origen, (bytes, bytearray, memoryview)):
+        return memoryview(origen)
+    if hasattr(origen, "getbuffer"):
+        return origen.getbuffer()
+    return origen.read()
+
+def _nombre_pdf(origen) -> str:
+    if isinstance(origen, (str, os.PathLike)):
+        return os.path.basename(origen)
+    return getattr(origen, "name", None) or "<memoria>"
+
+def invalidar_cache_azure(ruta_pdf=None) -> int:
+    """Invalida el resultado cacheado de un PDF (ruta o bytes), o toda la caché de Azure si no se indica."""
+    if ruta_pdf is None:
+        _pendientes_azure().invalidar()
+        return _cache_azure().invalidar()
+    clave = _clave_azure(_leer_pdf(ruta_pdf), _config("AZURE_MODEL_ID"))
+    return _cache_azure().invalidar(clave) + _cache_azure().invalidar("facturas:" + clave)
+
+# FUNCION AUXILIAR PARA EXTRAER CAMPOS DE AZURE
+@cronometrado("azure_extraccion")
+def extraer_campos_azure(ruta_pdf, usar_cache: bool = True, plazo_s: float = None):
+    """
+    Extrae los campos del modelo personalizado de Azure. `ruta_pdf` puede ser
+    una ruta, bytes/memoryview o un buffer (p.ej. el UploadedFile de Streamlit:
+    se usa su getbuffer() sin pasar por disco). Si el mismo PDF (por
+    contenido) ya se analizó con el mismo AZURE_MODEL_ID, devuelve el resultado
+    cacheado sin llamar a Azure. usar_cache=False fuerza un nuevo análisis
+    (y refresca la entrada cacheada). Trata el PDF como una sola factura; para
+    escaneos con varias, ver extraer_facturas_azure. Si Azure no termina en
+    plazo_s (default AZURE_PLAZO_S; 0 = no esperar, inf = sin límite) lanza
+    AnalisisPendiente: llamar de nuevo con el mismo PDF retoma el análisis en
+    curso (con plazo_s=0 cada llamada solo inicia o consulta, sin bloquear).
+    """
+    pdf_bytes = _leer_pdf(ruta_pdf)
+    model_id = _config("AZURE_MODEL_ID")
+    clave = _clave_azure(pdf_bytes, model_id)
+    if usar_cache and AZURE_CACHE_ENABLED:
+        campos = _cache_azure().get(clave)
+        if campos is not None:
+            incrementar("contabilizar_cache_total", ayuda="Consultas a cachés por resultado", cache="azure", resultado="hit")
+            return campos
+        incrementar("contabilizar_cache_total", ayuda="Consultas a cachés por resultado", cache="azure", resultado="miss")
+
+    campos = _campos_resultado(_analizar_azure(bytes(pdf_bytes), model_id, plazo_s=plazo_s, clave=clave))
+    if AZURE_CACHE_ENABLED:
+        _cache_azure().put(clave, campos)
+    _olvidar_analisis(clave + "#")
+    return campos
+
+def _analizar_azure(pdf_bytes: bytes, model_id: str, paginas: Optional[str] = None,
+                    plazo_s: float = None, clave: str = None):
+    """
+    Análisis de Azure del PDF completo o solo de `paginas` ('3-5'), retomando el
+    que ya esté en curso. AnalisisPendiente si no termina en plazo_s. Quien
+    guarda el resultado llama después a _olvidar_analisis(f"{clave}#{paginas}").
+    """
+    plazo = AZURE_PLAZO_S if plazo_s is None else plazo_s
+    clave_op = f"{clave or _clave_azure(pdf_bytes, model_id)}#{paginas or ''}"
+    with span("azure_analisis"):
+        result = _esperar_poller(clave_op, _poller_azure(clave_op, model_id, pdf_bytes, paginas), plazo)
+    if result is None:
+        raise AnalisisPendiente(clave_op, plazo)
+    return result
+
+def iniciar_analisis_azure(ruta_pdf, model_id: str = None) -> str:
+    """
+    Inicia el análisis del PDF (como extraer_campos_azure) sin esperarlo y
+    devuelve su clave para recoger_analisis_azure. Si ya está en caché o en
+    curso no se reenvía. El token de continuación queda guardado: la clave sirve
+    también después de reiniciar el proceso.
+    """
+    pdf_bytes = _leer_pdf(ruta_pdf)
+    model_id = model_id or _config("AZURE_MODEL_ID")
+    clave = _clave_azure(pdf_bytes, model_id)
+    if not (AZURE_CACHE_ENABLED and _cache_azure().get(clave) is not None):
+        _poller_azure(clave + "#", model_id, bytes(pdf_bytes))
+    return clave
+
+def recoger_analisis_azure(clave: str, esperar_s: float = 0.0) -> Optional[dict]:
+    """
+    Campos del análisis iniciado con iniciar_analisis_azure si ya terminó
+    (esperando como mucho esperar_s: 0 = no esperar, inf = sin límite), o None
+    si sigue en curso. KeyError si la
+    clave no corresponde a ningún análisis iniciado ni cacheado.
+    """
+    if AZURE_CACHE_ENABLED:
+        campos = _cache_azure().get(clave)
+        if campos is not None:
+            return campos
+    model_id = clave.split(":", 1)[1]
+    poller = _poller_azure(clave + "#", model_id)
+    result = _esperar_poller(clave + "#", poller, esperar_s)
+    if result is None:
+        return None
+    campos = _campos_resultado(result)
+    if AZURE_CACHE_ENABLED:
+        _cache_azure().put(clave, campos)
+    _olvidar_analisis(clave + "#")
+    return campos
+
+def analisis_terminado(clave_op: str) -> bool:
+    """
+    ¿Terminó (bien o con error) la operación de AnalisisPendiente.clave? Solo
+    consulta el poller, no espera. También True si ya no queda poller ni token:
+    la próxima llamada con el PDF la toma de la caché o la reenvía.
+    """
+    model_id = clave_op.split("#", 1)[0].split(":", 1)[1]
+    try:
+        return _poller_azure(clave_op, model_id).done()
+    except KeyError:
+        return True
+
+def _campos_documento(doc) -> dict:
+    campos = {}
+    for name, field in doc.fields.items():
+        if name == "Cantidad":
+            # Use field.content for "Cantidad" to get the raw string
+            value = field.content if field.content is not None else field.value if field.value is not None else ""
+        else:
+            value = field.value if field.value is not None else field.content if field.content is not None else ""
+        campos[name] = value
+    return campos
+
+def _campos_resultado(result) -> dict:
     campos = {}
     for doc in result.documents:
-        for name, field in doc.fields.items():
-            if name == "Cantidad":
-                # Use field.content for "Cantidad" to get the raw string
-                value = field.content if field.content is not None else field.value if field.value is not None else ""
-            else:
-                value = field.value if field.value is not None else field.content if field.content is not None else ""
-            campos[name] = value
+        campos.update(_campos_documento(doc))
     return campos
 
+# ==================  Varias facturas en un mismo PDF  ==================
+# Los proveedores mandan a veces un solo escaneo con varias facturas. El PDF
+# completo pasa primero por el modelo personalizado: si ya separó las facturas
+# (result.documents) no hay nada más que pagar. Solo cuando devuelve un único
+# documento de varias páginas se hace una pasada barata de OCR por página para
+# buscar los límites, y cada rango se analiza en paralelo.
+AZURE_SEPARAR_FACTURAS = os.getenv("AZURE_SEPARAR_FACTURAS", "1") not in ("0", "false", "False", "no")
+AZURE_MODELO_PAGINAS = os.getenv("AZURE_MODELO_PAGINAS", "prebuilt-read")
+AZURE_RANGOS_WORKERS = int(os.getenv("AZURE_RANGOS_WORKERS", "4"))
+
+_RE_PAGINA_PDF = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+# Número de factura en el encabezado de la página (texto canónico): "factura",
+# hasta cuatro palabras ("electronica de venta") y el marcador No./Nº/Nro./N°/#.
+# Una página de continuación que solo cita "factura 998877" no abre factura nueva.
+_RE_NUMERO_FACTURA = re.compile(
+    r"\bfactura\b(?:\s+[a-z]+){0,4}?\s*(?:\b(?:no|nro|numero|n)\b|#)\s*[.:#°]*\s*"
+    r"([a-z]{0,6}[- ]?\d{3,})\b")
+_ENCABEZADO_CARACTERES = 400  # el número se busca solo al inicio de cada página
+
+def _paginas_pdf(pdf_bytes: bytes) -> int:
+    """Páginas del PDF contando objetos /Page; 0 si no se pueden contar (p.ej. object streams)."""
+    return len(_RE_PAGINA_PDF.findall(pdf_bytes))
+
+def rangos_por_numero(textos_paginas) -> list:
+    """
+    Agrupa páginas consecutivas por número de factura del encabezado:
+    ['FACTURA No FE-101 ...', 'continúa...', 'FACTURA Nº FE-102'] -> ['1-2', '3-3'].
+    Las páginas sin número siguen a la factura anterior.
+    """
+    rangos, actual, inicio = [], None, 1
+    for i, texto in enumerate(textos_paginas, 1):
+        m = _RE_NUMERO_FACTURA.search(_canon(texto)[:_ENCABEZADO_CARACTERES])
+        numero = m.group(1).replace(" ", "").replace("-", "") if m else None
+        if numero and actual and numero != actual:
+            rangos.append(f"{inicio}-{i - 1}")
+            inicio = i
+        actual = numero or actual
+    if textos_paginas:
+        rangos.append(f"{inicio}-{len(textos_paginas)}")
+    return rangos
+
+def _rangos_por_documento(result) -> list:
+    """Rangos de páginas de cada documento que Azure reconoció en el resultado."""
+    rangos = []
+    for doc in result.documents:
+        paginas = [r.page_number for r in (doc.bounding_regions or [])]
+        rangos.append(f"{min(paginas)}-{max(paginas)}" if paginas else "")
+    return rangos
+
+@cronometrado("azure_separacion")
+def _rangos_facturas(pdf_bytes: bytes, plazo_s: float = None, clave: str = None) -> list:
+    """Pasada de OCR simple (AZURE_MODELO_PAGINAS): límites de factura por página."""
+    result = _analizar_azure(pdf_bytes, AZURE_MODELO_PAGINAS, plazo_s=plazo_s, clave=clave)
+    return rangos_por_numero([" ".join(l.content for l in (p.lines or [])) for p in result.pages])
+
+@cronometrado("azure_extraccion")
+def extraer_facturas_azure(ruta_pdf, usar_cache: bool = True, workers: int = None,
+                           plazo_s: float = None) -> list:
+    """
+    Una entrada (paginas, campos) por factura del PDF, p.ej. [('1-2', {...}), ('3-3', {...})].
+    Un PDF de una sola factura devuelve una sola entrada con los mismos campos que
+    extraer_campos_azure. Los rangos se analizan en paralelo (AZURE_RANGOS_WORKERS).
+    `ruta_pdf` y plazo_s (AnalisisPendiente) funcionan como en extraer_campos_azure;
+    los rangos que sí terminaron no se reenvían al retomar.
+    """
+    pdf_bytes = _leer_pdf(ruta_pdf)
+    model_id = _config("AZURE_MODEL_ID")
+    base = _clave_azure(pdf_bytes, model_id)
+    clave = "facturas:" + base
+    if usar_cache and AZURE_CACHE_ENABLED:
+        facturas = _cache_azure().get(clave)
+        if facturas is not None:
+            incrementar("contabilizar_cache_total", ayuda="Consultas a cachés por resultado", cache="azure", resultado="hit")
+            return facturas
+        incrementar("contabilizar_cache_total", ayuda="Consultas a cachés por resultado", cache="azure", resultado="miss")
+
+    n_paginas = _paginas_pdf(pdf_bytes)
+    pdf_bytes = bytes(pdf_bytes)  # única copia, solo en un fallo de caché: el SDK envía bytes
+    operaciones = [base + "#"]
+    result = _analizar_azure(pdf_bytes, model_id, plazo_s=plazo_s, clave=base)
+    n_paginas = len(result.pages or []) or n_paginas  # el resultado cuenta bien aun con object streams
+    rangos = []
+    if len(result.documents) > 1:
+        # El modelo ya separó las facturas: un campos por documento
+        facturas = [(r, _campos_documento(doc))
+                    for r, doc in zip(_rangos_por_documento(result), result.documents)]
+    else:
+        if AZURE_SEPARAR_FACTURAS and n_paginas > 1:
+            # Un solo documento de varias páginas: ¿son varias facturas pegadas?
+            clave_rangos = f"{base.split(':', 1)[0]}:{AZURE_MODELO_PAGINAS}"  # mismo PDF, modelo OCR
+            rangos = _rangos_facturas(pdf_bytes, plazo_s, clave_rangos)
+            operaciones += [clave_rangos + "#"] + [f"{base}#{r}" for r in rangos]
+        if len(rangos) > 1:
+            log.info("%s: %d facturas en páginas %s", _nombre_pdf(ruta_pdf), len(rangos), rangos)
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max(1, min(workers or AZURE_RANGOS_WORKERS, len(rangos)))) as pool:
+                resultados = list(pool.map(lambda r: _analizar_azure(pdf_bytes, model_id, r, plazo_s, base), rangos))
+            facturas = [(r, _campos_resultado(res)) for r, res in zip(rangos, resultados)]
+        else:
+            facturas = [(f"1-{n_paginas}" if n_paginas else "", _campos_resultado(result))]
+    if AZURE_CACHE_ENABLED:
+        _cache_azure().put(clave, facturas)
+    _olvidar_analisis(*operaciones)
+    return facturas
+
+def _cantidad_total_kg(cantidad) -> float:
+    """
+    Suma de 'Cantidad' (Kg). Azure trae el texto crudo con una cantidad por
+    línea ('12,500\n8,000'); se ignoran líneas vacías, cero o negativas.
+    """
+    if isinstance(cantidad, str):
+        # Remove thousands separators (commas), keep decimal point
+        quantities = [to_float(line.strip().replace(",", "")) for line in cantidad.split("\n") if line.strip()]
+    elif isinstance(cantidad, (list, tuple)):
+        quantities = [to_float(q) for q in cantidad]
+    elif isinstance(cantidad, (int, float)):
+        quantities = [to_float(cantidad)]
+    else:
+        quantities = []
+    quantities = [q for q in quantities if q > 0]
+    return round(sum(quantities), 2) if quantities else 0
+
 # ASIENTO CONTABLE
+@cronometrado("asiento")
 def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transaccion):
 
     asiento = []
+    texto = TextoFactura(campos)
     subtotal = to_float(campos.get("Subtotal"))
     fletes = to_float(campos.get("Fletes", 0))  # New field for freight charges
     adjusted_subtotal = subtotal + fletes  # Combine for debit and retention calculations
@@ -905,43 +2358,18 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
     cantidad_total = 0
     if cuenta == "14051001":
         cantidad = campos.get("Cantidad", "")
-        try:
-            quantities = []
-            if isinstance(cantidad, str):
-                import re
-                # Split by newlines and clean each line
-                lines = [line.strip() for line in cantidad.split("\n") if line.strip()]
-                for line in lines:
-                    # Remove thousands separators (commas), keep decimal point
-                    clean_line = line.replace(",", "")
-                    value = to_float(clean_line)
-                    if value > 0:  # Only accept positive quantities
-                        quantities.append(value)
-                    else:
-                        print(f"Debug - Skipping invalid quantity: {line} (negative or zero)")
-            elif isinstance(cantidad, (list, tuple)):
-                quantities = [to_float(q) for q in cantidad if to_float(q) > 0]
-            elif isinstance(cantidad, (int, float)):
-                value = to_float(cantidad)
-                if value > 0:
-                    quantities = [value]
-                else:
-                    print(f"Debug - Skipping invalid quantity: {cantidad} (negative or zero)")
-            else:
-                quantities = []
-            cantidad_total = round(sum(quantities), 2) if quantities else 0
-            print(f"Debug - Cantidad Parsed: Raw={cantidad}, Lines={lines}, Quantities={quantities}, Total={cantidad_total}")
-        except Exception as e:
-            print(f"Warning - Failed to parse Cantidad: {cantidad}, Error: {str(e)}. Setting cantidad_total to 0.")
-            cantidad_total = 0
+        cantidad_total = _cantidad_total_kg(cantidad)
+        log.debug("Cantidad Parsed: Raw=%r, Total=%s", cantidad, cantidad_total)
 
     # Check for imbalance risk
     expected_total = adjusted_subtotal + iva_valor
     if expected_total != total_factura:
-        print(f"Warning - Potential imbalance: Expected Total ({expected_total}) != Azure Total Factura ({total_factura}). Fletes may be already included in Subtotal or Total Factura. Using Subtotal only for safety.")
+        log.info("Potential imbalance: Expected Total (%s) != Azure Total Factura (%s). Fletes may be already "
+                 "included in Subtotal or Total Factura. Using Subtotal only for safety.", expected_total, total_factura)
         adjusted_subtotal = subtotal  # Fallback to subtotal to avoid double-counting
 
-    print(f"Debug - Campos: {campos}, Fletes: {fletes}, Adjusted Subtotal: {adjusted_subtotal}, Fomento: {fomento}, Cantidad Total (Kg): {cantidad_total}")  # Debug output
+    log.debug("Campos: %s, Fletes: %s, Adjusted Subtotal: %s, Fomento: %s, Cantidad Total (Kg): %s",
+              campos, fletes, adjusted_subtotal, fomento, cantidad_total)
 
     # 1. Subtotal + Fletes => gasto/inventario
     if adjusted_subtotal > 0:
@@ -979,31 +2407,18 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
     original_retefuente = retefuente_valor
     calculated_retefuente = 0.0
 
-    # Normalize regimen text and detect flags (handles 'iva\nNo ...')
-    regimen_norm = (campos.get("Regimen Tributario", "") or "").replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    is_autorretenedor = es_autorretenedor_renta(regimen_norm)
-    is_simple = es_regimen_simple(regimen_norm)
+    # Detect flags on the normalized regimen text (handles 'iva\nNo ...')
+    is_autorretenedor = texto.es_autorretenedor_renta()
+    is_simple = texto.es_regimen_simple()
 
     # Normalize/repair retention category from GPT and fall back for fletes
     cat_in = retention_category
     retention_category = normalize_retention_category(retention_category, descripcion=descripcion, cuenta=str(cuenta))
 
-    print(f"Debug - RTE cat IN='{cat_in}' -> NORM='{retention_category}', "
-          f"AutoRenta={is_autorretenedor}, Simple={is_simple}, Base={adjusted_subtotal}, OrigRF={original_retefuente}")
-
-    retention_mapping = {
-        "PERSONAS JURIDICAS 11%": {"account": "23651502", "rate": 0.11},
-        "PERSONAS NO DECLARANTES PN 10%": {"account": "23651503", "rate": 0.10},
-        "SERVICIOS 1%": {"account": "23652501", "rate": 0.01},
-        "SERVICIOS 4%": {"account": "23652502", "rate": 0.04},
-        "SERVICIOS 2%": {"account": "23652503", "rate": 0.02},
-        "SERVICIOS 3.5%": {"account": "23652505", "rate": 0.035},
-        "ARRENDAMIENTO BIENES INMUEBLES 3.5%": {"account": "23653004", "rate": 0.035},
-        "ARRENDAMIENTO BIENES MUEBLES 4%": {"account": "23653005", "rate": 0.04},
-        "COMBUSTIBLE 0.1%": {"account": "23657001", "rate": 0.001},
-        "COMPRAS 2.5%": {"account": "23657003", "rate": 0.025},
-        "COMPRAS 1.5%": {"account": "23657004", "rate": 0.015},
-    }
+    log.debug("RTE cat IN='%s' -> NORM='%s', AutoRenta=%s, Simple=%s, Base=%s, OrigRF=%s",
+              cat_in, retention_category, is_autorretenedor, is_simple, adjusted_subtotal, original_retefuente)
+
+    regla_rf = texto.reglas.retencion.get(retention_category)
     retefuente_account = "236520"
     retefuente_name = "Retefuente registrada"
 
@@ -1016,12 +2431,12 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
         and not is_autorretenedor
         and not is_simple
     ):
-        if retention_category in retention_mapping:
-            retefuente_account = retention_mapping[retention_category]["account"]
+        if regla_rf is not None:
+            retefuente_account = regla_rf.cuenta
             retefuente_name = retention_category
-            rate = retention_mapping[retention_category]["rate"]
+            rate = regla_rf.tarifa
             calculated_retefuente = round(adjusted_subtotal * rate, 2)
-            print(f"Debug - Applying retefuente: {retention_category} -> {rate * 100}% = {calculated_retefuente}")
+            log.debug("Applying retefuente: %s -> %s%% = %s", retention_category, rate * 100, calculated_retefuente)
             asiento.append({
                 "cuenta": retefuente_account,
                 "nombre": retefuente_name,
@@ -1030,10 +2445,10 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
                 "Cantidad (Kg)": 0
             })
         else:
-            print(f"Debug - Unknown retention category after normalize: '{retention_category}'")
+            log.debug("Unknown retention category after normalize: '%s'", retention_category)
     elif retention_category and original_retefuente > 0:
-        if retention_category in retention_mapping:
-            retefuente_account = retention_mapping[retention_category]["account"]
+        if regla_rf is not None:
+            retefuente_account = regla_rf.cuenta
             retefuente_name = retention_category
         asiento.append({
             "cuenta": retefuente_account,
@@ -1044,12 +2459,12 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
         })
 
 
-    print(f"Debug - Retefuente: Original={original_retefuente}, Calculated={calculated_retefuente}")  # Debug retefuente values
+    log.debug("Retefuente: Original=%s, Calculated=%s", original_retefuente, calculated_retefuente)
 
         # === 3) ReteICA Ibagué + Tasa Bomberil (solo si proveedor es de Ibagué) ===
     try:
-        reteica_val, bomberil_val, acc_ica, acc_bomb, note_ica = calcular_ica_bomberil_consolidado(campos, adjusted_subtotal)
-        print(f"Debug - ICA/Bomberil: {note_ica}, reteICA={reteica_val}, bomberil={bomberil_val}")
+        reteica_val, bomberil_val, acc_ica, acc_bomb, note_ica = calcular_ica_bomberil_consolidado(campos, adjusted_subtotal, texto)
+        log.debug("ICA/Bomberil: %s, reteICA=%s, bomberil=%s", note_ica, reteica_val, bomberil_val)
         if reteica_val > 0:
             asiento.append({
                 "cuenta": acc_ica,
@@ -1067,7 +2482,7 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
                 "Cantidad (Kg)": 0
             })
     except Exception as e:
-        print(f"Warn - cálculo ICA/Bomberil: {e}")
+        log.warning("cálculo ICA/Bomberil: %s", e)
 
     # 4. Impuesto Fomento retention for Arroz Paddy only
     if ("arroz paddy" in descripcion) and cuenta == "14051001":
@@ -1076,14 +2491,14 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
             campos["Impuesto Fomento"] = str(fomento)
         if fomento > 0:
             asiento.append({
-                "cuenta": "246005",
+                "cuenta": CUENTA_FOMENTO,
                 "nombre": "Cuota Fomento Arrocero",
                 "debito": 0,
                 "credito": fomento,
                 "Cantidad (Kg)": 0
             })
         else:
-            print(f"Debug - Fomento is zero or not processed: {fomento}")  # Debug for missing case
+            log.debug("Fomento is zero or not processed: %s", fomento)
 
           # 5. Cuenta por pagar al proveedor (adjusted for retentions)
     def _to_float(v):
@@ -1118,16 +2533,16 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
     # >>> Usa tu archivo de pares para decidir la cuenta de CxP <<<
     cxp_cuenta, cxp_nombre_base = seleccionar_cuenta_cxp_por_pares(
         cuenta_debito=cuenta,
-        csv_path="Pares_Debito-AP_extra_dos.csv",
+        csv_path=CXP_PARES_CSV,
     )
 
-    print(
-        f"Debug - Total Factura: {total_factura}, Adjusted Subtotal: {adjusted_subtotal}, "
-        f"Fomento: {fomento}, Original Fomento: {original_fomento}, "
-        f"Retefuente: {retefuente_valor}, Calculated Retefuente: {calculated_retefuente}, "
-        f"ReteICA Calc: {reteica_calc}, Bomberil Calc: {bomberil_calc}, "
-        f"ReteICA Doc: {reteica_in_doc}, Bomberil Doc: {bomberil_in_doc}, "
-        f"Payable Account: {cxp_cuenta} - {cxp_nombre_base}, Payable Amount: {round(payable_amount, 2)}"
+    log.debug(
+        "Total Factura: %s, Adjusted Subtotal: %s, Fomento: %s, Original Fomento: %s, "
+        "Retefuente: %s, Calculated Retefuente: %s, ReteICA Calc: %s, Bomberil Calc: %s, "
+        "ReteICA Doc: %s, Bomberil Doc: %s, Payable Account: %s - %s, Payable Amount: %s",
+        total_factura, adjusted_subtotal, fomento, original_fomento,
+        retefuente_valor, calculated_retefuente, reteica_calc, bomberil_calc,
+        reteica_in_doc, bomberil_in_doc, cxp_cuenta, cxp_nombre_base, round(payable_amount, 2),
     )
 
     asiento.append({
@@ -1141,8 +2556,388 @@ def construir_asiento(campos, cuenta, nombre, retention_category, tipo_transacci
 
     return asiento
 
+# =====================  Asientos en lote (vectorizado)  =====================
+# Re-liquidación masiva: mismas reglas que construir_asiento, pero columna a
+# columna. Los detectores de texto (régimen, flete, categoría, ICA) se evalúan
+# una vez por combinación distinta de valores y el resto es aritmética NumPy.
+
+_COLUMNAS_ASIENTO = ["asiento", "cuenta", "nombre", "debito", "credito", "Cantidad (Kg)", "Tercero", "Detalle"]
+
+def _combinar(*codigos):
+    """(codigos, primeros): código de combinación por fila e índice de su primera aparición."""
+    import numpy as np
+    import pandas as pd
+    combinado = np.zeros(len(codigos[0]), dtype=np.int64)
+    for c in codigos:
+        # c >= -1 (vacía); se re-factoriza en cada paso para que la clave no desborde int64
+        combinado, unicos = pd.factorize(combinado * (int(c.max(initial=-1)) + 2) + (c + 1))
+    primeros = np.empty(len(unicos), dtype=np.int64)
+    primeros[combinado[::-1]] = np.arange(len(combinado) - 1, -1, -1)
+    return combinado, primeros
+
+def _unicos(*columnas):
+    """(codigos, primeros) de la combinación de varias columnas."""
+    import pandas as pd
+    return _combinar(*(pd.factorize(col, use_na_sentinel=False)[0] for col in columnas))
+
+def _tabla_unicos(fn, *columnas, codigos=None):
+    """
+    (codigos, resultados): fn(*valores) una sola vez por combinación distinta.
+    `codigos`: factorización ya hecha de cada columna (evita re-factorizar texto).
+    """
+    import pandas as pd
+    if codigos is None and len(columnas) == 1:
+        codigos, unicos = pd.factorize(columnas[0], use_na_sentinel=False)
+        return codigos, [fn(u) for u in unicos]
+    codigos, primeros = _combinar(*codigos) if codigos is not None else _unicos(*columnas)
+    return codigos, [fn(*(col[i] for col in columnas)) for i in primeros]
+
+def _mapear_unicos(fn, *columnas, dtype=object, codigos=None):
+    """fn(*valores) una sola vez por combinación distinta, alineado con las filas."""
+    import numpy as np
+    codigos, valores = _tabla_unicos(fn, *columnas, codigos=codigos)
+    resultados = np.empty(len(valores), dtype=dtype)
+    resultados[:] = valores
+    return resultados[codigos]
+
+def _redondear2(x):
+    """
+    round(x, 2) de Python en NumPy. np.round difiere del redondeo exacto de
+    Python en algunos casos casi-empate (.xx5): esos se recalculan uno a uno.
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    out = np.round(x, 2)
+    frac = np.abs(x * 100.0) % 1.0
+    dudosos = np.flatnonzero(np.abs(frac - 0.5) < 1e-6 + np.abs(x) * 1e-13)
+    if len(dudosos):
+        out[dudosos] = [round(v, 2) for v in x[dudosos].tolist()]
+    return out
+
+class _CamposLote:
+    """
+    Columnas de `campos` del lote, factorizadas una vez por columna usada:
+    (código por fila, valores distintos). Celda vacía (NaN/None) = llave
+    ausente en `campos` (código -1). Lo que depende solo del valor (texto,
+    conversión a número, "¿es verdadero?") se calcula por valor distinto y se
+    reparte a las filas indexando con los códigos.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.n = len(df)
+        self._cols = {}
+        self._floats = {}
+        self._primeros = {}
+
+    def _columna(self, nombre):
+        if nombre not in self._cols:
+            import numpy as np
+            import pandas as pd
+            if nombre in self.df.columns:
+                codigos, unicos = pd.factorize(self.df[nombre], use_na_sentinel=True)
+            else:
+                codigos, unicos = np.full(self.n, -1, dtype=np.int64), []
+            self._cols[nombre] = (codigos, np.asarray(unicos, dtype=object))
+        return self._cols[nombre]
+
+    def _por_valor(self, nombre, valores_unicos, vacia, dtype=object):
+        """Valores calculados por valor distinto (más `vacia` para las celdas vacías) repartidos por fila."""
+        import numpy as np
+        codigos, unicos = self._columna(nombre)
+        tabla = np.empty(len(unicos) + 1, dtype=dtype)
+        tabla[:-1] = valores_unicos
+        tabla[-1] = vacia
+        return tabla[codigos]  # código -1 = última posición
+
+    def codigos(self, nombre):
+        """Código por fila (-1 = vacía), para combinar columnas sin re-factorizar."""
+        return self._columna(nombre)[0]
+
+    def get(self, nombre, default=""):
+        """Equivalente a campos.get(nombre, default)."""
+        return self._por_valor(nombre, self._columna(nombre)[1], default)
+
+    def por_valor(self, nombre, fn, default="", dtype=object):
+        """fn(campos.get(nombre, default)) por fila, evaluando fn una vez por valor distinto."""
+        return self._por_valor(nombre, [fn(v) for v in self._columna(nombre)[1]], fn(default), dtype)
+
+    def texto(self, nombre, default=""):
+        """str(campos.get(nombre, default)) por fila, como array object."""
+        return self.por_valor(nombre, str, default)
+
+    def _primero(self, nombres, default):
+        clave = (tuple(nombres), default)
+        if clave not in self._primeros:
+            import numpy as np
+            codigos = np.full(self.n, -1, dtype=np.int64)
+            pendiente = np.ones(self.n, dtype=bool)
+            tablas, base = [], 0
+            for nombre in nombres:
+                c, unicos = self._columna(nombre)
+                if not len(unicos):
+                    continue
+                ok = pendiente & self._por_valor(nombre, [v != "" and v != 0 for v in unicos], False, bool)
+                codigos[ok] = c[ok] + base
+                pendiente &= ~ok
+                tablas.append(unicos)
+                base += len(unicos)
+            tabla = np.empty(base + 1, dtype=object)
+            tabla[:-1] = np.concatenate(tablas) if tablas else []
+            tabla[-1] = default
+            self._primeros[clave] = (codigos, tabla)
+        return self._primeros[clave]
+
+    def primero(self, nombres, default="", texto=False):
+        """Equivalente a `campos.get(a) or campos.get(b) or default` (str(...) con texto=True)."""
+        import numpy as np
+        codigos, tabla = self._primero(nombres, default)
+        if texto:
+            tabla = np.array([str(v) for v in tabla], dtype=object)
+        return tabla[codigos]
+
+    def codigos_primero(self, nombres, default=""):
+        """Códigos por fila de `primero` (-1 = default)."""
+        return self._primero(nombres, default)[0]
+
+    def floats(self, nombre, default=None, estricto=False):
+        """
+        to_float(campos.get(nombre, default)) por fila. Con estricto=True replica
+        el bloque IVA de construir_asiento: float(valor or 0), NaN si no convierte.
+        """
+        clave = (nombre, default)
+        if clave not in self._floats:
+            import numpy as np
+            unicos = self._columna(nombre)[1]
+            v, e = _floats_lote(np.append(unicos, np.array([default], dtype=object)))
+            self._floats[clave] = (self._por_valor(nombre, v[:-1], v[-1], float),
+                                   self._por_valor(nombre, e[:-1], e[-1], float))
+        return self._floats[clave][1 if estricto else 0].copy()
+
+def _floats_lote(col):
+    """(to_float, float estricto) elemento a elemento sobre un array object."""
+    import numpy as np
+    col = col.copy()
+    col[np.equal(col, None)] = 0  # to_float(None) == float(None or 0) == 0.0
+    # Solo el texto con comas de miles se limpia; el estricto (float(x)) falla en esas celdas
+    con_coma = np.array([isinstance(v, str) and "," in v for v in col], dtype=bool)
+    if con_coma.any():
+        col[con_coma] = [v.replace(",", "") for v in col[con_coma]]
+    try:
+        # NumPy aplica el mismo float() de Python (to_float también tolera espacios)
+        valores = col.astype(float)
+    except (TypeError, ValueError):
+        return (_mapear_unicos(to_float, col, dtype=float),
+                np.where(con_coma, np.nan, _mapear_unicos(_float_estricto, col, dtype=float)))
+    if not con_coma.any():
+        return valores, valores
+    estrictos = valores.copy()
+    estrictos[con_coma] = np.nan
+    return valores, estrictos
+
+def _float_estricto(v) -> float:
+    # Como el bloque IVA de construir_asiento: float(x or 0), NaN si no convierte
+    try:
+        return float(v or 0)
+    except Exception:
+        return float("nan")
+
+def _regla_retefuente(categoria_gpt, descripcion, cuenta):
+    """(categoría normalizada, cuenta, tarifa, en_mapa) como en construir_asiento."""
+    categoria = normalize_retention_category(categoria_gpt, descripcion=descripcion, cuenta=cuenta)
+    regla = obtener_reglas().retencion.get(categoria)
+    if regla is None:
+        return categoria, "236520", 0.0, False
+    return categoria, regla.cuenta, regla.tarifa, True
+
+def _ciudad_ica(descripcion, proveedor, od, ciudad):
+    # Igual que calcular_ica_bomberil_consolidado; None = flete sin ORIGEN (no reteICA)
+    if es_flete(descripcion.strip(), proveedor.strip()):
+        return extraer_origen(od.strip()) or None
+    return ciudad.strip()
+
+def _parametros_ica_fila(ciudad, regimen, actividad):
+    if ciudad is None:
+        return 0.0, 0.0, 0.0
+    try:
+        tarifa, base_min, tb, _ = _parametros_ica(ciudad, regimen, actividad)
+    except Exception as e:
+        log.warning("cálculo ICA/Bomberil: %s", e)
+        return 0.0, 0.0, 0.0
+    return tarifa, base_min or 0.0, tb or 0.0
+
+@cronometrado("asiento_lote")
+def construir_asientos_lote(df, csv_pares: str = CXP_PARES_CSV):
+    """
+    Versión masiva de construir_asiento para re-liquidar históricos.
+
+    `df`: una fila por factura con las columnas de `campos` (Subtotal, IVA Valor,
+    Descripcion, ...) más cuenta, nombre, retention_category y tipo_transaccion.
+    Una celda vacía (NaN/None) equivale a que la llave no venga en `campos`.
+    No modifica `df` (el escalar sí escribe campos["Impuesto Fomento"]).
+
+    Devuelve un DataFrame largo, una fila por línea contable, con la columna
+    `asiento` = índice de la factura en `df` y las líneas en el mismo orden que
+    construir_asiento (gasto, IVA, retefuente, reteICA, bomberil, fomento, CxP).
+    """
+    import numpy as np
+    import pandas as pd
+
+    n = len(df)
+    if n == 0:
+        return pd.DataFrame(columns=_COLUMNAS_ASIENTO)
+    campos = _CamposLote(df)
+
+    cuenta = campos.texto("cuenta")
+    c_cuenta = campos.codigos("cuenta")
+    nombre = campos.get("nombre")
+
+    subtotal = campos.floats("Subtotal")
+    fletes = campos.floats("Fletes", 0)
+    iva = campos.floats("IVA Valor")
+    total = campos.floats("Total Factura")
+    orig_rf = campos.floats("Retefuente Valor")
+    fomento_doc = campos.floats("Impuesto Fomento", 0)
+
+    nit = campos.texto("NIT Proveedor")
+    proveedor = campos.texto("Proveedor")
+    regimen = campos.primero(_CAMPO_REGIMEN)  # con o sin tilde, como TextoFactura.norm
+    c_regimen = campos.codigos_primero(_CAMPO_REGIMEN)
+    descripcion = campos.por_valor("Descripcion", lambda d: d.lower())
+    c_descripcion = campos.codigos("Descripcion")
+
+    # Base: Subtotal + Fletes, salvo que no cuadre con el total (fletes ya incluidos)
+    adj = subtotal + fletes
+    adj = np.where(adj + iva != total, subtotal, adj)
+    hay_base = adj > 0
+
+    # Cantidad (Kg) solo para 14051001
+    es_paddy_cta = campos.por_valor("cuenta", lambda c: str(c) == "14051001", dtype=bool)
+    cantidad = np.zeros(n)
+    if es_paddy_cta.any():
+        c_cantidad = campos.codigos("Cantidad")[es_paddy_cta]
+        cantidad[es_paddy_cta] = _mapear_unicos(_cantidad_total_kg, campos.get("Cantidad")[es_paddy_cta],
+                                                dtype=float, codigos=[c_cantidad])
+
+    # IVA descontable: conversión estricta; si falla una, ambas quedan en 0
+    iva_e = campos.floats("IVA Valor", estricto=True)
+    sub_e = campos.floats("Subtotal", estricto=True)
+    falla = np.isnan(iva_e) | np.isnan(sub_e)
+    iva_e[falla] = 0.0
+    sub_e[falla] = 0.0
+    validos = (iva_e > 0) & (sub_e > 0)
+    tabla = obtener_reglas()
+    tasa = np.zeros(n)
+    for r in reversed(tabla.tarifas_iva):  # la mayor se evalúa último: tiene prioridad, como en detect_iva_rate
+        esperado = sub_e * r
+        tasa[validos & (np.abs(iva_e - esperado) <= 0.01 * np.maximum(esperado, 1e-9))] = r
+    tipos_iva = ("servicios", "compras", "gastos")
+    es_servicio = campos.por_valor("tipo_transaccion", lambda t: _normalize_tx_type((t or "").strip()) == "servicios",
+                                   dtype=bool)
+    inventario = campos.por_valor("cuenta", lambda c: _is_inventory_account(str(c)), dtype=bool)
+    tipo_iva = np.where(es_servicio, 0, np.where(inventario, 1, 2))
+    cta_iva = np.full(n, None, dtype=object)
+    nom_iva = np.full(n, None, dtype=object)
+    for (tipo, r), acc in tabla.iva.items():
+        if tipo not in tipos_iva:
+            continue
+        m = (tipo_iva == tipos_iva.index(tipo)) & (tasa == r)
+        cta_iva[m] = acc.numero
+        nom_iva[m] = acc.nombre
+    linea_iva = hay_base & (tasa > 0) & (iva_e != 0)
+    tercero_iva = campos.primero(["NIT Proveedor", "Proveedor"], texto=True)
+    detalle_iva = campos.por_valor("Descripcion", lambda d: d.lower() or "IVA descontable", default="")
+
+    # Retefuente
+    def _excluido_rf(s):
+        s = _canon(str(s))
+        return _es_autorretenedor_renta_c(s, tabla) or _es_regimen_simple_c(s, tabla)
+
+    excluido_rf = _mapear_unicos(_excluido_rf, regimen, dtype=bool, codigos=[c_regimen])
+    codigos, reglas = _tabla_unicos(_regla_retefuente, campos.get("retention_category"), descripcion, cuenta,
+                                    codigos=[campos.codigos("retention_category"), c_descripcion, c_cuenta])
+    categoria = np.array([r[0] for r in reglas], dtype=object)[codigos]
+    cta_rf = np.array([r[1] for r in reglas], dtype=object)[codigos]
+    tasa_rf = np.array([r[2] for r in reglas], dtype=float)[codigos]
+    en_mapa = np.array([r[3] for r in reglas], dtype=bool)[codigos]
+    nom_rf = np.where(en_mapa, categoria, "Retefuente registrada")
+    con_cat = categoria != ""
+    calcula_rf = con_cat & en_mapa & (orig_rf == 0) & (adj > 1271000) & ~excluido_rf
+    calc_rf = np.zeros(n)
+    calc_rf[calcula_rf] = _redondear2(adj[calcula_rf] * tasa_rf[calcula_rf])
+    valor_rf = np.where(calcula_rf, calc_rf, orig_rf)
+    linea_rf = calcula_rf | (con_cat & (orig_rf > 0))
+
+    # ReteICA / bomberil (territorialidad: ORIGEN del flete o ciudad del proveedor)
+    grupos_ica = (["Descripcion", "Descripción"], ["Proveedor"], ["Origen-Destino", "Origen - Destino"], ["Ciudad"])
+    c_ciudad, ciudades = _tabla_unicos(_ciudad_ica, *(campos.primero(g) for g in grupos_ica),
+                                       codigos=[campos.codigos_primero(g) for g in grupos_ica])
+    ciudad_ica = np.array(ciudades, dtype=object)[c_ciudad]
+    grupo_actividad = ["Actividad Economica", "Actividad Económica"]
+    actividad = campos.primero(grupo_actividad)
+    codigos, params = _tabla_unicos(_parametros_ica_fila, ciudad_ica, regimen, actividad,
+                                    codigos=[c_ciudad, c_regimen, campos.codigos_primero(grupo_actividad)])
+    params = np.array(params, dtype=float).reshape(-1, 3)[codigos]
+    tarifa_ica, base_min, tarifa_bomb = params[:, 0], params[:, 1], params[:, 2]
+    aplica_ica = (tarifa_ica > 0) & (adj > base_min)
+    reteica = np.zeros(n)
+    reteica[aplica_ica] = _redondear2(adj[aplica_ica] * tarifa_ica[aplica_ica])
+    bomberil = np.zeros(n)
+    bomberil[aplica_ica] = _redondear2(reteica[aplica_ica] * tarifa_bomb[aplica_ica])
+
+    # Fomento arrocero
+    es_paddy = es_paddy_cta & campos.por_valor("Descripcion", lambda d: "arroz paddy" in d.lower(), dtype=bool)
+    recalcula_fom = es_paddy & (fomento_doc == 0)
+    fomento = fomento_doc.copy()
+    fomento[recalcula_fom] = _redondear2(adj[recalcula_fom] * 0.005)
+    linea_fom = es_paddy & (fomento > 0)
+
+    # CxP: total - fomento calculado - retenciones calculadas por la app
+    def _doc(nombres):
+        return _mapear_unicos(to_float, campos.primero(nombres, 0), dtype=float,
+                              codigos=[campos.codigos_primero(nombres, 0)])
+
+    reteica_doc = _doc(["RetICA Valor", "ReteICA Valor", "Retención ICA"])
+    bomberil_doc = _doc(["Bomberil Valor", "Sobretasa Bomberil", "Tasa Bomberil"])
+    pagar = total - np.where(recalcula_fom, fomento, 0.0)
+    pagar = pagar - calc_rf
+    pagar = pagar - np.where((reteica > 0) & (reteica_doc <= 0), reteica, 0.0)
+    pagar = pagar - np.where((bomberil > 0) & (bomberil_doc <= 0), bomberil, 0.0)
+    codigos, cuentas_unicas = _tabla_unicos(str, cuenta, codigos=[c_cuenta])
+    cxp = seleccionar_cuentas_cxp_lote(cuentas_unicas, csv_path=csv_pares)
+    cta_cxp = np.array([c for c, _ in cxp], dtype=object)[codigos]
+    nom_cxp = np.empty(n, dtype=object)
+    nom_cxp[:] = [f"{cxp[c][1]} - {p} - NIT {t}" for c, p, t in zip(codigos.tolist(), proveedor, nit)]
+
+    # Ensamble: un bloque por tipo de línea (máscara y valores: array por factura o
+    # escalar común) y orden estable (factura, tipo)
+    bloques = [
+        (hay_base, cuenta, nombre, adj, 0.0, cantidad, None, None),
+        (linea_iva, cta_iva, nom_iva, _redondear2(iva_e), 0.0, 0.0, tercero_iva, detalle_iva),
+        (linea_rf, cta_rf, nom_rf, 0.0, valor_rf, 0.0, None, None),
+        (reteica > 0, ICA_ACCOUNT_DEFAULT, "ReteICA Ibagué", 0.0, reteica, 0.0, None, None),
+        (bomberil > 0, BOMBERIL_ACCOUNT_DEFAULT, "Tasa bomberil Ibagué", 0.0, bomberil, 0.0, None, None),
+        (linea_fom, CUENTA_FOMENTO, "Cuota Fomento Arrocero", 0.0, fomento, 0.0, None, None),
+        (np.ones(n, dtype=bool), cta_cxp, nom_cxp, 0.0, _redondear2(pagar), 0.0, None, None),
+    ]
+    mascaras = np.stack([b[0] for b in bloques], axis=1)        # (n, tipos)
+    filas, tipos = np.nonzero(mascaras)                          # orden fila-mayor = (factura, tipo)
+    destinos = [np.flatnonzero(tipos == t) for t in range(len(bloques))]
+    columnas = {"asiento": df.index.to_numpy()[filas]}
+    for j, nombre_col in enumerate(_COLUMNAS_ASIENTO[1:], start=1):
+        numerica = nombre_col in ("debito", "credito", "Cantidad (Kg)")
+        col = np.empty(len(filas), dtype=float if numerica else object)
+        for b, destino in zip(bloques, destinos):
+            col[destino] = b[j][b[0]] if isinstance(b[j], np.ndarray) else b[j]
+        # Texto como object (igual que pandas 2): sin inferir el dtype string fila a fila
+        columnas[nombre_col] = col if numerica else pd.Series(col, dtype=object, copy=False)
+    return pd.DataFrame(columnas, copy=False)
+
+
 # MAIN
 def main():
+    from metricas import configurar_logging
+    configurar_logging()
     archivo_pdf = "factura_page_1.pdf"
     campos = extraer_campos_azure(archivo_pdf)
     descripcion = campos.get("Descripcion", "")
@@ -1155,15 +2950,14 @@ def main():
         print(f"❌ Asiento no cuadra. Débitos: {debitos}, Créditos: {creditos}, Diferencia: {diferencia}")
         return
     if cuentas := validar_cuentas_puc(asiento):
-        print(f"❌ Cuentas inválidas:", cuentas)
+        print("❌ Cuentas inválidas:", cuentas)
         return
-    nombre_base = os.path.splitext(os.path.basename(archivo_pdf))[0]
-    df = pd.DataFrame(asiento)
-    df.to_csv(f"asiento_{nombre_base}.csv", index=False)
-    with open(f"asiento_{nombre_base}.json", "w", encoding="utf-8") as f:
-        json.dump(asiento, f, indent=2, ensure_ascii=False)
-    print(f"✅ Exportado: asiento_{nombre_base}.csv y .json")
-    print(df)
+    import pandas as pd
+    from diario import DiarioContable
+    with DiarioContable() as diario:
+        diario.agregar(asiento, factura=os.path.basename(archivo_pdf), campos=campos)
+    print(f"✅ Anexado al diario: {diario.ruta} (consolidado por periodo: diario.exportar_consolidado())")
+    print(pd.DataFrame(asiento))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
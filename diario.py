@@ -0,0 +1,255 @@
+# diario.py
+"""
+Diario contable en streaming (solo-anexar) y exportación consolidada para el ERP.
+
+    from diario import DiarioContable, exportar_consolidado
+
+    with DiarioContable("diario/") as d:            # diario/diario.jsonl
+        d.agregar(asiento, factura=clave, campos=campos, periodo="2024-05")
+    exportar_consolidado("diario/")                 # diario/export/diario_2024-05.csv, saldos_2024-05.csv
+
+Cada línea del asiento es un JSON completo en diario.jsonl, con la factura
+(clave), el periodo (AAAA-MM; por defecto el de la fecha de la factura y, si
+no la trae, el mes en curso), el tercero y un número de registro. Las líneas
+se acumulan en memoria y se escriben con fsync cada DIARIO_FLUSH_LINEAS líneas,
+a más tardar DIARIO_FLUSH_S segundos después de la primera línea pendiente (un
+temporizador, aunque no lleguen más asientos) y al cerrar. Una línea truncada por un corte
+abrupto se ignora al leer; si una factura se registra dos veces, la exportación
+conserva solo su último registro.
+
+La exportación lee el diario una sola vez y escribe, por periodo, el detalle
+ordenado por cuenta y tercero y los saldos por (cuenta, tercero); en CSV y,
+si hay motor Parquet instalado (pyarrow/fastparquet), también en Parquet.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+
+log = logging.getLogger("contabilizar")
+
+DIARIO_DIR = os.getenv("DIARIO_DIR", "diario")
+DIARIO_ARCHIVO = "diario.jsonl"
+DIARIO_FLUSH_LINEAS = int(os.getenv("DIARIO_FLUSH_LINEAS", "500"))
+DIARIO_FLUSH_S = float(os.getenv("DIARIO_FLUSH_S", "2"))
+
+# Columnas del detalle exportado (las demás claves de las líneas se conservan al final)
+COLUMNAS_DIARIO = ("periodo", "cuenta", "Tercero", "nombre", "debito", "credito",
+                   "Cantidad (Kg)", "Detalle", "factura", "registro")
+
+
+# Campos de fecha de la factura, en orden de preferencia
+CAMPOS_FECHA = ("Fecha", "Fecha Factura", "Fecha de Emisión", "Fecha Emision")
+_RE_FECHA_AMD = re.compile(r"\b(\d{4})[-/.](\d{1,2})[-/.]\d{1,2}\b")   # 2024-05-17
+_RE_FECHA_DMA = re.compile(r"\b\d{1,2}[-/.](\d{1,2})[-/.](\d{4})\b")   # 17/05/2024
+
+
+def periodo_actual() -> str:
+    return datetime.now().strftime("%Y-%m")
+
+
+def periodo_de_factura(campos: dict):
+    """Periodo AAAA-MM de la fecha de la factura (date de Azure o texto AAAA-MM-DD / DD/MM/AAAA), o None."""
+    for nombre in CAMPOS_FECHA:
+        valor = (campos or {}).get(nombre)
+        if isinstance(valor, (date, datetime)):
+            return valor.strftime("%Y-%m")
+        if not isinstance(valor, str):
+            continue
+        m = _RE_FECHA_AMD.search(valor)
+        anio, mes = (m.group(1), m.group(2)) if m else (None, None)
+        if m is None and (m := _RE_FECHA_DMA.search(valor)):
+            anio, mes = m.group(2), m.group(1)
+        if anio and 1 <= int(mes) <= 12:
+            return f"{anio}-{int(mes):02d}"
+    return None
+
+
+def _ruta_diario(ruta: str) -> str:
+    return os.path.join(ruta, DIARIO_ARCHIVO) if not ruta.endswith(".jsonl") else ruta
+
+
+def _termina_en_salto(ruta: str) -> bool:
+    with open(ruta, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def leer_diario(ruta: str = DIARIO_DIR):
+    """Itera las líneas del diario (carpeta o .jsonl); ignora líneas incompletas."""
+    ruta = _ruta_diario(ruta)
+    if not os.path.exists(ruta):
+        return
+    with open(ruta, "r", encoding="utf-8") as f:
+        for linea in f:
+            try:
+                yield json.loads(linea)
+            except ValueError:
+                continue  # línea truncada por un corte abrupto
+
+
+class DiarioContable:
+    """
+    Sumidero solo-anexar de asientos, seguro entre hilos. `facturas` contiene
+    las claves ya registradas (incluidas las de ejecuciones anteriores), para
+    que quien procesa por lotes pueda reconciliar tras una caída; el diario se
+    lee para armarlas solo la primera vez que se piden.
+    """
+
+    def __init__(self, carpeta: str = DIARIO_DIR, flush_lineas: int = DIARIO_FLUSH_LINEAS,
+                 flush_s: float = DIARIO_FLUSH_S):
+        os.makedirs(carpeta, exist_ok=True)
+        self.carpeta = carpeta
+        self.ruta = _ruta_diario(carpeta)
+        self.flush_lineas = max(1, flush_lineas)
+        self.flush_s = flush_s
+        self._lock = threading.Lock()
+        self._pendientes = []
+        self._ultimo_flush = time.monotonic()
+        self._temporizador = None
+        self._facturas = None
+        self._f = open(self.ruta, "a", encoding="utf-8")
+        if self._f.tell() and not _termina_en_salto(self.ruta):
+            self._f.write("\n")  # aísla la línea truncada: las nuevas no se pegan a ella
+
+    @property
+    def facturas(self) -> set:
+        with self._lock:
+            if self._facturas is None:
+                if not self._f.closed:
+                    self._flush()  # las pendientes también cuentan
+                self._facturas = {reg.get("factura") for reg in leer_diario(self.ruta)}
+            return self._facturas
+
+    def agregar(self, asiento, factura: str, campos: dict = None, periodo: str = None) -> int:
+        """
+        Anexa las líneas de un asiento. El tercero de cada línea es su 'Tercero'
+        o, si no trae, el NIT del proveedor. `periodo` (AAAA-MM) por defecto es
+        el de la fecha de la factura en `campos` o, si no la trae, el mes en
+        curso. Devuelve el número de líneas.
+        """
+        campos = campos or {}
+        nit = str(campos.get("NIT Proveedor") or campos.get("Proveedor") or "")
+        periodo = periodo or periodo_de_factura(campos) or periodo_actual()
+        comun = {"factura": factura, "periodo": periodo, "registro": time.time_ns()}
+        lineas = []
+        for l in asiento:
+            reg = dict(l)
+            t = reg.get("Tercero")
+            reg["Tercero"] = str(t) if t not in (None, "") and t == t else nit  # t != t: NaN del editor
+            reg.update(comun)
+            lineas.append(json.dumps(reg, ensure_ascii=False, default=str))
+        with self._lock:
+            self._pendientes.extend(lineas)
+            if self._facturas is not None:
+                self._facturas.add(factura)
+            if (len(self._pendientes) >= self.flush_lineas
+                    or time.monotonic() - self._ultimo_flush >= self.flush_s):
+                self._flush()
+            elif self._temporizador is None and self._pendientes:
+                # Un escritor de larga vida (el lote) no deja líneas sin escribir indefinidamente
+                self._temporizador = threading.Timer(self.flush_s, self._flush_por_tiempo)
+                self._temporizador.daemon = True
+                self._temporizador.start()
+        return len(lineas)
+
+    def _flush_por_tiempo(self):
+        with self._lock:
+            if not self._f.closed:
+                self._flush()
+
+    def _flush(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        if self._pendientes:
+            self._f.write("\n".join(self._pendientes) + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._pendientes.clear()
+        self._ultimo_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def cerrar(self):
+        with self._lock:
+            if not self._f.closed:
+                self._flush()
+                self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+
+# =====================  Exportación consolidada  =====================
+
+def cargar_diario(ruta: str = DIARIO_DIR, periodos=None):
+    """DataFrame del diario con el último registro de cada factura (opcionalmente filtrado por periodo)."""
+    import pandas as pd
+
+    periodos = set(periodos) if periodos else None
+    filas = [r for r in leer_diario(ruta) if periodos is None or r.get("periodo") in periodos]
+    df = pd.DataFrame(filas)
+    if df.empty:
+        return pd.DataFrame(columns=list(COLUMNAS_DIARIO))
+    # Una factura re-registrada (reintento tras una caída) conserva solo su último registro
+    df = df[df["registro"] == df.groupby("factura")["registro"].transform("max")]
+    for c in ("debito", "credito", "Cantidad (Kg)"):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
+    extras = [c for c in df.columns if c not in COLUMNAS_DIARIO]
+    df = df.reindex(columns=[c for c in COLUMNAS_DIARIO if c in df.columns] + extras)
+    return df.sort_values(["periodo", "cuenta", "Tercero", "factura", "registro"], kind="stable",
+                          ignore_index=True)
+
+
+def _motor_parquet():
+    import importlib.util
+    return next((m for m in ("pyarrow", "fastparquet") if importlib.util.find_spec(m)), None)
+
+
+def saldos(df):
+    """Débitos y créditos por (periodo, cuenta, Tercero)."""
+    return (df.groupby(["periodo", "cuenta", "Tercero"], sort=True, as_index=False)
+              .agg(nombre=("nombre", "first"), debito=("debito", "sum"),
+                   credito=("credito", "sum"), lineas=("cuenta", "size"))
+              .round({"debito": 2, "credito": 2}))
+
+
+def exportar_consolidado(ruta: str = DIARIO_DIR, salida: str = None, periodos=None,
+                         parquet: bool = None, df=None) -> list:
+    """
+    Escribe por periodo diario_<periodo>.csv (detalle) y saldos_<periodo>.csv en
+    `salida` (default <carpeta del diario>/export). parquet=None -> también en
+    Parquet si hay motor instalado. `df`: el diario ya cargado con cargar_diario
+    (p.ej. tras validarlo), para no leerlo dos veces. Devuelve las rutas escritas.
+    """
+    carpeta = os.path.dirname(_ruta_diario(ruta)) or "."
+    salida = salida or os.path.join(carpeta, "export")
+    os.makedirs(salida, exist_ok=True)
+    motor = _motor_parquet() if parquet is not False else None
+    if parquet and motor is None:
+        log.warning("diario: sin pyarrow/fastparquet; la exportación Parquet se omite")
+
+    if df is None:
+        df = cargar_diario(ruta, periodos)
+    tabla_saldos = saldos(df)
+    escritos = []
+    for periodo, detalle in df.groupby("periodo", sort=True):
+        for nombre, tabla in (("diario", detalle), ("saldos", tabla_saldos[tabla_saldos["periodo"] == periodo])):
+            base = os.path.join(salida, f"{nombre}_{periodo}")
+            tabla.to_csv(base + ".csv", index=False)
+            escritos.append(base + ".csv")
+            if motor:
+                tabla.to_parquet(base + ".parquet", index=False, engine=motor)
+                escritos.append(base + ".parquet")
+    log.info("diario: %d línea(s) exportadas en %d archivo(s) a %s", len(df), len(escritos), salida)
+    return escritos
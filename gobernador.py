@@ -0,0 +1,255 @@
+# gobernador.py
+"""
+Gobernador de las llamadas salientes (Azure Document Intelligence, OpenAI).
+
+    from gobernador import gobernador
+    resultado = gobernador("openai").ejecutar(cliente.chat.completions.create, **kwargs)
+
+Por servicio:
+  - cubeta de fichas: GOB_<SERVICIO>_RPS solicitudes/s con ráfaga GOB_<SERVICIO>_RAFAGA;
+  - concurrencia adaptativa (AIMD): el límite sube ~+1 por cada `limite` llamadas
+    exitosas y baja a la mitad con cada señal de congestión (429, 503, 504 o
+    timeout), entre 1 y GOB_<SERVICIO>_CONCURRENCIA; los demás fallos no lo mueven;
+  - reintentos de 408/429/5xx y errores de conexión con backoff exponencial con
+    jitter completo. Un Retry-After del servidor se respeta y, si vino con una
+    señal de congestión, además pausa la cubeta: ningún hilo vuelve a intentar
+    antes de tiempo.
+La ficha se toma antes de ocupar un cupo: la espera por tasa no retiene cupos.
+Y para todo el proceso (todas las sesiones de Streamlit y los hilos del lote),
+un tope global de GOB_MAX_CONCURRENCIA llamadas en curso.
+
+Los clientes de PoolClientes se crean sin reintentos propios en la solicitud
+inicial: los reintentos viven aquí, una sola vez.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from metricas import incrementar, observar
+
+log = logging.getLogger("contabilizar")
+
+GOB_MAX_CONCURRENCIA = int(os.getenv("GOB_MAX_CONCURRENCIA", "16"))
+GOB_REINTENTOS = int(os.getenv("GOB_REINTENTOS", "5"))
+GOB_BACKOFF_BASE_S = float(os.getenv("GOB_BACKOFF_BASE_S", "0.5"))
+GOB_BACKOFF_MAX_S = float(os.getenv("GOB_BACKOFF_MAX_S", "30"))
+GOB_RETRY_AFTER_MAX_S = float(os.getenv("GOB_RETRY_AFTER_MAX_S", "120"))
+
+# Por servicio: (solicitudes/s, ráfaga, concurrencia máxima). Azure S0 admite 15
+# análisis/s; gpt-4o en el nivel 1 de OpenAI, 500 solicitudes/min (~8/s).
+_DEFECTOS = {"azure": (15, 15, 8), "openai": (8, 8, 8)}
+
+ESTADOS_TRANSITORIOS = frozenset({408, 429, 500, 502, 503, 504})
+# El servidor está saturado (no es un fallo puntual de la solicitud): reducir la concurrencia
+ESTADOS_CONGESTION = frozenset({408, 429, 503, 504})
+# Errores de red de los SDK (por nombre: este módulo no importa azure/openai/httpx)
+_ERRORES_CONEXION = frozenset({"APIConnectionError", "APITimeoutError", "ServiceRequestError",
+                               "ServiceResponseError", "TransportError", "TimeoutException"})
+
+
+def _estado_http(e: Exception):
+    estado = getattr(e, "status_code", None)
+    if estado is None:
+        estado = getattr(getattr(e, "response", None), "status_code", None)
+    return estado if isinstance(estado, int) else None
+
+
+def es_transitorio(e: Exception) -> bool:
+    """408/429/5xx o error de conexión/timeout: vale la pena reintentar."""
+    estado = _estado_http(e)
+    if estado is not None:
+        return estado in ESTADOS_TRANSITORIOS
+    return isinstance(e, (ConnectionError, TimeoutError)) or any(
+        c.__name__ in _ERRORES_CONEXION for c in type(e).__mro__)
+
+
+def es_congestion(e: Exception) -> bool:
+    """429/503/504/408 o timeout: el servicio no da abasto y conviene bajar la concurrencia."""
+    estado = _estado_http(e)
+    if estado is not None:
+        return estado in ESTADOS_CONGESTION
+    return isinstance(e, TimeoutError) or any(
+        "Timeout" in c.__name__ for c in type(e).__mro__)
+
+
+def retry_after(e: Exception):
+    """Segundos pedidos por el servidor (Retry-After / retry-after-ms / x-ms-retry-after-ms), o None."""
+    cabeceras = getattr(getattr(e, "response", None), "headers", None)
+    if not cabeceras:
+        return None
+    try:
+        cabeceras = {str(k).lower(): v for k, v in cabeceras.items()}
+    except AttributeError:
+        return None
+    for nombre, escala in (("retry-after-ms", 1e-3), ("x-ms-retry-after-ms", 1e-3), ("retry-after", 1.0)):
+        valor = cabeceras.get(nombre)
+        if valor is None:
+            continue
+        try:
+            segundos = float(valor) * escala
+        except ValueError:
+            try:  # Retry-After en formato fecha HTTP
+                segundos = parsedate_to_datetime(valor).timestamp() - time.time()
+            except (TypeError, ValueError):
+                continue
+        return min(max(0.0, segundos), GOB_RETRY_AFTER_MAX_S)
+    return None
+
+
+def backoff(intento: int) -> float:
+    """Exponencial con jitter completo: uniforme en [0, min(max, base * 2^intento)]."""
+    return random.uniform(0, min(GOB_BACKOFF_MAX_S, GOB_BACKOFF_BASE_S * (2 ** intento)))
+
+
+class CubetaFichas:
+    """Limitador de tasa seguro entre hilos; tasa <= 0 desactiva el límite."""
+
+    def __init__(self, tasa: float, rafaga: float):
+        self.tasa = tasa
+        self.capacidad = max(1.0, rafaga)
+        self._fichas = self.capacidad
+        self._t = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def pausar(self, segundos: float):
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+    def tomar(self) -> float:
+        """Toma una ficha, esperando lo necesario; devuelve los segundos esperados."""
+        esperado = 0.0
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                if self.tasa > 0:
+                    self._fichas = min(self.capacidad, self._fichas + (ahora - self._t) * self.tasa)
+                self._t = ahora
+                espera = self._pausa_hasta - ahora
+                if espera <= 0:
+                    if self.tasa <= 0:
+                        return esperado
+                    if self._fichas >= 1:
+                        self._fichas -= 1
+                        return esperado
+                    espera = (1 - self._fichas) / self.tasa
+            time.sleep(espera)
+            esperado += espera
+
+    @property
+    def fichas(self) -> float:
+        return self._fichas
+
+
+class LimiteAdaptativo:
+    """Concurrencia AIMD: +1/limite por éxito, mitad por saturación, entre 1 y maximo.
+    Un fallo sin saturación (exito=False) libera el cupo sin tocar el límite."""
+
+    def __init__(self, maximo: int):
+        self.maximo = max(1, maximo)
+        self.limite = float(self.maximo)
+        self.en_curso = 0
+        self._cond = threading.Condition()
+
+    def entrar(self):
+        with self._cond:
+            while self.en_curso >= int(self.limite):
+                self._cond.wait()
+            self.en_curso += 1
+
+    def salir(self, saturado: bool = False, exito: bool = True):
+        with self._cond:
+            self.en_curso -= 1
+            if saturado:
+                self.limite = max(1.0, self.limite / 2)
+            elif exito:
+                self.limite = min(float(self.maximo), self.limite + 1 / self.limite)
+            self._cond.notify_all()
+
+
+_cupo_global = threading.BoundedSemaphore(max(1, GOB_MAX_CONCURRENCIA))
+
+
+class Gobernador:
+    def __init__(self, servicio: str, tasa: float, rafaga: float, concurrencia: int,
+                 reintentos: int = GOB_REINTENTOS):
+        self.servicio = servicio
+        self.cubeta = CubetaFichas(tasa, rafaga)
+        self.concurrencia = LimiteAdaptativo(concurrencia)
+        self.reintentos = reintentos
+
+    def ejecutar(self, fn, *args, **kwargs):
+        """
+        Llama fn(*args, **kwargs) dentro de los límites del servicio y del proceso,
+        reintentando los errores transitorios. El último error se propaga.
+        """
+        intento = 0
+        while True:
+            espera = self.cubeta.tomar()  # sin cupos tomados: esperar aquí no bloquea a otros servicios
+            if espera:
+                observar("contabilizar_salida_espera_segundos", espera,
+                         ayuda="Espera por el límite de tasa antes de una llamada saliente",
+                         servicio=self.servicio)
+            self.concurrencia.entrar()
+            saturado, exito = False, False
+            try:
+                with _cupo_global:
+                    resultado = fn(*args, **kwargs)
+                exito = True
+            except Exception as e:
+                saturado = es_congestion(e)
+                if intento >= self.reintentos or not es_transitorio(e):
+                    self._contar("error")
+                    raise
+                pausa = retry_after(e)
+                if pausa is not None and saturado:
+                    self.cubeta.pausar(pausa)
+                pausa = pausa + random.uniform(0, GOB_BACKOFF_BASE_S) if pausa is not None else backoff(intento)
+                motivo = f"{type(e).__name__} {_estado_http(e) or ''}".strip()
+            else:
+                self._contar("ok")
+                return resultado
+            finally:
+                self.concurrencia.salir(saturado, exito)
+            intento += 1
+            self._contar("reintento")
+            log.info("%s: %s, reintento %d/%d en %.1f s", self.servicio, motivo, intento, self.reintentos, pausa)
+            time.sleep(pausa)
+
+    def _contar(self, resultado: str):
+        incrementar("contabilizar_salida_total", ayuda="Llamadas salientes por servicio y resultado",
+                    servicio=self.servicio, resultado=resultado)
+
+    def estado(self) -> dict:
+        return {"limite": round(self.concurrencia.limite, 2), "en_curso": self.concurrencia.en_curso,
+                "fichas": round(self.cubeta.fichas, 2)}
+
+
+_gobernadores = {}
+_gobernadores_lock = threading.Lock()
+
+
+def gobernador(servicio: str) -> Gobernador:
+    """Gobernador compartido del servicio ('azure', 'openai', ...), creado con su configuración del entorno."""
+    g = _gobernadores.get(servicio)
+    if g is None:
+        with _gobernadores_lock:
+            g = _gobernadores.get(servicio)
+            if g is None:
+                tasa, rafaga, conc = _DEFECTOS.get(servicio, (0, 1, GOB_MAX_CONCURRENCIA))
+                pref = f"GOB_{servicio.upper()}_"
+                g = _gobernadores[servicio] = Gobernador(
+                    servicio,
+                    float(os.getenv(pref + "RPS", tasa)),
+                    float(os.getenv(pref + "RAFAGA", rafaga)),
+                    int(os.getenv(pref + "CONCURRENCIA", conc)),
+                )
+    return g
+
+
+def estado() -> dict:
+    """Límite de concurrencia actual, llamadas en curso y fichas disponibles por servicio."""
+    return {s: g.estado() for s, g in list(_gobernadores.items())}
@@ -0,0 +1,226 @@
+# metricas.py
+"""
+Instrumentación liviana del pipeline contable (solo librería estándar).
+
+    from metricas import span, incrementar
+
+    with span("azure"):                      # histograma + contador por etapa
+        ...
+    incrementar("contabilizar_cache_total", cache="azure", resultado="hit")
+
+Las métricas viven en memoria del proceso y se exportan en formato de texto
+Prometheus con exportar_prometheus(), o se sirven en http://127.0.0.1:<puerto>/metrics
+con servir_metricas(puerto) (METRICAS_PUERTO en el entorno).
+
+Los detalles de depuración van por `logging` (logger "contabilizar"): con el
+nivel por defecto (LOG_LEVEL=WARNING) los log.debug(...) no formatean nada.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Límites (segundos) de los buckets de latencia: de CxP/validación (µs) a Azure/GPT (s)
+BUCKETS_S = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+
+_AYUDA = {
+    "contabilizar_etapa_segundos": "Duración de cada etapa del pipeline contable",
+    "contabilizar_etapa_total": "Ejecuciones de cada etapa por resultado",
+}
+
+
+def configurar_logging(nivel: str = None):
+    """Nivel de logging para los scripts (LOG_LEVEL, default WARNING). La librería no lo fija."""
+    nivel = (nivel or os.getenv("LOG_LEVEL", "WARNING")).upper()
+    logging.basicConfig(level=getattr(logging, nivel, logging.WARNING),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+def _clave(etiquetas: dict) -> tuple:
+    return tuple(sorted(etiquetas.items()))
+
+
+class _Histograma:
+    __slots__ = ("cuentas", "suma", "total")
+
+    def __init__(self):
+        self.cuentas = [0] * (len(BUCKETS_S) + 1)  # último = +Inf
+        self.suma = 0.0
+        self.total = 0
+
+
+class RegistroMetricas:
+    """Contadores e histogramas con etiquetas, seguros entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}   # nombre -> {etiquetas: valor}
+        self._histogramas = {}  # nombre -> {etiquetas: _Histograma}
+        self._ayuda = dict(_AYUDA)
+
+    def incrementar(self, nombre: str, valor: float = 1, ayuda: str = None, **etiquetas):
+        k = _clave(etiquetas)
+        with self._lock:
+            serie = self._contadores.setdefault(nombre, {})
+            serie[k] = serie.get(k, 0) + valor
+            if ayuda:
+                self._ayuda.setdefault(nombre, ayuda)
+
+    def observar(self, nombre: str, valor: float, ayuda: str = None, **etiquetas):
+        k = _clave(etiquetas)
+        i = bisect_left(BUCKETS_S, valor)
+        with self._lock:
+            h = self._histogramas.setdefault(nombre, {}).get(k)
+            if h is None:
+                h = self._histogramas[nombre][k] = _Histograma()
+            h.cuentas[i] += 1
+            h.suma += valor
+            h.total += 1
+            if ayuda:
+                self._ayuda.setdefault(nombre, ayuda)
+
+    def reiniciar(self):
+        with self._lock:
+            self._contadores.clear()
+            self._histogramas.clear()
+
+    def resumen(self) -> dict:
+        """{etapa: {n, p50_ms, p95_ms, total_s}} aproximado desde los buckets (para CLIs/UI)."""
+        out = {}
+        with self._lock:
+            for k, h in self._histogramas.get("contabilizar_etapa_segundos", {}).items():
+                etapa = dict(k).get("etapa", "")
+                out[etapa] = {
+                    "n": h.total,
+                    "p50_ms": _cuantil(h, 0.50) * 1000,
+                    "p95_ms": _cuantil(h, 0.95) * 1000,
+                    "total_s": round(h.suma, 3),
+                }
+        return out
+
+    def exportar_prometheus(self) -> str:
+        """Texto en el formato de exposición de Prometheus (text/plain; version=0.0.4)."""
+        lineas = []
+        with self._lock:
+            for nombre in sorted(self._contadores):
+                lineas.append(f"# HELP {nombre} {self._ayuda.get(nombre, nombre)}")
+                lineas.append(f"# TYPE {nombre} counter")
+                for k, v in sorted(self._contadores[nombre].items()):
+                    lineas.append(f"{nombre}{_etiquetas(k)} {_num(v)}")
+            for nombre in sorted(self._histogramas):
+                lineas.append(f"# HELP {nombre} {self._ayuda.get(nombre, nombre)}")
+                lineas.append(f"# TYPE {nombre} histogram")
+                for k, h in sorted(self._histogramas[nombre].items()):
+                    acumulado = 0
+                    for limite, c in zip(BUCKETS_S + (float("inf"),), h.cuentas):
+                        acumulado += c
+                        le = "+Inf" if limite == float("inf") else _num(limite)
+                        lineas.append(f"{nombre}_bucket{_etiquetas(k + (('le', le),))} {acumulado}")
+                    lineas.append(f"{nombre}_sum{_etiquetas(k)} {_num(h.suma)}")
+                    lineas.append(f"{nombre}_count{_etiquetas(k)} {h.total}")
+        return "\n".join(lineas) + "\n"
+
+
+def _cuantil(h: _Histograma, q: float) -> float:
+    # Límite superior del bucket que contiene el cuantil (cota, como histogram_quantile sin interpolar)
+    if not h.total:
+        return 0.0
+    objetivo, acumulado = q * h.total, 0
+    for limite, c in zip(BUCKETS_S + (BUCKETS_S[-1],), h.cuentas):
+        acumulado += c
+        if acumulado >= objetivo:
+            return limite
+    return BUCKETS_S[-1]
+
+
+def _num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def _etiquetas(k: tuple) -> str:
+    if not k:
+        return ""
+    pares = ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for n, v in k)
+    return "{" + pares + "}"
+
+
+registro = RegistroMetricas()
+incrementar = registro.incrementar
+observar = registro.observar
+exportar_prometheus = registro.exportar_prometheus
+
+
+@contextmanager
+def span(etapa: str, **etiquetas):
+    """
+    Mide la etapa: contabilizar_etapa_segundos{etapa} (histograma) y
+    contabilizar_etapa_total{etapa,resultado=ok|error}. Las excepciones se propagan.
+    """
+    t0 = time.perf_counter()
+    resultado = "error"
+    try:
+        yield
+        resultado = "ok"
+    finally:
+        registro.observar("contabilizar_etapa_segundos", time.perf_counter() - t0, etapa=etapa, **etiquetas)
+        registro.incrementar("contabilizar_etapa_total", etapa=etapa, resultado=resultado, **etiquetas)
+
+
+def cronometrado(etapa: str):
+    """Decorador equivalente a envolver la función en span(etapa)."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            with span(etapa):
+                return fn(*args, **kwargs)
+        return envoltura
+    return deco
+
+
+# =====================  Servidor /metrics local  =====================
+
+_servidor = None
+_servidor_lock = threading.Lock()
+
+
+def servir_metricas(puerto: int = None, host: str = METRICAS_HOST):
+    """
+    Sirve /metrics en un hilo daemon (una sola vez por proceso; llamadas
+    siguientes devuelven el mismo servidor). puerto None -> METRICAS_PUERTO;
+    sin puerto configurado no hace nada y devuelve None.
+    """
+    global _servidor
+    if puerto is None:
+        puerto = os.getenv("METRICAS_PUERTO")
+        if not puerto:
+            return None
+    with _servidor_lock:
+        if _servidor is not None:
+            return _servidor
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                cuerpo = exportar_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):  # sin ruido en la consola por cada scrape
+                pass
+
+        _servidor = ThreadingHTTPServer((host, int(puerto)), _Handler)
+        threading.Thread(target=_servidor.serve_forever, name="metricas-http", daemon=True).start()
+        logging.getLogger("contabilizar").info("Métricas en http://%s:%s/metrics", host, _servidor.server_port)
+        return _servidor
@@ -0,0 +1,393 @@
+# procesar_lote.py
+"""
+Procesamiento por lotes de facturas PDF (cierre de mes).
+
+Uso:
+    python procesar_lote.py facturas/               # todos los PDF de la carpeta
+    python procesar_lote.py "facturas/2024-*.pdf"   # glob
+    python procesar_lote.py facturas/ --workers 8 --salida asientos/
+
+Cada PDF pasa por extraer_facturas_azure (un escaneo puede traer varias
+facturas; sus rangos de páginas se analizan en paralelo) y cada factura por
+clasificar_con_gpt -> construir_asiento -> validar_balance. El avance se
+registra en un manifiesto (JSONL, solo-anexar) dentro de la carpeta de salida: si el proceso se cae o se
+interrumpe con Ctrl-C, al relanzarlo se retoma donde quedó y las etapas ya
+completadas (Azure, GPT) no se vuelven a enviar.
+
+Los asientos cuadrados se anexan al diario (<salida>/diario.jsonl, ver
+diario.py) y al final se exporta el consolidado del periodo para el ERP en
+<salida>/export/. Con --por-factura se escriben además los asiento_<pdf>.csv/.json.
+
+Con --gpt-lote el lote va por etapas: primero se extraen todos los PDF, luego
+las facturas sin clasificar se envían a GPT en micro-lotes (varias por
+consulta, ver cf.clasificar_facturas_lote) y al final se arman los asientos.
+
+El código de salida es 0 solo si todas las facturas quedaron OK y el diario
+valida (cuadre, cuentas PUC y un asiento por cada factura procesada según el
+manifiesto); cualquier otro estado final (descuadre, cuentas inválidas, error,
+pendiente en Azure) devuelve 2.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+import contabilizar_factura as cf
+import metricas
+from diario import DiarioContable, cargar_diario, exportar_consolidado, periodo_actual, periodo_de_factura
+
+# Estados del manifiesto, en orden de avance
+EXTRAIDA = "extraida"
+CLASIFICADA = "clasificada"
+OK = "ok"
+DESCUADRE = "descuadre"
+CUENTAS_INVALIDAS = "cuentas_invalidas"
+ERROR = "error"
+PENDIENTE_AZURE = "pendiente_azure"  # Azure no terminó en AZURE_PLAZO_S: se retoma al relanzar
+OMITIDA = "omitida"                  # ya quedó OK en una ejecución anterior
+
+FINALES = (OK, DESCUADRE, CUENTAS_INVALIDAS)
+
+
+def _ya_final(previo: dict) -> str:
+    """Estado a informar de una factura que ya llegó a un estado final: OMITIDA si quedó OK."""
+    return OMITIDA if previo["estado"] == OK else previo["estado"]
+
+
+def _hash_archivo(ruta: str) -> str:
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def resolver_entradas(entradas) -> list:
+    """Expande carpetas y globs a una lista ordenada y sin duplicados de PDFs."""
+    rutas = []
+    for e in entradas:
+        if os.path.isdir(e):
+            candidatos = glob.glob(os.path.join(e, "*.pdf")) + glob.glob(os.path.join(e, "*.PDF"))
+        else:
+            candidatos = glob.glob(e)
+        rutas.extend(p for p in candidatos if os.path.isfile(p) and p.lower().endswith(".pdf"))
+    return sorted(set(os.path.abspath(p) for p in rutas))
+
+
+# =====================  Manifiesto de avance (checkpoint)  =====================
+
+class Manifiesto:
+    """
+    Registro solo-anexar de las transiciones de cada factura, clave = SHA-256 del PDF.
+    Cada línea es un JSON completo y se hace fsync al escribirla; al cargar se
+    reproduce el archivo y la última transición de cada factura gana. Una línea
+    truncada por un corte abrupto simplemente se ignora.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self.estado = {}
+        self._lock = threading.Lock()
+        if os.path.exists(ruta):
+            with open(ruta, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        reg = json.loads(linea)
+                    except ValueError:
+                        continue  # línea incompleta de una ejecución interrumpida
+                    self.estado.setdefault(reg["clave"], {}).update(reg)
+
+    def get(self, clave: str) -> dict:
+        with self._lock:
+            return dict(self.estado.get(clave, {}))
+
+    def registrar(self, clave: str, **datos):
+        reg = {"clave": clave, "actualizado": datetime.now().isoformat(timespec="seconds"), **datos}
+        linea = json.dumps(reg, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.ruta, "a", encoding="utf-8") as f:
+                f.write(linea + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.estado.setdefault(clave, {}).update(reg)
+
+    def aprobadas(self) -> list:
+        """Facturas en estado OK: las únicas cuyo asiento se escribe en el diario."""
+        with self._lock:
+            return [c for c, reg in self.estado.items() if reg.get("estado") == OK]
+
+
+# =====================  Pipeline por factura  =====================
+
+def procesar_una(ruta_pdf: str, manifiesto: Manifiesto, salida: str, usar_cache: bool = True,
+                 diario: DiarioContable = None, periodo: str = None, por_factura: bool = False) -> list:
+    """
+    Ejecuta las etapas pendientes de un PDF y devuelve el estado final de cada
+    factura que contiene (un PDF escaneado puede traer varias; ver
+    cf.extraer_facturas_azure). Cada factura extra se registra como <hash>#<páginas>.
+    """
+    facturas = _facturas_del_pdf(ruta_pdf, manifiesto, usar_cache)
+    if isinstance(facturas, str):
+        return [facturas]
+    return [_procesar_factura(clave, ruta_pdf, paginas, campos, manifiesto, salida, nombre_base,
+                              diario, periodo, por_factura)
+            for clave, paginas, campos, nombre_base in facturas]
+
+
+def _facturas_del_pdf(ruta_pdf: str, manifiesto: Manifiesto, usar_cache: bool = True):
+    """
+    Extrae las facturas del PDF (o las toma del manifiesto) como una lista de
+    (clave, paginas, campos, nombre_base); si no hay nada que hacer devuelve el
+    estado del PDF: OMITIDA (o su estado final anterior), PENDIENTE_AZURE o ERROR.
+    """
+    clave = _hash_archivo(ruta_pdf)
+    previo = manifiesto.get(clave)
+    if previo.get("estado") in FINALES:
+        return _ya_final(previo)
+
+    # 1) Azure (solo si no se extrajo antes): rangos de páginas analizados en paralelo
+    facturas = previo.get("facturas")
+    if facturas is None and previo.get("campos") is not None:
+        facturas = [("", previo["campos"])]  # manifiesto anterior a la separación por facturas
+    if facturas is None:
+        try:
+            facturas = cf.extraer_facturas_azure(ruta_pdf, usar_cache=usar_cache)
+        except cf.AnalisisPendiente as e:
+            manifiesto.registrar(clave, archivo=ruta_pdf, estado=PENDIENTE_AZURE, error=str(e))
+            return PENDIENTE_AZURE
+        except Exception as e:
+            manifiesto.registrar(clave, archivo=ruta_pdf, estado=ERROR, error=f"{type(e).__name__}: {e}")
+            return ERROR
+        manifiesto.registrar(clave, archivo=ruta_pdf, estado=EXTRAIDA, facturas=facturas)
+
+    nombre_base = os.path.splitext(os.path.basename(ruta_pdf))[0]
+    if len(facturas) == 1:
+        paginas, campos = facturas[0]
+        return [(clave, paginas, campos, nombre_base)]
+    return [(f"{clave}#{paginas}", paginas, campos, f"{nombre_base}_p{paginas}") for paginas, campos in facturas]
+
+
+def _procesar_factura(clave: str, ruta_pdf: str, paginas: str, campos: dict, manifiesto: Manifiesto,
+                      salida: str, nombre_base: str, diario: DiarioContable = None,
+                      periodo: str = None, por_factura: bool = False) -> str:
+    """Clasificación, asiento y validaciones de una factura ya extraída; devuelve su estado."""
+    previo = manifiesto.get(clave)
+    if previo.get("estado") in FINALES:
+        return _ya_final(previo)
+    try:
+        # 2) Clasificación: memoria NIT / caché / GPT (solo si no se clasificó antes)
+        clasificacion = previo.get("clasificacion")
+        if clasificacion is None:
+            *clasificacion, fuente = cf.clasificar_factura(campos)
+            manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=CLASIFICADA, campos=campos,
+                                 clasificacion=clasificacion, fuente_clasificacion=fuente)
+
+        # 3) Asiento + validaciones (locales, baratas: siempre se recalculan)
+        cuenta, nombre, retention_category, tipo_transaccion = clasificacion
+        asiento = cf.construir_asiento(dict(campos), cuenta, nombre, retention_category,
+                                       tipo_transaccion=tipo_transaccion)
+        valido, debitos, creditos, diferencia = cf.validar_balance(asiento)
+        if not valido:
+            manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=DESCUADRE, asiento=asiento,
+                                 error=f"Débitos: {debitos}, Créditos: {creditos}, Diferencia: {diferencia}")
+            return DESCUADRE
+        invalidas = cf.validar_cuentas_puc(asiento)
+        if invalidas:
+            manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=CUENTAS_INVALIDAS,
+                                 asiento=asiento, error=f"Cuentas inválidas: {sorted(invalidas)}")
+            return CUENTAS_INVALIDAS
+
+        periodo = periodo or periodo_de_factura(campos) or periodo_actual()
+        if diario is not None:
+            diario.agregar(asiento, factura=clave, campos=campos, periodo=periodo)
+        if por_factura:
+            pd.DataFrame(asiento).to_csv(os.path.join(salida, f"asiento_{nombre_base}.csv"), index=False)
+            with open(os.path.join(salida, f"asiento_{nombre_base}.json"), "w", encoding="utf-8") as f:
+                json.dump(asiento, f, indent=2, ensure_ascii=False)
+        manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=OK, asiento=asiento,
+                             periodo=periodo, error=None)
+        return OK
+    except Exception as e:
+        # Se conservan campos/clasificación ya registrados: el reintento parte de ahí
+        manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=ERROR, error=f"{type(e).__name__}: {e}")
+        return ERROR
+
+
+def _clasificar_pendientes(pendientes, manifiesto: Manifiesto) -> set:
+    """
+    Clasifica en micro-lotes las facturas (clave, ruta_pdf, paginas, campos) y
+    registra CLASIFICADA en el manifiesto; devuelve las claves que fallaron.
+    """
+    if not pendientes:
+        return set()
+    fallidas = set()
+    resultados = cf.clasificar_facturas_lote([campos for *_, campos in pendientes])
+    for (clave, ruta_pdf, paginas, campos), r in zip(pendientes, resultados):
+        if isinstance(r, Exception):
+            manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=ERROR,
+                                 error=f"{type(r).__name__}: {r}")
+            fallidas.add(clave)
+            continue
+        *clasificacion, fuente = r
+        manifiesto.registrar(clave, archivo=ruta_pdf, paginas=paginas, estado=CLASIFICADA, campos=campos,
+                             clasificacion=clasificacion, fuente_clasificacion=fuente)
+    return fallidas
+
+
+def _procesar_por_etapas(rutas, pool, manifiesto: Manifiesto, salida: str, usar_cache: bool,
+                         diario: DiarioContable, periodo: str, por_factura: bool):
+    """
+    --gpt-lote: extrae todos los PDF, clasifica lo pendiente en micro-lotes y
+    arma los asientos. Genera (ruta_pdf, estados) a medida que termina cada PDF.
+    """
+    futuros = {pool.submit(_facturas_del_pdf, r, manifiesto, usar_cache): r for r in rutas}
+    extraidas = {futuros[fut]: fut.result() for fut in as_completed(futuros)}
+
+    pendientes = []
+    for ruta_pdf, facturas in extraidas.items():
+        for clave, paginas, campos, _ in ([] if isinstance(facturas, str) else facturas):
+            previo = manifiesto.get(clave)
+            if previo.get("estado") not in FINALES and previo.get("clasificacion") is None:
+                pendientes.append((clave, ruta_pdf, paginas, campos))
+    fallidas = _clasificar_pendientes(pendientes, manifiesto)
+
+    def _asientos(ruta_pdf, facturas):
+        if isinstance(facturas, str):
+            return [facturas]
+        return [ERROR if clave in fallidas else
+                _procesar_factura(clave, ruta_pdf, paginas, campos, manifiesto, salida, nombre_base,
+                                  diario, periodo, por_factura)
+                for clave, paginas, campos, nombre_base in facturas]
+
+    futuros = {pool.submit(_asientos, r, f): r for r, f in extraidas.items()}
+    for fut in as_completed(futuros):
+        yield futuros[fut], fut.result()
+
+
+def _reconciliar_diario(manifiesto: Manifiesto, diario: DiarioContable, periodo: str) -> int:
+    """Anexa al diario los asientos OK del manifiesto que no alcanzaron a escribirse (caída entre flushes)."""
+    n = 0
+    for clave, reg in list(manifiesto.estado.items()):
+        if reg.get("estado") == OK and reg.get("asiento") and clave not in diario.facturas:
+            diario.agregar(reg["asiento"], factura=clave, campos=reg.get("campos"),
+                           periodo=reg.get("periodo") or periodo)
+            n += 1
+    return n
+
+
+def procesar_lote(rutas, salida: str, workers: int = 4, manifiesto_path: str = None,
+                  usar_cache: bool = True, periodo: str = None, por_factura: bool = False,
+                  gpt_lote: bool = False) -> dict:
+    """
+    Procesa `rutas` con `workers` hilos concurrentes (gpt_lote: por etapas, con
+    la clasificación en micro-lotes). Devuelve el conteo de facturas por estado.
+    """
+    os.makedirs(salida, exist_ok=True)
+    manifiesto = Manifiesto(manifiesto_path or os.path.join(salida, "manifiesto.jsonl"))
+    conteo = {}
+    total = len(rutas)
+
+    with DiarioContable(salida) as diario:
+        if (n := _reconciliar_diario(manifiesto, diario, periodo)):
+            print(f"↺ {n} asiento(s) del manifiesto recuperados en el diario")
+        pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            if gpt_lote:
+                terminados = _procesar_por_etapas(rutas, pool, manifiesto, salida, usar_cache,
+                                                  diario, periodo, por_factura)
+            else:
+                futuros = {pool.submit(procesar_una, r, manifiesto, salida, usar_cache,
+                                       diario, periodo, por_factura): r for r in rutas}
+                terminados = ((futuros[fut], fut.result()) for fut in as_completed(futuros))
+            for i, (ruta_pdf, estados) in enumerate(terminados, 1):
+                for estado in estados:
+                    conteo[estado] = conteo.get(estado, 0) + 1
+                detalle = f" ({len(estados)} facturas)" if len(estados) > 1 else ""
+                print(f"[{i}/{total}] {','.join(estados):<17} {os.path.basename(ruta_pdf)}{detalle}")
+        except KeyboardInterrupt:
+            print("\n⏸ Interrumpido: se esperan las facturas en curso; el resto queda pendiente para la próxima ejecución.")
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        pool.shutdown(wait=True)
+    return conteo
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Contabiliza en lote una carpeta o glob de facturas PDF.")
+    parser.add_argument("entradas", nargs="+", help="Carpeta(s) o patrón(es) glob de PDFs")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("LOTE_WORKERS", "4")),
+                        help="Facturas procesadas en paralelo (default 4 o $LOTE_WORKERS)")
+    parser.add_argument("--salida", default="asientos", help="Carpeta de salida de asientos y manifiesto")
+    parser.add_argument("--manifiesto", default=None, help="Ruta del manifiesto (default <salida>/manifiesto.jsonl)")
+    parser.add_argument("--sin-cache-azure", action="store_true",
+                        help="Ignora la caché de Azure y vuelve a analizar cada PDF")
+    parser.add_argument("--periodo", default=os.getenv("LOTE_PERIODO"),
+                        help="Periodo contable AAAA-MM para todos los asientos (default $LOTE_PERIODO o, "
+                             "por factura, el de su fecha; el mes actual si no la trae)")
+    parser.add_argument("--por-factura", action="store_true",
+                        help="Escribe además asiento_<pdf>.csv/.json por cada factura")
+    parser.add_argument("--gpt-lote", action="store_true",
+                        default=os.getenv("LOTE_GPT_LOTE", "0") not in ("0", "false", "False", "no"),
+                        help="Clasifica las facturas pendientes en micro-lotes (varias por consulta a GPT)")
+    parser.add_argument("--metricas-puerto", type=int, default=os.getenv("METRICAS_PUERTO"),
+                        help="Sirve métricas Prometheus en http://127.0.0.1:<puerto>/metrics")
+    args = parser.parse_args(argv)
+    metricas.configurar_logging()
+    if args.metricas_puerto:
+        metricas.servir_metricas(args.metricas_puerto)
+
+    rutas = resolver_entradas(args.entradas)
+    if not rutas:
+        print("No se encontraron PDFs en:", args.entradas)
+        return 1
+    print(f"Procesando {len(rutas)} PDF(s) con {args.workers} worker(s)...")
+    # Una cuenta de las tablas (pares CxP, reglas, ICA) ausente del PUC dejaría sus facturas en cuentas_invalidas
+    for cuenta, origen in sorted(cf.cuentas_sistema_fuera_del_puc().items()):
+        print(f"⚠️ la cuenta {cuenta} ({origen}) no existe en el PUC")
+
+    try:
+        conteo = procesar_lote(rutas, args.salida, args.workers, args.manifiesto,
+                               usar_cache=not args.sin_cache_azure, periodo=args.periodo,
+                               por_factura=args.por_factura, gpt_lote=args.gpt_lote)
+    except KeyboardInterrupt:
+        return 130
+    print("Resumen:", ", ".join(f"{k}={v}" for k, v in sorted(conteo.items())))
+    if conteo.get(PENDIENTE_AZURE):
+        print(f"⏳ {conteo[PENDIENTE_AZURE]} PDF(s) siguen en análisis en Azure: relance el lote para recogerlos "
+              "(se retoman desde su token, sin reenviarlos)")
+    # Validación de todo el diario antes de entregarlo al ERP: cuadre, cuentas PUC
+    # y que cada factura aprobada según el manifiesto tenga su asiento (las de
+    # descuadre o cuentas inválidas ya se informaron y no van al diario)
+    df_diario = cargar_diario(args.salida)
+    manifiesto = Manifiesto(args.manifiesto or os.path.join(args.salida, "manifiesto.jsonl"))
+    reporte = cf.validar_asientos_lote(df_diario, esperadas=manifiesto.aprobadas())
+    print("Validación del diario:", reporte.resumen())
+    for fila in reporte.descuadrados.head(20).itertuples(index=False):
+        print(f"  descuadre {fila.factura}: débitos {fila.debito:,.2f}, créditos {fila.credito:,.2f}, "
+              f"diferencia {fila.diferencia:,.2f}")
+    for factura in reporte.faltantes[:20]:
+        reg = manifiesto.get(factura)
+        paginas = f" p{reg['paginas']}" if reg.get("paginas") else ""
+        print(f"  sin asiento en el diario: {os.path.basename(reg.get('archivo', ''))}{paginas} ({reg.get('estado')})")
+    escritos = exportar_consolidado(args.salida, df=df_diario)
+    print(f"Consolidado para el ERP: {len(escritos)} archivo(s) en {os.path.join(args.salida, 'export')}")
+    for etapa, m in sorted(metricas.registro.resumen().items()):
+        print(f"  {etapa:<20} n={m['n']:<6} p50<={m['p50_ms']:g} ms  p95<={m['p95_ms']:g} ms  total={m['total_s']} s")
+    tokens = cf.estadisticas_tokens_gpt()
+    if tokens["consultas"]:
+        print(f"  tokens GPT: {tokens['prompt']} de prompt ({tokens['prompt_cacheado']} desde la caché de prefijo), "
+              f"{tokens['respuesta']} de respuesta en {tokens['consultas']} consulta(s)")
+    # Cualquier factura que no terminó OK (descuadre, cuentas inválidas, error,
+    # pendiente en Azure) hace fallar la ejecución para cron/CI
+    return 0 if set(conteo) <= {OK, OMITIDA} and reporte.ok else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
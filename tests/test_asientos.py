@@ -0,0 +1,32 @@
+"""DiarioColumnar.totales con asientos sin líneas."""
+import pytest
+
+from asientos import DiarioColumnar
+
+A = [{"cuenta": "513550", "debito": 100.0, "credito": 0}, {"cuenta": "233525", "debito": 0, "credito": 100.0}]
+B = [{"cuenta": "14051001", "debito": 250.5, "credito": 0}, {"cuenta": "22050501", "debito": 0, "credito": 250.5}]
+
+
+@pytest.mark.parametrize("asientos,esperado", [
+    ([("a", A), ("vacio", []), ("b", B)], {"a": 10000, "vacio": 0, "b": 25050}),
+    ([("a", A), ("b", B), ("vacio", [])], {"a": 10000, "b": 25050, "vacio": 0}),
+    ([("vacio", []), ("a", A)], {"vacio": 0, "a": 10000}),
+    ([("vacio", [])], {"vacio": 0}),
+])
+def test_totales_con_asiento_vacio(asientos, esperado):
+    claves, debitos, creditos = DiarioColumnar.desde_dicts(asientos).totales()
+    assert dict(zip(claves, debitos.tolist())) == esperado
+    assert dict(zip(claves, creditos.tolist())) == esperado
+
+
+def test_desde_dataframe_rechaza_lineas_sin_clave():
+    import pandas as pd
+
+    df = pd.DataFrame({"asiento": ["a", None, "a", "b"], "cuenta": ["513550", "233525", "233525", "513550"],
+                       "debito": [100.0, 0, 0, 5.0], "credito": [0, 40.0, 60.0, 0]})
+    with pytest.raises(ValueError, match="1 línea"):
+        DiarioColumnar.desde_dataframe(df)
+
+    claves, debitos, creditos = DiarioColumnar.desde_dataframe(df.dropna(subset=["asiento"])).totales()
+    assert dict(zip(claves, debitos.tolist())) == {"a": 10000, "b": 500}
+    assert dict(zip(claves, creditos.tolist())) == {"a": 6000, "b": 0}
@@ -0,0 +1,33 @@
+"""construir_asientos_lote produce las mismas líneas que construir_asiento."""
+import contextlib
+import io
+
+import pandas as pd
+
+import contabilizar_factura as cf
+from bench_contabilizar import _normalizar_linea, facturas_sinteticas
+
+
+def test_lote_igual_al_escalar():
+    facturas = facturas_sinteticas(1500, semilla=11)
+    df = pd.DataFrame([dict(c, cuenta=k[0], nombre=k[1], retention_category=k[2], tipo_transaccion=k[3])
+                       for c, k in facturas])
+    lote = cf.construir_asientos_lote(df)
+    with contextlib.redirect_stdout(io.StringIO()):
+        escalar = [cf.construir_asiento(dict(c), *k) for c, k in facturas]
+
+    por_factura = {i: [] for i in range(len(facturas))}
+    for linea in lote.to_dict("records"):
+        por_factura[linea["asiento"]].append(_normalizar_linea(linea))
+    difieren = [i for i, lineas in enumerate(escalar) if por_factura[i] != [_normalizar_linea(l) for l in lineas]]
+    assert difieren == []
+    assert len(lote) == sum(len(lineas) for lineas in escalar)
+
+
+def test_lote_no_modifica_el_dataframe():
+    facturas = facturas_sinteticas(50)
+    df = pd.DataFrame([dict(c, cuenta=k[0], nombre=k[1], retention_category=k[2], tipo_transaccion=k[3])
+                       for c, k in facturas])
+    antes = df.copy()
+    cf.construir_asientos_lote(df)
+    pd.testing.assert_frame_equal(df, antes)
@@ -0,0 +1,47 @@
+"""_poller_azure: un solo análisis por clave aunque varios hilos lo pidan a la vez."""
+import threading
+import time
+
+import contabilizar_factura as cf
+
+
+class _Poller:
+    def continuation_token(self):
+        return "token"
+
+
+class _ClienteLento:
+    def __init__(self):
+        self.envios = 0
+        self._lock = threading.Lock()
+
+    def begin_analyze_document(self, model_id, document, **kwargs):
+        with self._lock:
+            self.envios += 1
+        time.sleep(0.2)  # ventana en la que otro hilo vería la clave sin token ni poller
+        return _Poller()
+
+
+def test_hilos_con_el_mismo_pdf_comparten_el_analisis(tmp_path, monkeypatch):
+    cliente = _ClienteLento()
+    pendientes = cf._CacheSQLite("azure_pendientes", path=str(tmp_path / "cache.db"))
+    monkeypatch.setattr(cf.pool_clientes, "azure", lambda: cliente)
+    monkeypatch.setattr(cf, "_pendientes_azure", lambda: pendientes)
+    clave_op = cf._clave_azure(b"%PDF-1", "modelo") + "#"
+    pollers = []
+
+    def pedir():
+        pollers.append(cf._poller_azure(clave_op, "modelo", b"%PDF-1"))
+
+    hilos = [threading.Thread(target=pedir) for _ in range(4)]
+    try:
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+    finally:
+        cf._olvidar_analisis(clave_op)
+
+    assert cliente.envios == 1
+    assert len(pollers) == 4 and all(p is pollers[0] for p in pollers)
+    assert not cf._pollers_creando
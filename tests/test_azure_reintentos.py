@@ -0,0 +1,73 @@
+"""Reintentos del cliente de Azure: el envío del análisis no, las consultas de estado sí."""
+import io
+import json
+
+import pytest
+
+pytest.importorskip("azure.ai.formrecognizer")
+import requests
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+
+import contabilizar_factura as cf
+
+ENDPOINT = "https://prueba.cognitiveservices.azure.com"
+OPERACION = ENDPOINT + "/formrecognizer/documentModels/modelo/analyzeResults/op-1?api-version=2023-07-31"
+RESULTADO = {"status": "succeeded", "createdDateTime": "2024-01-01T00:00:00Z",
+             "lastUpdatedDateTime": "2024-01-01T00:00:01Z",
+             "analyzeResult": {"apiVersion": "2023-07-31", "modelId": "modelo", "content": "",
+                               "pages": [], "documents": []}}
+
+
+def _respuesta(estado, cuerpo=None, cabeceras=None):
+    r = requests.Response()
+    r.status_code = estado
+    r.reason = "OK" if estado < 400 else "Service Unavailable"
+    contenido = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+    r._content = contenido
+    r.raw = io.BytesIO(contenido)
+    r.headers.update({"Content-Type": "application/json", **(cabeceras or {})})
+    return r
+
+
+class _SesionGuionada(requests.Session):
+    """Devuelve las respuestas de `guion[metodo]` en orden y registra cada solicitud."""
+
+    def __init__(self, guion):
+        super().__init__()
+        self.guion = {m: list(rs) for m, rs in guion.items()}
+        self.llamadas = []
+
+    def request(self, method, url, **kwargs):
+        self.llamadas.append(method)
+        return self.guion[method].pop(0)
+
+
+def _cliente(sesion):
+    return DocumentAnalysisClient(ENDPOINT, AzureKeyCredential("clave"),
+                                  transport=RequestsTransport(session=sesion, session_owner=False),
+                                  retry_policy=cf._politica_reintentos_azure(), retry_backoff_factor=0)
+
+
+def test_consulta_de_estado_fallida_se_reintenta():
+    sesion = _SesionGuionada({
+        "POST": [_respuesta(202, cabeceras={"Operation-Location": OPERACION})],
+        "GET": [_respuesta(503, {"error": {"code": "ServiceUnavailable", "message": "ocupado"}}),
+                _respuesta(200, RESULTADO)],
+    })
+    poller = _cliente(sesion).begin_analyze_document("modelo", b"%PDF", polling_interval=0)
+    assert poller.result().documents == []
+    assert sesion.llamadas == ["POST", "GET", "GET"]
+
+
+def test_envio_fallido_no_se_reintenta_en_el_sdk():
+    sesion = _SesionGuionada({
+        "POST": [_respuesta(503, {"error": {"code": "ServiceUnavailable", "message": "ocupado"}}),
+                 _respuesta(202, cabeceras={"Operation-Location": OPERACION})],
+    })
+    with pytest.raises(HttpResponseError) as e:
+        _cliente(sesion).begin_analyze_document("modelo", b"%PDF", polling_interval=0)
+    assert e.value.status_code == 503  # el gobernador decide si reintentar
+    assert sesion.llamadas == ["POST"]
@@ -0,0 +1,72 @@
+"""Caché de Azure por contenido del PDF + modelo, con expulsión por tamaño y edad."""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import contabilizar_factura as cf
+
+PDF = b"%PDF-1.4 factura de prueba"
+
+
+def _resultado(proveedor):
+    campo = SimpleNamespace(value=proveedor, content=proveedor)
+    return SimpleNamespace(documents=[SimpleNamespace(fields={"Proveedor": campo})])
+
+
+@pytest.fixture
+def analisis(tmp_path, monkeypatch):
+    """Cuenta los análisis enviados a Azure; cachés en tmp_path."""
+    cache = cf._CacheSQLite("azure_campos", path=str(tmp_path / "cache.db"))
+    pendientes = cf._CacheSQLite("azure_pendientes", path=str(tmp_path / "cache.db"))
+    enviados = []
+
+    def analizar(pdf_bytes, model_id, paginas=None, plazo_s=None, clave=None):
+        enviados.append(model_id)
+        return _resultado(f"Molino {len(enviados)}")
+
+    monkeypatch.setenv("AZURE_MODEL_ID", "modelo-a")
+    monkeypatch.setattr(cf, "_cache_azure", lambda: cache)
+    monkeypatch.setattr(cf, "_pendientes_azure", lambda: pendientes)
+    monkeypatch.setattr(cf, "_analizar_azure", analizar)
+    return enviados
+
+
+def test_mismo_pdf_no_vuelve_a_azure(analisis, tmp_path):
+    ruta = tmp_path / "factura.pdf"
+    ruta.write_bytes(PDF)
+    assert cf.extraer_campos_azure(PDF) == {"Proveedor": "Molino 1"}
+    # mismo contenido como ruta o memoryview: la clave es el SHA-256, no el nombre
+    assert cf.extraer_campos_azure(str(ruta)) == {"Proveedor": "Molino 1"}
+    assert cf.extraer_campos_azure(memoryview(PDF)) == {"Proveedor": "Molino 1"}
+    assert analisis == ["modelo-a"]
+
+
+def test_otro_modelo_o_sin_cache_vuelve_a_analizar(analisis, monkeypatch):
+    cf.extraer_campos_azure(PDF)
+    monkeypatch.setenv("AZURE_MODEL_ID", "modelo-b")
+    assert cf.extraer_campos_azure(PDF) == {"Proveedor": "Molino 2"}
+    assert cf.extraer_campos_azure(PDF, usar_cache=False) == {"Proveedor": "Molino 3"}
+    assert cf.extraer_campos_azure(PDF) == {"Proveedor": "Molino 3"}  # usar_cache=False refresca la entrada
+    assert analisis == ["modelo-a", "modelo-b", "modelo-b"]
+
+
+def test_invalidar_fuerza_un_nuevo_analisis(analisis):
+    cf.extraer_campos_azure(PDF)
+    assert cf.invalidar_cache_azure(PDF) == 1
+    assert cf.extraer_campos_azure(PDF) == {"Proveedor": "Molino 2"}
+    assert len(analisis) == 2
+
+
+def test_expulsion_por_tamano_y_edad(tmp_path):
+    cache = cf._CacheSQLite("azure_campos", path=str(tmp_path / "cache.db"), max_bytes=2500, max_age_s=60)
+    for clave in ("a", "b"):
+        cache.put(clave, "x" * 1000)
+    cache.get("a")  # "b" queda como la menos usada
+    cache.put("c", "x" * 1000)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+    with cache._lock, cache._db:
+        cache._db.execute("UPDATE azure_campos SET creado = ? WHERE clave = 'a'", (time.time() - 120,))
+    assert cache.get("a") is None
@@ -0,0 +1,40 @@
+"""Caché de clasificación: TTL desde la respuesta de GPT y entradas por huella."""
+import time
+
+import contabilizar_factura as cf
+
+RESULTADO = ("513550", "Honorarios", "SERVICIOS 2%", "servicios")
+
+
+def _memo(tmp_path, ttl_s=100.0):
+    memo = cf._MemoClasificacion(maxsize=8, ttl_s=ttl_s)
+    memo._disco = cf._CacheSQLite("clasificacion", path=str(tmp_path / "cache.db"), max_age_s=ttl_s)
+    return memo
+
+
+def test_hit_de_disco_conserva_la_fecha_original(tmp_path):
+    memo = _memo(tmp_path)
+    clave = cf._MemoClasificacion.clave("Asesoría contable", "Contadores", "", "h1")
+    memo.put(clave, RESULTADO)
+    memo._lru.clear()  # otro proceso: solo el disco tiene la entrada
+    with memo._disco._lock, memo._disco._db:
+        memo._disco._db.execute("UPDATE clasificacion SET creado = ?", (time.time() - 90,))
+
+    assert memo.get(clave) == (RESULTADO, "cache_disco")
+    creado, _ = memo._lru[clave]
+    assert time.time() - creado >= 90
+    memo.ttl_s = memo._disco.max_age_s = 50  # ya vencida: ni el LRU ni el disco la reviven
+    assert memo.get(clave) == (None, None)
+
+
+def test_otra_huella_no_borra_las_entradas_existentes(tmp_path):
+    memo = _memo(tmp_path)
+    vieja = cf._MemoClasificacion.clave("Flete arroz", "Transportes", "Ibagué - Bogotá", "h1")
+    nueva = cf._MemoClasificacion.clave("Flete arroz", "Transportes", "Ibagué - Bogotá", "h2")
+    memo.put(vieja, RESULTADO)
+
+    assert memo.get(nueva) == (None, None)
+    memo.put(nueva, RESULTADO)
+    memo._lru.clear()
+    assert memo.get(vieja) == (RESULTADO, "cache_disco")
+    assert memo.get(nueva) == (RESULTADO, "cache_disco")
@@ -0,0 +1,144 @@
+"""Clasificación en micro-lotes: una consulta por lote, reintento individual y tamaño adaptativo."""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import contabilizar_factura as cf
+
+HONORARIOS = ("513550", "Honorarios", "SERVICIOS 2%", "servicios")
+PAPELERIA = ("519530", "Útiles y papelería", "COMPRAS 2.5%", "bienes")
+
+
+def _factura(descripcion, nit=""):
+    return {"Descripcion": descripcion, "Proveedor": f"Proveedor {descripcion}", "Origen-Destino": "",
+            "NIT Proveedor": nit}
+
+
+@pytest.fixture
+def gpt(tmp_path, monkeypatch):
+    """Caché y memoria NIT en tmp_path; registra las consultas en lote e individuales."""
+    memo = cf._MemoClasificacion(maxsize=64, ttl_s=3600)
+    memo._disco = cf._CacheSQLite("clasificacion", path=str(tmp_path / "cache.db"), max_age_s=3600)
+    memoria = cf._CacheSQLite("memoria_nit", path=str(tmp_path / "cache.db"))
+    llamadas = SimpleNamespace(lotes=[], individuales=[], respuesta_lote=None, individual=None)
+
+    def lote(tripletas):
+        llamadas.lotes.append([d for d, _, _ in tripletas])
+        if llamadas.respuesta_lote is not None:
+            return llamadas.respuesta_lote(tripletas)
+        return [HONORARIOS] * len(tripletas)
+
+    def individual(descripcion, proveedor, origen_destino):
+        llamadas.individuales.append(descripcion)
+        if llamadas.individual is not None:
+            return llamadas.individual(descripcion)
+        return PAPELERIA
+
+    monkeypatch.setattr(cf, "_memo_clasificacion", memo)
+    monkeypatch.setattr(cf, "_memoria_nit", lambda: memoria)
+    monkeypatch.setattr(cf, "_huella_clasificador", lambda: "h1")
+    monkeypatch.setattr(cf, "_tamano_lote_gpt", cf._TamanoLote(4, 8))
+    monkeypatch.setattr(cf, "_clasificar_lote_api", lote)
+    monkeypatch.setattr(cf, "_clasificar_con_gpt_api", individual)
+    monkeypatch.setattr(cf, "CLASIF_CACHE_ENABLED", True)
+    return llamadas
+
+
+def test_facturas_distintas_van_en_una_consulta(gpt):
+    facturas = [_factura("Asesoría"), _factura("Auditoría"), _factura("Asesoría"), _factura("Revisoría")]
+    resultados = cf.clasificar_facturas_lote(facturas)
+
+    assert gpt.lotes == [["Asesoría", "Auditoría", "Revisoría"]]  # la repetida no se envía dos veces
+    assert gpt.individuales == []
+    assert resultados == [(*HONORARIOS, "gpt_lote")] * 4
+
+
+def test_lote_limpio_aumenta_el_tamano_en_uno(gpt):
+    cf.clasificar_facturas_lote([_factura(f"Servicio {i}") for i in range(3)])
+    assert cf._tamano_lote_gpt.n == 5
+
+
+def test_item_sin_resolver_se_reintenta_solo(gpt):
+    gpt.respuesta_lote = lambda tripletas: [None if d == "Resmas" else HONORARIOS for d, _, _ in tripletas]
+    resultados = cf.clasificar_facturas_lote([_factura("Asesoría"), _factura("Resmas"), _factura("Auditoría")])
+
+    assert gpt.individuales == ["Resmas"]
+    assert [r[-1] for r in resultados] == ["gpt_lote", "gpt", "gpt_lote"]
+    assert resultados[1] == (*PAPELERIA, "gpt")
+    assert cf._tamano_lote_gpt.n == 2  # respuesta parcial: el tamaño se parte en dos
+
+
+def test_fallo_individual_solo_afecta_su_posicion(gpt):
+    gpt.respuesta_lote = lambda tripletas: [None if d == "Resmas" else HONORARIOS for d, _, _ in tripletas]
+
+    def individual(descripcion):
+        raise ValueError("respuesta sin cuenta")
+
+    gpt.individual = individual
+    resultados = cf.clasificar_facturas_lote([_factura("Asesoría"), _factura("Resmas"), _factura("Auditoría")])
+
+    assert isinstance(resultados[1], ValueError)
+    assert resultados[0] == resultados[2] == (*HONORARIOS, "gpt_lote")
+    assert cf._memo_clasificacion.get(cf._MemoClasificacion.clave("Resmas", "Proveedor Resmas", "", "h1")) == (None, None)
+
+
+def test_lote_que_falla_se_parte_en_dos(gpt):
+    def respuesta(tripletas):
+        if len(tripletas) > 2:
+            raise json.JSONDecodeError("Expecting value", "", 0)
+        return [HONORARIOS] * len(tripletas)
+
+    gpt.respuesta_lote = respuesta
+    resultados = cf.clasificar_facturas_lote([_factura(f"Servicio {i}") for i in range(4)])
+
+    assert gpt.lotes == [[f"Servicio {i}" for i in range(4)], ["Servicio 0", "Servicio 1"], ["Servicio 2", "Servicio 3"]]
+    assert resultados == [(*HONORARIOS, "gpt_lote")] * 4
+    assert cf._tamano_lote_gpt.n == 4  # 4 -> 2 por el fallo, +1 por cada mitad limpia
+
+
+def test_max_lote_fija_el_tamano(gpt):
+    cf.clasificar_facturas_lote([_factura(f"Servicio {i}") for i in range(5)], max_lote=2)
+    assert [len(b) for b in gpt.lotes] == [2, 2]
+    assert gpt.individuales == ["Servicio 4"]  # un lote de uno es una consulta individual
+
+
+def test_cache_y_memoria_nit_evitan_la_api(gpt):
+    facturas = [_factura("Asesoría"), _factura("Auditoría")]
+    cf.clasificar_facturas_lote(facturas)
+    for factura in ("sha-1", "sha-2"):
+        cf.recordar_clasificacion_nit("900123456-1", *PAPELERIA, factura=factura)
+    gpt.lotes.clear()
+
+    resultados = cf.clasificar_facturas_lote(facturas + [_factura("Resmas", nit="900123456-1")])
+
+    assert gpt.lotes == [] and gpt.individuales == []
+    assert resultados == [(*HONORARIOS, "cache_memoria")] * 2 + [(*PAPELERIA, "memoria_nit")]
+
+
+def test_respuesta_del_lote_se_asigna_por_id(monkeypatch):
+    catalogo = SimpleNamespace(huella="h1")
+    contenido = {"resultados": [
+        {"id": 2, "cuenta": "5195-30", "nombre": "Útiles", "retention_category": "COMPRAS 2.5%"},
+        {"id": 0, "cuenta": "513550", "nombre": "Honorarios", "retention_category": "SERVICIOS 2%",
+         "tipo_transaccion": "servicios"},
+        {"id": 1, "cuenta": "", "nombre": "Sin cuenta", "retention_category": "NO APLICA"},
+        {"id": "x", "cuenta": "519530"},
+    ]}
+    enviados = []
+
+    def chat(**kwargs):
+        enviados.append(kwargs["messages"][-1]["content"])
+        mensaje = SimpleNamespace(content=json.dumps(contenido))
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+    monkeypatch.setattr(cf, "obtener_catalogo_puc", lambda *a: catalogo)
+    monkeypatch.setattr(cf, "_mensajes_gpt", lambda cat, sufijo: [{"role": "user", "content": sufijo}])
+    monkeypatch.setattr(cf, "PUC_SHORTLIST_ENABLED", False)
+    monkeypatch.setattr(cf, "_chat_gpt", chat)
+
+    salida = cf._clasificar_lote_api([("Asesoría", "Contadores", ""), ("Resmas", "Papelería", ""),
+                                      ("Lapiceros", "Papelería", ""), ("Toner", "Papelería", "")])
+
+    assert len(enviados) == 1 and all(d in enviados[0] for d in ("Asesoría", "Resmas", "Lapiceros", "Toner"))
+    assert salida == [HONORARIOS, None, ("519530", "Útiles", "COMPRAS 2.5%", ""), None]
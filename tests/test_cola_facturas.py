@@ -0,0 +1,46 @@
+"""ColaFacturas: los hilos del pool no esperan a Azure; un hilo de sondeo recoge los análisis."""
+import threading
+import time
+
+import contabilizar_factura as cf
+import cola_facturas
+from cola_facturas import ColaFacturas, ESPERANDO_AZURE, LISTO
+
+CAMPOS = {"Proveedor": "Molino", "Subtotal": 100}
+
+
+def _esperar(condicion, limite_s=5.0):
+    fin = time.time() + limite_s
+    while not condicion() and time.time() < fin:
+        time.sleep(0.01)
+    return condicion()
+
+
+def test_analisis_lento_no_retiene_el_unico_hilo(monkeypatch):
+    terminado = threading.Event()
+    plazos = []
+
+    def extraer(pdf_bytes, plazo_s=None):
+        plazos.append(plazo_s)
+        if bytes(pdf_bytes) == b"lento" and not terminado.is_set():
+            raise cf.AnalisisPendiente("abc:modelo#", plazo_s)
+        return [("1-1", dict(CAMPOS))]
+
+    monkeypatch.setattr(cola_facturas, "COLA_SONDEO_AZURE_S", 0.01)
+    monkeypatch.setattr(cf, "extraer_facturas_azure", extraer)
+    monkeypatch.setattr(cf, "analisis_terminado", lambda clave: terminado.is_set())
+    monkeypatch.setattr(cf, "clasificar_factura", lambda campos: ("513550", "Gasto", "", "servicios", "gpt"))
+    monkeypatch.setattr(cf, "construir_asiento", lambda campos, *clasificacion: [{"cuenta": "513550"}])
+
+    cola = ColaFacturas(workers=1)
+    lento = cola.encolar("s1", "lento.pdf", b"lento")
+    assert _esperar(lambda: lento.estado == ESPERANDO_AZURE)
+    rapido = cola.encolar("s2", "rapido.pdf", b"rapido")
+    assert _esperar(lambda: rapido.estado == LISTO)  # el único hilo quedó libre
+    assert lento.estado == ESPERANDO_AZURE
+
+    terminado.set()
+    assert _esperar(lambda: lento.estado == LISTO)
+    assert [f.paginas for f in lento.facturas] == ["1-1"]
+    assert set(plazos) == {0}
+    assert not cola._esperando
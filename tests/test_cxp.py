@@ -0,0 +1,51 @@
+"""Índice CxP del archivo de pares: lectura del CSV y sidecar compilado."""
+import json
+import os
+import pickle
+
+import contabilizar_factura as cf
+
+CSV = ('Debito - Cuenta,AP - Cuenta,AP - Descripción\n'
+       '513550,2335250000,"HONORARIOS\nPOR PAGAR"\n'
+       '513550,2335250000,"HONORARIOS\nPOR PAGAR"\n'
+       '51355001,2335950400,OTROS\n'
+       '14051001,2205050000,MATERIA PRIMA\n')
+
+
+def _csv(tmp_path, texto=CSV):
+    ruta = tmp_path / "pares.csv"
+    ruta.write_text(texto, encoding="utf-8")
+    return str(ruta)
+
+
+def test_campo_entre_comillas_con_salto_de_linea(tmp_path):
+    indice = cf.IndiceCxP.desde_csv(_csv(tmp_path))
+    assert indice.ap_nombres["2335250000"] == "HONORARIOS\nPOR PAGAR"
+    assert indice.buscar("513550") == ("2335250000", "exact")
+    assert indice.buscar("14051001") == ("2205050000", "exact")
+    assert indice.buscar("51355099") == ("2335250000", "prefix-6")
+
+
+class _Trampa:
+    def __reduce__(self):
+        return (open, (os.environ["CXP_TRAMPA"], "w"))
+
+
+def test_sidecar_es_json_y_no_se_deserializa_con_pickle(tmp_path, monkeypatch):
+    ruta = _csv(tmp_path)
+    trampa = tmp_path / "ejecutado"
+    monkeypatch.setenv("CXP_TRAMPA", str(trampa))
+    with open(ruta + ".cxpidx", "wb") as f:
+        pickle.dump({"version": cf._CXP_IDX_VERSION, "x": _Trampa()}, f)
+    monkeypatch.setattr(cf, "_indices_cxp", {})
+
+    indice = cf._cargar_indice_cxp(ruta)
+    assert not trampa.exists()
+    assert indice.buscar("513550") == ("2335250000", "exact")
+    with open(ruta + ".cxpidx", encoding="utf-8") as f:
+        datos = json.load(f)  # se reescribió como JSON
+
+    monkeypatch.setattr(cf, "_indices_cxp", {})
+    desde_sidecar = cf._cargar_indice_cxp(ruta)
+    assert datos["firma"] == list(cf._firma_archivo(ruta))
+    assert desde_sidecar.raiz == indice.raiz and desde_sidecar.ap_nombres == indice.ap_nombres
@@ -0,0 +1,60 @@
+"""DiarioContable: flush por temporizador, periodo de la factura e índice de facturas perezoso."""
+import time
+from datetime import date
+
+import pytest
+
+import diario as dm
+from diario import DiarioContable, leer_diario
+
+ASIENTO = [{"cuenta": "513550", "debito": 100.0, "credito": 0},
+           {"cuenta": "233525", "debito": 0, "credito": 100.0}]
+
+
+def test_temporizador_escribe_sin_mas_asientos(tmp_path):
+    d = DiarioContable(str(tmp_path), flush_lineas=1000, flush_s=0.2)
+    try:
+        d.agregar(ASIENTO, factura="f1", periodo="2024-05")
+        assert list(leer_diario(str(tmp_path))) == []  # pendiente en memoria
+        time.sleep(0.6)
+        assert [r["factura"] for r in leer_diario(str(tmp_path))] == ["f1", "f1"]
+    finally:
+        d.cerrar()
+
+
+@pytest.mark.parametrize("campos,periodo", [
+    ({"Fecha": date(2024, 3, 31)}, "2024-03"),
+    ({"Fecha": "2024-02-15"}, "2024-02"),
+    ({"Fecha Factura": "15/01/2024"}, "2024-01"),
+    ({"Fecha": "sin fecha", "Fecha de Emisión": "7-11-2023"}, "2023-11"),
+    ({"Fecha": "31/13/2024"}, None),
+    ({}, None),
+])
+def test_periodo_de_factura(campos, periodo):
+    assert dm.periodo_de_factura(campos) == periodo
+
+
+def test_periodo_por_defecto_es_el_de_la_factura(tmp_path, monkeypatch):
+    monkeypatch.setattr(dm, "periodo_actual", lambda: "2030-01")
+    with DiarioContable(str(tmp_path)) as d:
+        d.agregar(ASIENTO, factura="con_fecha", campos={"Fecha": "2024-02-15"})
+        d.agregar(ASIENTO, factura="sin_fecha", campos={})
+        d.agregar(ASIENTO, factura="forzado", campos={"Fecha": "2024-02-15"}, periodo="2024-04")
+    periodos = {r["factura"]: r["periodo"] for r in leer_diario(str(tmp_path))}
+    assert periodos == {"con_fecha": "2024-02", "sin_fecha": "2030-01", "forzado": "2024-04"}
+
+
+def test_indice_de_facturas_se_lee_una_vez_y_solo_si_se_pide(tmp_path, monkeypatch):
+    with DiarioContable(str(tmp_path)) as d:
+        d.agregar(ASIENTO, factura="previa", periodo="2024-05")
+
+    lecturas = []
+    original = dm.leer_diario
+    monkeypatch.setattr(dm, "leer_diario", lambda ruta: lecturas.append(ruta) or original(ruta))
+    with DiarioContable(str(tmp_path)) as d:
+        d.agregar(ASIENTO, factura="nueva", periodo="2024-05")
+        assert lecturas == []
+        assert d.facturas == {"previa", "nueva"}  # incluye la aún no escrita
+        d.agregar(ASIENTO, factura="otra", periodo="2024-05")
+        assert "otra" in d.facturas
+    assert len(lecturas) == 1
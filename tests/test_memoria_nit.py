@@ -0,0 +1,67 @@
+"""Memoria de clasificaciones por NIT aprendida de los asientos confirmados en la UI."""
+import pytest
+
+import contabilizar_factura as cf
+
+CAMPOS = {"NIT Proveedor": "900123456-1", "Proveedor": "Contadores Asociados", "Ciudad": "Ibagué",
+          "Actividad Economica": "CIIU: 6920", "Regimen Tributario": "Responsable de IVA",
+          "Descripcion": "Asesoría contable mensual", "Subtotal": "10000000", "Fletes": "0",
+          "IVA Valor": "1900000", "Total Factura": "11900000", "Retefuente Valor": "0"}
+SUGERIDA = ("513550", "Honorarios", "SERVICIOS 2%", "servicios")
+
+
+@pytest.fixture
+def gpt(tmp_path, monkeypatch):
+    """Memoria NIT en tmp_path; registra las facturas que llegan a GPT."""
+    memoria = cf._CacheSQLite("memoria_nit", path=str(tmp_path / "cache.db"))
+    llamadas = []
+
+    def clasificar(descripcion, proveedor, origen_destino, usar_cache):
+        llamadas.append(descripcion)
+        return SUGERIDA, "gpt"
+
+    monkeypatch.setattr(cf, "_memoria_nit", lambda: memoria)
+    monkeypatch.setattr(cf, "_clasificar_memoizado", clasificar)
+    monkeypatch.setattr(cf, "NIT_MEMORIA_MIN_CONFIRMACIONES", 2)
+    return llamadas
+
+
+def _confirmar(factura, clasificacion=SUGERIDA):
+    asiento = cf.construir_asiento(dict(CAMPOS), *clasificacion)
+    return cf.aprender_de_asiento(CAMPOS, asiento, clasificacion, factura=factura)
+
+
+def _memoria():
+    reg = cf.consultar_memoria_nit(CAMPOS["NIT Proveedor"])
+    return reg["cuenta"], reg["nombre"], reg["retention_category"], reg["tipo_transaccion"]
+
+
+def test_confirmaciones_de_facturas_distintas_evitan_gpt(gpt):
+    reg = _confirmar("sha-1")
+    assert (reg["cuenta"], reg["tipo_transaccion"], reg["confirmaciones"]) == ("513550", "servicios", 1)
+    assert cf.clasificar_factura(CAMPOS)[-1] == "gpt"  # una sola confirmación no basta
+
+    _confirmar("sha-2")
+    assert cf.clasificar_factura(CAMPOS) == (*_memoria(), "memoria_nit")
+    assert len(gpt) == 1
+
+
+def test_descargar_dos_veces_la_misma_factura_cuenta_una_vez(gpt):
+    _confirmar("sha-1")
+    assert _confirmar("sha-1")["confirmaciones"] == 1
+    assert cf.consultar_memoria_nit(CAMPOS["NIT Proveedor"]) is None
+
+
+def test_clasificacion_distinta_reinicia_la_cuenta(gpt):
+    _confirmar("sha-1")
+    _confirmar("sha-2")
+    otra = ("519530", "Útiles y papelería", "COMPRAS 2.5%", "bienes")
+    assert cf.recordar_clasificacion_nit(CAMPOS["NIT Proveedor"], *otra, factura="sha-3")["confirmaciones"] == 1
+    assert cf.consultar_memoria_nit(CAMPOS["NIT Proveedor"]) is None
+    assert cf.clasificar_factura(CAMPOS)[-1] == "gpt"
+
+
+def test_usar_cache_false_ignora_la_memoria(gpt):
+    _confirmar("sha-1")
+    _confirmar("sha-2")
+    assert cf.clasificar_factura(CAMPOS, usar_cache=False)[-1] == "gpt"
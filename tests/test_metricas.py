@@ -0,0 +1,61 @@
+"""Spans por etapa, exportación Prometheus y /metrics local."""
+import urllib.request
+
+import pytest
+
+import contabilizar_factura as cf
+import metricas
+from metricas import RegistroMetricas, span
+
+
+@pytest.fixture
+def registro(monkeypatch):
+    nuevo = RegistroMetricas()
+    monkeypatch.setattr(metricas, "registro", nuevo)
+    return nuevo
+
+
+def test_span_cuenta_ok_y_error_y_propaga(registro):
+    with span("cxp"):
+        pass
+    with pytest.raises(ZeroDivisionError):
+        with span("cxp"):
+            1 / 0
+    texto = registro.exportar_prometheus()
+    assert 'contabilizar_etapa_total{etapa="cxp",resultado="ok"} 1' in texto
+    assert 'contabilizar_etapa_total{etapa="cxp",resultado="error"} 1' in texto
+    assert 'contabilizar_etapa_segundos_count{etapa="cxp"} 2' in texto
+    assert registro.resumen()["cxp"]["n"] == 2
+
+
+def test_histograma_acumulado_y_etiquetas_escapadas(registro):
+    for v in (0.002, 0.02, 3.0, 100.0):
+        registro.observar("latencia_segundos", v, ayuda="Latencia", servicio='az"ure')
+    lineas = registro.exportar_prometheus().splitlines()
+    assert "# TYPE latencia_segundos histogram" in lineas
+    etiqueta = 'servicio="az\\"ure"'
+    assert f'latencia_segundos_bucket{{{etiqueta},le="0.005"}} 1' in lineas
+    assert f'latencia_segundos_bucket{{{etiqueta},le="0.05"}} 2' in lineas
+    assert f'latencia_segundos_bucket{{{etiqueta},le="60.0"}} 3' in lineas
+    assert f'latencia_segundos_bucket{{{etiqueta},le="+Inf"}} 4' in lineas
+    assert f"latencia_segundos_count{{{etiqueta}}} 4" in lineas
+
+
+def test_asiento_se_mide_sin_imprimir(registro, capsys):
+    campos = {"NIT Proveedor": "900123456-1", "Proveedor": "Transportes", "Ciudad": "Ibagué",
+              "Actividad Economica": "CIIU: 4923", "Descripcion": "Flete", "Subtotal": "3000000",
+              "IVA Valor": "0", "Total Factura": "3000000"}
+    cf.construir_asiento(campos, "5235500000", "Fletes", "SERVICIOS 1%", "servicios")
+    assert capsys.readouterr().out == ""
+    assert registro.resumen()["asiento"]["n"] == 1
+
+
+def test_servidor_local_expone_metrics():
+    metricas.incrementar("contabilizar_prueba_total", ayuda="Prueba del servidor", origen="test")
+    servidor = metricas.servir_metricas(0)
+    assert metricas.servir_metricas(0) is servidor  # una sola vez por proceso
+    url = f"http://127.0.0.1:{servidor.server_port}/metrics"
+    with urllib.request.urlopen(url, timeout=5) as r:
+        assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        cuerpo = r.read().decode("utf-8")
+    assert 'contabilizar_prueba_total{origen="test"} 1' in cuerpo
@@ -0,0 +1,82 @@
+"""Tabla de reglas tributarias y autómata de palabras clave frente a la búsqueda con `in`."""
+import json
+import random
+
+import pytest
+
+import contabilizar_factura as cf
+
+
+def _por_subcadena(palabras, texto):
+    return {familia for familia, lista in palabras.items() if any(p in texto for p in lista)}
+
+
+def test_automata_con_palabras_solapadas():
+    palabras = {"a": ["he", "she"], "b": ["hers"], "c": ["his"], "d": ["e"]}
+    automata = cf.AutomataPalabras(palabras)
+    for texto in ("ushers", "this", "hishe", "", "xyz", "hehers"):
+        assert automata.buscar(texto) == _por_subcadena(palabras, texto), texto
+
+
+def test_automata_igual_a_la_busqueda_por_subcadena_con_la_tabla_real():
+    with open(cf._resolver_reglas(cf.REGLAS_TRIBUTARIAS_PATH), encoding="utf-8") as f:
+        palabras = {fam: [cf._canon(p) for p in lista] for fam, lista in json.load(f)["palabras"].items()}
+    automata = cf.AutomataPalabras(palabras)
+    trozos = [p for lista in palabras.values() for p in lista] + ["no somos", "factura", "iva", " ", "de", "ic"]
+    azar = random.Random(15)
+    for _ in range(2000):
+        partes = [azar.choice(trozos) for _ in range(azar.randint(0, 5))]
+        texto = "".join(p[azar.randint(0, len(p) // 2):] if azar.random() < 0.3 else p for p in partes)
+        assert automata.buscar(texto) == _por_subcadena(palabras, texto), texto
+
+
+@pytest.mark.parametrize("texto,familias", [
+    ("Servicio de TRANSPORTE de carga", {"flete"}),
+    ("AUTORRETENEDOR DE ICA en Ibagué", {"renta_ica", "exclusion_ica", "ibague"}),
+    ("Régimen Simple de Tributación", {"exclusion_ica", "regimen_simple"}),
+    ("Asesoría contable", set()),
+])
+def test_familias_sobre_texto_canonico(texto, familias):
+    assert cf.obtener_reglas().familias(cf._canon(texto)) == familias
+
+
+@pytest.mark.parametrize("categoria,descripcion,cuenta,esperada", [
+    ("Servicios 1 %", "", "", "SERVICIOS 1%"),
+    ("servicios 2%", "", "", "SERVICIOS 2%"),
+    ("", "Flete Ibagué - Bogotá", "", "SERVICIOS 1%"),
+    ("", "", "5235500000", "SERVICIOS 1%"),
+    ("INEXISTENTE 9%", "Asesoría", "513550", ""),
+])
+def test_normaliza_categoria_de_retencion(categoria, descripcion, cuenta, esperada):
+    assert cf.normalize_retention_category(categoria, descripcion=descripcion, cuenta=cuenta) == esperada
+
+
+def test_autorretenedor_de_renta_y_sus_negaciones():
+    assert cf.es_autorretenedor_renta("Somos Autorretenedor de Renta")
+    assert not cf.es_autorretenedor_renta("No somos autorretenedores de renta")
+    assert not cf.es_autorretenedor_renta("Autorretenedor de ICA")
+
+
+def test_tabla_se_recompila_al_cambiar(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, "REGLAS_RECARGA_S", 0)
+    with open(cf._resolver_reglas(cf.REGLAS_TRIBUTARIAS_PATH), encoding="utf-8") as f:
+        datos = json.load(f)
+    ruta = tmp_path / "reglas.json"
+    ruta.write_text(json.dumps(datos), encoding="utf-8")
+    reglas = cf.obtener_reglas(str(ruta))
+    assert cf.obtener_reglas(str(ruta)) is reglas
+
+    datos["version"] = "prueba-2"
+    datos["palabras"]["flete"].append("encomienda")
+    ruta.write_text(json.dumps(datos), encoding="utf-8")
+    nuevas = cf.obtener_reglas(str(ruta))
+    assert nuevas is not reglas and nuevas.version == "prueba-2"
+    assert "flete" in nuevas.familias("envio por encomienda")
+
+
+def test_tabla_invalida_se_rechaza(tmp_path):
+    ruta = tmp_path / "reglas.json"
+    ruta.write_text(json.dumps({"retencion": {"X": {"cuenta": "236540"}}, "iva": [], "palabras": {}}),
+                    encoding="utf-8")
+    with pytest.raises(ValueError, match="tabla inválida"):
+        cf.ReglasTributarias.cargar(str(ruta))
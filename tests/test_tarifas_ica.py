@@ -0,0 +1,54 @@
+"""Registro de tarifas ICA Ibagué: consulta por CIIU, unidades al cargar y recarga por cambio de archivo."""
+import os
+
+import pytest
+
+import contabilizar_factura as cf
+
+TRANSPORTE = {"Actividad Economica": "CIIU: 4923", "Regimen Tributario": "Responsable de IVA"}
+
+
+@pytest.mark.parametrize("ciudad", ["Ibagué", "IBAGUE - TOLIMA", "ibague"])
+def test_proveedor_de_ibague_retiene_ica_y_bomberil(ciudad):
+    reteica, bomberil, cta_ica, cta_bomb, _ = cf.calcular_ica_bomberil(dict(TRANSPORTE, Ciudad=ciudad), 3000000)
+    assert (reteica, bomberil) == (24900.0, 4980.0)  # 8.3 por mil; bomberil 20 % del reteICA
+    assert (cta_ica, cta_bomb) == (cf.ICA_ACCOUNT_DEFAULT, cf.BOMBERIL_ACCOUNT_DEFAULT)
+
+
+def test_proveedor_de_espinal_no_retiene():
+    reteica, bomberil, *_, nota = cf.calcular_ica_bomberil(dict(TRANSPORTE, Ciudad="Espinal"), 3000000)
+    assert (reteica, bomberil) == (0.0, 0.0)
+    assert "NO domiciliado" in nota
+
+
+def test_ciiu_sin_tarifa_no_retiene():
+    campos = dict(TRANSPORTE, Ciudad="Ibagué", **{"Actividad Economica": "Actividad Económica 6920"})
+    assert cf.calcular_ica_bomberil(campos, 3000000)[0] == 0.0
+    assert cf.obtener_registro_ica().get("CIIU 4923").tarifa == 0.0083
+    assert cf.obtener_registro_ica().get("6920") is None
+
+
+def test_unidades_se_normalizan_al_cargar(tmp_path):
+    ruta = tmp_path / "tarifas.csv"
+    ruta.write_text("Código CIIU;Tarifa por mil;Base mínima;Bomberil\n"
+                    "161;8,3;1.271.000;20\n"
+                    "4711;0,6;;0.15\n"
+                    "9999;45;;\n", encoding="utf-8")
+    reg = cf.RegistroTarifasICA.cargar(str(ruta))
+    assert reg.get("0161") == cf.TarifaICA("0161", 0.0083, 1271000.0, 0.2)
+    assert reg.get("4711") == cf.TarifaICA("4711", 0.0006, 0.0, 0.15)
+    assert reg.get("9999") is None  # 45 por mil: error de unidades, se descarta con advertencia
+    assert any("fuera de rango" in a for a in reg.advertencias)
+
+
+def test_se_recarga_solo_si_cambia_el_archivo(tmp_path):
+    ruta = tmp_path / "tarifas.csv"
+    ruta.write_text("CIIU,tarifa,tasa_bomberil\n4923,0.0083,0.2\n", encoding="utf-8")
+    reg = cf.obtener_registro_ica(str(ruta))
+    assert cf.obtener_registro_ica(str(ruta)) is reg
+
+    ruta.write_text("CIIU,tarifa,tasa_bomberil\n4923,0.01,0.2\n6920,0.0096,\n", encoding="utf-8")
+    os.utime(ruta, ns=(reg.firma[0] + 10**9, reg.firma[0] + 10**9))
+    nuevo = cf.obtener_registro_ica(str(ruta))
+    assert nuevo is not reg
+    assert nuevo.get("4923").tarifa == 0.01 and nuevo.get("6920").tarifa == 0.0096
@@ -0,0 +1,92 @@
+"""Asientos reales de construir_asiento frente a validar_cuentas_puc / validar_asientos_lote."""
+import pandas as pd
+import pytest
+
+import contabilizar_factura as cf
+
+_BASE = {"NIT Proveedor": "900123456-1", "Regimen Tributario": "Responsable de IVA",
+         "Fletes": "0", "Retefuente Valor": "0"}
+
+# (campos, clasificación): CxP del archivo de pares, IVA y retención de las
+# reglas, ReteICA/bomberil de Ibagué, fomento arrocero y fletes 5235500000
+FACTURAS = [
+    (dict(_BASE, **{"Proveedor": "Contadores Asociados", "Ciudad": "Ibagué", "Actividad Economica": "CIIU: 6920",
+                    "Descripcion": "Asesoría contable mensual", "Subtotal": "10000000",
+                    "IVA Valor": "1900000", "Total Factura": "11900000"}),
+     ("513550", "Honorarios", "SERVICIOS 2%", "servicios")),
+    (dict(_BASE, **{"Proveedor": "Molino", "Ciudad": "Espinal", "Actividad Economica": "CIIU: 0112",
+                    "Descripcion": "Arroz paddy verde", "Subtotal": "20000000", "Cantidad": "10,000",
+                    "IVA Valor": "0", "Total Factura": "20000000"}),
+     ("14051001", "Arroz paddy", "COMPRAS 2.5%", "bienes")),
+    (dict(_BASE, **{"Proveedor": "Transportes", "Ciudad": "Ibagué", "Actividad Economica": "CIIU: 4923",
+                    "Descripcion": "Flete arroz", "Origen-Destino": "Ibagué - Bogotá", "Subtotal": "3000000",
+                    "IVA Valor": "0", "Total Factura": "3000000"}),
+     ("5235500000", "Fletes", "SERVICIOS 1%", "servicios")),
+]
+
+
+def _asiento(campos, clasificacion):
+    return cf.construir_asiento(dict(campos), *clasificacion)
+
+
+@pytest.mark.parametrize("campos,clasificacion", FACTURAS)
+def test_asiento_real_pasa_validacion(campos, clasificacion):
+    asiento = _asiento(campos, clasificacion)
+    assert cf.validar_balance(asiento)[0]
+    assert cf.validar_cuentas_puc(asiento) == set()
+
+
+def test_diario_real_pasa_validacion_lote():
+    df = pd.DataFrame([dict(l, factura=f"f{i}") for i, (c, k) in enumerate(FACTURAS) for l in _asiento(c, k)])
+    cuentas = set(df["cuenta"])
+    assert {cf.ICA_ACCOUNT_DEFAULT, cf.BOMBERIL_ACCOUNT_DEFAULT, cf.CUENTA_FOMENTO, "5235500000"} <= cuentas
+    reporte = cf.validar_asientos_lote(df)
+    assert reporte.ok, reporte.resumen()
+
+
+def test_cuenta_inexistente_se_reporta():
+    asiento = _asiento(*FACTURAS[0])
+    asiento[0] = dict(asiento[0], cuenta="99999999")
+    assert cf.validar_cuentas_puc(asiento) == {"99999999"}
+    reporte = cf.validar_asientos_lote(pd.DataFrame([dict(l, factura="f0") for l in asiento]))
+    assert not reporte.ok
+    assert reporte.cuentas_invalidas["cuenta"].tolist() == ["99999999"]
+
+
+def test_facturas_procesadas_sin_asiento_se_reportan():
+    df = pd.DataFrame([dict(l, factura="f0") for l in _asiento(*FACTURAS[0])])
+    reporte = cf.validar_asientos_lote(df, esperadas=["f0", "f1", "f2"])
+    assert not reporte.ok
+    assert reporte.faltantes == ("f1", "f2")
+    assert "2 factura(s) procesada(s) sin asiento" in reporte.resumen()
+
+    vacio = cf.validar_asientos_lote(df.iloc[0:0], esperadas=["f0"])
+    assert not vacio.ok and vacio.faltantes == ("f0",)
+    assert cf.validar_asientos_lote(df, esperadas=["f0"]).ok
+
+
+def test_solo_las_facturas_aprobadas_se_esperan_en_el_diario(tmp_path):
+    from procesar_lote import CUENTAS_INVALIDAS, DESCUADRE, ERROR, OK, Manifiesto
+
+    manifiesto = Manifiesto(str(tmp_path / "manifiesto.jsonl"))
+    for clave, estado in [("f0", OK), ("f1", DESCUADRE), ("f2", CUENTAS_INVALIDAS), ("f3", ERROR), ("f4", OK)]:
+        manifiesto.registrar(clave, estado=estado)
+    assert sorted(manifiesto.aprobadas()) == ["f0", "f4"]
+
+    # El diario solo recibe las aprobadas: las rechazadas no cuentan como faltantes
+    df = pd.DataFrame([dict(l, factura=f) for f, (campos, clasif) in [("f0", FACTURAS[0]), ("f4", FACTURAS[1])]
+                       for l in _asiento(campos, clasif)])
+    assert cf.validar_asientos_lote(df, esperadas=manifiesto.aprobadas()).faltantes == ()
+    reporte = cf.validar_asientos_lote(df[df["factura"] == "f0"], esperadas=manifiesto.aprobadas())
+    assert reporte.faltantes == ("f4",)
+
+
+def test_cuentas_de_las_tablas_existen_en_el_puc():
+    assert cf.cuentas_sistema_fuera_del_puc() == {}
+
+
+def test_cuenta_mal_digitada_en_una_tabla_no_se_acepta(monkeypatch):
+    monkeypatch.setattr(cf, "ICA_ACCOUNT_DEFAULT", "2368050001")
+    assert cf.cuentas_sistema_fuera_del_puc() == {"2368050001": "PUC_RETEICA_IBAGUE"}
+    asiento = _asiento(*FACTURAS[2])
+    assert cf.validar_cuentas_puc(asiento) == {"2368050001"}